@@ -1,18 +1,30 @@
 from django.contrib import admin
-from .models import Room, Message
+from chatapp.paginations import EstimatedCountPaginator
+from .models import Room, Message, ArchivedMessage
 
 
 class RoomAdmin(admin.ModelAdmin):
     list_display = ('name', 'label', 'user',)
     search_fields = ('name', 'user__username')
-    list_filter = ('user',)
+    list_select_related = ('user',)
+    raw_id_fields = ('user', 'users', 'last_message', 'last_sender')
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
 
 
 class MessageAdmin(admin.ModelAdmin):
     list_display = ('subject', 'message', 'user', 'room')
     search_fields = ('message', 'subject', 'user__username')
-    list_filter = ('user', 'room',)
+    list_select_related = ('user', 'room')
+    raw_id_fields = ('user', 'room')
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+
+
+class ArchivedMessageAdmin(MessageAdmin):
+    list_display = ('subject', 'message', 'user', 'room', 'created')
 
 
 admin.site.register(Room, RoomAdmin)
 admin.site.register(Message, MessageAdmin)
+admin.site.register(ArchivedMessage, ArchivedMessageAdmin)
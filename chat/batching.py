@@ -0,0 +1,111 @@
+import atexit
+import logging
+import threading
+from django.db import close_old_connections
+
+logger = logging.getLogger(__name__)
+
+
+class BackgroundBatcher:
+    """
+    Collect items from any thread and hand them to `handler` in batches,
+    every `interval` milliseconds or as soon as `batch_size` items wait
+    """
+
+    def __init__(self, handler, interval, batch_size, name='batcher',
+                 flush_on_exit=True):
+        """
+        :param handler: Callable receiving the list of pending items
+        :param interval: Maximum milliseconds an item waits
+        :param batch_size: Number of pending items triggering a flush
+        :param name: Name of the flushing thread
+        :param flush_on_exit: Flush pending items when the process exits
+        """
+
+        self.handler = handler
+        self.interval = interval / 1000
+        self.batch_size = batch_size
+        self.name = name
+
+        self._items = []
+        self._condition = threading.Condition()
+        self._thread = None
+        self._stopped = False
+
+        atexit.register(self.stop, flush=flush_on_exit)
+
+    def __len__(self):
+        with self._condition:
+            return len(self._items)
+
+    def add(self, item):
+        """
+        Queue an item and wake up the flushing thread when the batch is full
+        """
+
+        with self._condition:
+            self._items.append(item)
+            self._start()
+
+            if len(self._items) >= self.batch_size:
+                self._condition.notify()
+
+    def flush(self):
+        """
+        Hand the pending items to the handler in the calling thread
+        """
+
+        with self._condition:
+            items, self._items = self._items, []
+
+        if items:
+            self.handler(items)
+
+        return len(items)
+
+    def stop(self, flush=True):
+        """
+        Stop the flushing thread and flush what is left
+        :param flush: False drops the pending items instead
+        """
+
+        with self._condition:
+            self._stopped = True
+            self._condition.notify()
+
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+        if flush:
+            self.flush()
+        else:
+            with self._condition:
+                self._items = []
+
+    def _start(self):
+        if self._thread is None and not self._stopped:
+            self._thread = threading.Thread(
+                target=self._run, name=self.name, daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                if not self._stopped and len(self._items) < self.batch_size:
+                    self._condition.wait(self.interval)
+
+                if self._stopped:
+                    return
+
+                if not self._items:
+                    continue
+
+            close_old_connections()
+
+            try:
+                self.flush()
+            except Exception:
+                logger.exception('%s failed to flush a batch.', self.name)
+            finally:
+                close_old_connections()
@@ -1,142 +1,485 @@
-from asgiref.sync import async_to_sync
-from channels.generic.websocket import WebsocketConsumer
-import json
-import asyncio
+import logging
+from urllib.parse import parse_qs
+from channels.generic.websocket import AsyncJsonWebsocketConsumer
+from django.conf import settings
+from django.db import DatabaseError
 from rest_framework.exceptions import ValidationError, NotFound
-from chatapp.constants import CHAT_ROOM_PREFIX
-from .views import MessageViewSet
+from chatapp.constants import CHAT_ROOM_PREFIX, CHAT_USER_PREFIX
+from chatapp.queries import QueryCounter
+from .executors import database_to_async
+from .metrics import (
+    BYTES_RECEIVED, BYTES_SENT, CHANNEL_LAYER_SECONDS, COMMAND_SECONDS,
+    CONNECTIONS, FRAMES_RECEIVED, FRAMES_SENT, ROOM_CONNECTIONS,
+    SERIALIZE_SECONDS)
 from .models import Message, Room
-from .serializers import MessageSerializer
+from .protocols import encode_frames, negotiate
+from .serializers import MessageProjection
+from .writers import get_message_writer
 from chatapp import constants
-from django.core import serializers
 
+logger = logging.getLogger(__name__)
 
-class ChatConsumer(WebsocketConsumer):
+
+@database_to_async
+def get_rooms(room_ids):
     """
-    Chat consumer
+    Get rooms and their users with one query each
     """
 
-    def init_chat(self):
-        """
-        Init chat room by check user, room
-        """
+    rooms = Room.objects.filter(pk__in=room_ids).prefetch_related('users')
+    return {room.id: (room, list(room.users.all())) for room in rooms}
 
-        self.user = self.scope['user']
 
-        # Check not valid user
-        if not self.user or not self.user.is_authenticated:
-            self.send_error_message('Require login.')
-            return
+@database_to_async
+def get_room_data(user, room, room_users, protocol, room_version=None,
+                  last_seen_message_id=None):
+    """
+    Get latest messages, room and users data of a room. A client resuming
+    from `last_seen_message_id` only gets the messages it missed, unless
+    it missed more than MESSAGE_RESUME_MAXIMUM
+    """
 
-        # Check user in the room
-        self.room_id = int(self.scope['url_route']['kwargs']['room'])
-        self.room_group_name = f'{CHAT_ROOM_PREFIX}{self.room_id}'
+    if last_seen_message_id is not None:
+        messages = Message.objects.history_after(
+            room.id, last_seen_message_id, constants.MESSAGE_RESUME_MAXIMUM + 1)
 
-        try:
-            self.room = Room.objects.get_room(pk=self.room_id)
-            self.room_users = self.room.users.all()
+        if len(messages) <= constants.MESSAGE_RESUME_MAXIMUM:
+            return {
+                'command': 'fetch_data',
+                'resumed': True,
+                'messages': MessageProjection.from_instances(messages),
+            }
+
+    # Get messages form a room
+    messages = MessageProjection.values(Message.objects.messages(
+        user, room.id))[:constants.MESSAGE_MAXIMUM][::-1]
+
+    return {
+        'command': 'fetch_data',
+        'messages': MessageProjection.from_rows(messages),
+        **protocol.room_data(room, room_users, room_version)
+    }
+
+
+@database_to_async
+def get_history(room_id, message_id, limit, before):
+    """
+    Get a chunk of messages before or after a message, oldest first
+    """
 
-            if self.user not in self.room_users:
-                self.send_error_message('User is not in this room.')
+    if before:
+        messages = Message.objects.history_before(
+            room_id, message_id, limit)[::-1]
+    else:
+        messages = Message.objects.history_after(room_id, message_id, limit)
 
-        except (ValidationError, NotFound) as e:
-            self.send_error_message(str(e))
+    return MessageProjection.from_instances(messages)
 
-    def connect(self):
+
+@database_to_async
+def write_message(writer, message):
+    """
+    Store new message
+    """
+    return writer.write(message)
+
+
+class ChatConsumer(AsyncJsonWebsocketConsumer):
+    """
+    Chat consumer. A connection to `ws/chat/<room>/` is subscribed to that
+    room, a connection to `ws/chat/` subscribes and unsubscribes to many
+    rooms. Frames about a room carry its `room_id`, which commands of a
+    connection with more than one room must give.
+    """
+
+    async def connect(self):
         """
         Connect to unique channel
         """
 
-        self.init_chat()
+        self.protocol = negotiate(self.scope.get('subprotocols'))
+        self.user = self.scope['user']
+        self.rooms = {}
+        self.room_users = {}
+        self.last_seen_message_id = {}
+        CONNECTIONS.inc()
+
+        error = await self.init_chat()
+
+        await self.accept(subprotocol=self.protocol.subprotocol)
 
         # Check init success
-        if hasattr(self, 'room_group_name'):
+        if error:
+            await self.send_error_message(error)
+            return await self.close()
 
-            async_to_sync(self.channel_layer.group_add)(
-                self.room_group_name,
+    async def init_chat(self):
+        """
+        Init chat by check user and subscribe to the room of the URL, before
+        accepting so the client does not miss messages
+        :returns: Error message
+        """
+
+        # Check not valid user
+        if not self.user or not self.user.is_authenticated:
+            return 'Require login.'
+
+        # Personal group receiving updates of all user rooms
+        self.user_group_name = f'{CHAT_USER_PREFIX}{self.user.id}'
+
+        with CHANNEL_LAYER_SECONDS.time(operation='group_add'):
+            await self.channel_layer.group_add(
+                self.user_group_name,
                 self.channel_name
             )
 
-            self.accept()
+        room_id = self.scope['url_route']['kwargs'].get('room')
+
+        if room_id is not None:
+            errors = await self.subscribe_rooms([room_id])
 
-    def disconnect(self, close_code):
+            if errors:
+                return errors[0][1]
+
+            # Reconnecting client resumes from the query string on its
+            # first fetch_data
+            query = parse_qs(self.scope.get('query_string', b'').decode())
+
+            if 'last_seen_message_id' in query:
+                self.last_seen_message_id[room_id] = \
+                    query['last_seen_message_id'][0]
+
+    async def disconnect(self, close_code):
         """
         Disconnect form a channel
         """
 
-        async_to_sync(self.channel_layer.group_discard)(
-            self.room_group_name,
-            self.channel_name
-        )
+        if not hasattr(self, 'rooms'):
+            return
+
+        CONNECTIONS.dec()
+
+        for room_id in list(self.rooms):
+            await self.unsubscribe_room(room_id)
+
+        if hasattr(self, 'user_group_name'):
+            with CHANNEL_LAYER_SECONDS.time(operation='group_discard'):
+                await self.channel_layer.group_discard(
+                    self.user_group_name,
+                    self.channel_name
+                )
+
+    async def subscribe_rooms(self, room_ids):
+        """
+        Check the membership of all rooms at once and join the groups of
+        the rooms user is member of
+        :param room_ids: List of room ID
+        :returns: List of (room ID, error message) of the rejected rooms
+        """
+
+        rooms = await get_rooms(room_ids)
+        errors = []
+
+        for room_id in room_ids:
+
+            if room_id not in rooms:
+                errors.append((room_id, 'Room matching query does not exist.'))
+                continue
+
+            room, room_users = rooms[room_id]
+
+            # Check user in the room
+            if self.user not in room_users:
+                errors.append((room_id, 'User is not in this room.'))
+                continue
+
+            if room_id not in self.rooms:
+                with CHANNEL_LAYER_SECONDS.time(operation='group_add'):
+                    await self.channel_layer.group_add(
+                        f'{CHAT_ROOM_PREFIX}{room_id}',
+                        self.channel_name
+                    )
+
+                ROOM_CONNECTIONS.inc(room=room_id)
+
+            self.rooms[room_id] = room
+            self.room_users[room_id] = room_users
+
+        return errors
 
-    def receive(self, text_data):
+    async def unsubscribe_room(self, room_id):
+        """
+        Leave the group of a room
+        """
+
+        if self.rooms.pop(room_id, None):
+            del self.room_users[room_id]
+
+            with CHANNEL_LAYER_SECONDS.time(operation='group_discard'):
+                await self.channel_layer.group_discard(
+                    f'{CHAT_ROOM_PREFIX}{room_id}',
+                    self.channel_name
+                )
+
+            # Do not keep a series per room that ever had a connection
+            if not ROOM_CONNECTIONS.dec(room=room_id):
+                ROOM_CONNECTIONS.remove(room=room_id)
+
+    async def receive(self, text_data=None, bytes_data=None, **kwargs):
+        """
+        Decode frame with the negotiated protocol
+        """
+
+        FRAMES_RECEIVED.inc(protocol=self.protocol.name)
+        BYTES_RECEIVED.inc(len(text_data or bytes_data or ''),
+                           protocol=self.protocol.name)
+
+        with SERIALIZE_SECONDS.time(operation='decode'):
+            content = self.protocol.decode(text_data, bytes_data)
+
+        await self.receive_json(content)
+
+    async def receive_json(self, content):
         """
         Receive message
         """
 
-        data = json.loads(text_data)
-        self.commands[data['command']](self, data)
+        name = content.get('command')
+        command = self.commands.get(name)
+
+        if not command:
+            return await self.send_error_message('Command is not supported.')
+
+        if settings.DEBUG:
+            return await self.run_counted(name, command, content)
+
+        with COMMAND_SECONDS.time(command=name):
+            await command(self, content)
+
+    async def run_counted(self, name, command, content):
+        """
+        Run a command and log its SQL queries and database time, including
+        the ones run by the database executor
+        """
+
+        with QueryCounter() as queries, COMMAND_SECONDS.time(command=name):
+            await command(self, content)
+
+        logger.debug('%s: %d queries in %.2f ms', name, queries.count,
+                     queries.duration * 1000)
+
+        return queries
+
+    def get_room(self, data):
+        """
+        Get the subscribed room a command is about
+        :returns: Room instance or None
+        """
+
+        room_id = data.get('room_id')
+
+        if room_id is None and len(self.rooms) == 1:
+            return next(iter(self.rooms.values()))
+
+        try:
+            return self.rooms.get(int(room_id))
+        except (TypeError, ValueError):
+            return None
+
+    async def subscribe(self, data):
+        """
+        Subscribe to rooms
+        """
+
+        try:
+            room_ids = [int(room_id) for room_id in data.get('rooms')]
+        except (TypeError, ValueError):
+            return await self.send_error_message('Rooms must a list of room ID.')
+
+        if len(set(room_ids) | set(self.rooms)) > constants.ROOM_SUBSCRIPTION_MAXIMUM:
+            return await self.send_error_message(
+                f'Maximum {constants.ROOM_SUBSCRIPTION_MAXIMUM} rooms in a connection.')
+
+        errors = await self.subscribe_rooms(room_ids)
+
+        for room_id, error in errors:
+            await self.send_error_message(error, room_id)
+
+        await self.send_message({
+            'command': 'subscribe',
+            'rooms': list(self.rooms),
+        })
 
-    def json_serialize(self, data):
+    async def unsubscribe(self, data):
         """
-        Serializer data to json
+        Unsubscribe from rooms
         """
-        return json.loads(serializers.serialize('json', data))
 
-    def fetch_data(self, data=None):
+        try:
+            room_ids = [int(room_id) for room_id in data.get('rooms')]
+        except (TypeError, ValueError):
+            return await self.send_error_message('Rooms must a list of room ID.')
+
+        for room_id in room_ids:
+            await self.unsubscribe_room(room_id)
+
+        await self.send_message({
+            'command': 'unsubscribe',
+            'rooms': list(self.rooms),
+        })
+
+    async def fetch_data(self, data=None):
         """
         Fetch latest messages form a room
         """
 
+        data = data or {}
+        room = self.get_room(data)
+
+        if not room:
+            return await self.send_error_message('Room is not subscribed.')
+
+        last_seen_message_id = data.get(
+            'last_seen_message_id', self.last_seen_message_id.pop(room.id, None))
+
         try:
+            if last_seen_message_id is not None:
+                last_seen_message_id = int(last_seen_message_id)
+        except (TypeError, ValueError):
+            return await self.send_error_message(
+                'Last seen message ID must be an integer.', room.id)
 
-            # Get messages form a room
-            messages = Message.objects.messages(self.user,
-                self.room.id)[:constants.MESSAGE_MAXIMUM][::-1]
+        resume = last_seen_message_id is not None
 
-            messages_serializer = MessageSerializer(messages, many=True)
-            room_serializer = self.json_serialize([self.room, ])
-            users_serializer = self.json_serialize(self.room_users)
+        # Buffered messages are broadcast without ID, clients cannot know
+        # which one they saw last, they get a full snapshot
+        if get_message_writer().buffered:
+            last_seen_message_id = None
 
-            content = {
-                'command': 'fetch_data',
-                'messages': list(messages_serializer.data),
-                'room': room_serializer[0],
-                'room_users': users_serializer
-            }
+        try:
+            content = await get_room_data(
+                self.user, room, self.room_users[room.id], self.protocol,
+                data.get('room_version'), last_seen_message_id)
 
-            self.send_message(content)
+            if resume:
+                content.setdefault('resumed', False)
 
-        except (ValidationError, AttributeError) as e:
-            return self.send_error_message('Room matching query does not exist.')
+            await self.send_message({'room_id': room.id, **content})
 
-    def new_message(self, data):
+        except (ValidationError, NotFound):
+            return await self.send_error_message(
+                'Room matching query does not exist.', room.id)
+
+    async def fetch_before(self, data):
         """
-        Create new message
+        Fetch messages older than `message_id`, the latest if not given
         """
+        await self.fetch_history(data, before=True)
 
-        msg = data['message']
+    async def fetch_after(self, data):
+        """
+        Fetch messages newer than `message_id`
+        """
+        await self.fetch_history(data, before=False)
 
-        if msg:
+    async def fetch_history(self, data, before):
+        """
+        Stream up to `limit` messages in chunks of MESSAGE_CHUNK_SIZE, each
+        chunk is a keyset query continuing from the previous one
+        """
 
-            message = Message.objects.create(
-                user=self.user,
-                message=data['message'],
-                room=self.room)
+        room = self.get_room(data)
 
-            message_serializer = MessageSerializer(message, many=False)
+        if not room:
+            return await self.send_error_message('Room is not subscribed.')
 
-            content = {
-                'command': 'new_message',
-                'message': message_serializer.data
-            }
-            return self.send_chat_message(content)
+        # Buffered messages are broadcast without ID to continue from
+        if get_message_writer().buffered:
+            return await self.send_error_message(
+                'Message history is not available with buffered messages.',
+                room.id)
+
+        message_id = data.get('message_id')
+
+        if message_id is None and not before:
+            return await self.send_error_message(
+                'Message ID is require.', room.id)
+
+        try:
+            if message_id is not None:
+                message_id = int(message_id)
+            limit = int(data.get('limit', constants.MESSAGE_MAXIMUM))
+        except (TypeError, ValueError):
+            return await self.send_error_message(
+                'Message ID and limit must be integers.', room.id)
+
+        limit = max(1, min(limit, constants.MESSAGE_HISTORY_MAXIMUM))
+        sent = 0
+
+        while True:
+            size = min(constants.MESSAGE_CHUNK_SIZE, limit - sent)
+            messages = await get_history(room.id, message_id, size, before)
+            sent += len(messages)
+
+            if messages:
+                message_id = messages[0 if before else -1]['id']
+
+            has_more = len(messages) == size
+            done = not has_more or sent >= limit
+
+            await self.send_message({
+                'command': data['command'],
+                'room_id': room.id,
+                'messages': messages,
+                'cursor': message_id,
+                'has_more': has_more,
+                'done': done,
+            })
+
+            if done:
+                break
+
+    async def new_message(self, data):
+        """
+        Create new message
+        """
+
+        room = self.get_room(data)
+
+        if not room:
+            return await self.send_error_message('Room is not subscribed.')
+
+        msg = data.get('message')
+
+        if msg:
+            message = Message(user=self.user, room=room, message=msg)
+            writer = get_message_writer()
+
+            # Buffered messages are broadcast before they are stored
+            if writer.buffered:
+                writer.write(message)
+            else:
+                try:
+                    await write_message(writer, message)
+                except DatabaseError:
+                    logger.exception('Storing a message failed')
+                    return await self.send_error_message(
+                        'Message could not be stored.', room.id)
+
+            with SERIALIZE_SECONDS.time(operation='message'):
+                content = {
+                    'command': 'new_message',
+                    'room_id': room.id,
+                    'message': MessageProjection.from_instance(message)
+                }
+            return await self.send_chat_message(room.id, content)
         else:
-            return self.send_error_message('Message content is require.')
+            return await self.send_error_message(
+                'Message content is require.', room.id)
 
-    def send_error_message(self, message):
+    async def send_error_message(self, message, room_id=None):
         """
-        Send error message
+        Send error message to the client
         """
 
         content = {
@@ -144,50 +487,101 @@ class ChatConsumer(WebsocketConsumer):
             'message': message
         }
 
-        async_to_sync(self.channel_layer.group_send)(
-            self.room_group_name,
-            {
-                'type': 'error_message',
-                'message': content
-            }
-        )
+        if room_id is not None:
+            content['room_id'] = room_id
+
+        await self.send_message(content)
 
-    def error_message(self, event):
+    async def error_message(self, event):
         """
         Handler for error message
         """
-        message = event['message']
-        self.send(text_data=json.dumps(message))
+        await self.send_message(event['message'])
 
-    def send_message(self, message):
+    async def send_message(self, message):
         """
         Handler for message
         """
-        self.send(text_data=json.dumps(message))
+        await self.send_json(message)
 
-    def send_chat_message(self, message):
+    async def send_json(self, content, close=False):
         """
-        Send chat message
+        Encode content with the negotiated protocol and send it
         """
-        async_to_sync(self.channel_layer.group_send)(
-            self.room_group_name,
-            {
-                'type': 'chat_message',
-                'message': message
-            }
-        )
 
-    def chat_message(self, event):
+        with SERIALIZE_SECONDS.time(operation='encode'):
+            frame = self.protocol.encode(content)
+
+        await self.send_frame(frame, close=close)
+
+    async def send_frame(self, frame, close=False):
         """
-        Send message to channel
+        Send an encoded frame
         """
 
-        message = event['message']
-        self.send(text_data=json.dumps(message))
+        FRAMES_SENT.inc(protocol=self.protocol.name)
+        BYTES_SENT.inc(len(frame), protocol=self.protocol.name)
+
+        if isinstance(frame, bytes):
+            await self.send(bytes_data=frame, close=close)
+        else:
+            await self.send(text_data=frame, close=close)
+
+    async def send_chat_message(self, room_id, message):
+        """
+        Send chat message, encoded once per protocol here instead of by
+        every recipient
+        """
+
+        with SERIALIZE_SECONDS.time(operation='encode_frames'):
+            frames = encode_frames(message)
+
+        with CHANNEL_LAYER_SECONDS.time(operation='group_send'):
+            await self.channel_layer.group_send(
+                f'{CHAT_ROOM_PREFIX}{room_id}',
+                {
+                    'type': 'chat_message',
+                    'frames': frames
+                }
+            )
+
+    async def chat_message(self, event):
+        """
+        Forward the encoded message to the client
+        """
+        await self.send_frame(event['frames'][self.protocol.name])
+
+    async def room_updated(self, event):
+        """
+        Forward the update of one of user rooms to the client
+        """
+        await self.send_frame(event['frames'][self.protocol.name])
+
+    async def members_changed(self, event):
+        """
+        Leave a room user was removed from, or reload the users of the room,
+        then forward the change to the client
+        """
+
+        room_id = event['room_id']
+
+        if self.user.id in event['removed']:
+            await self.unsubscribe_room(room_id)
+        elif room_id in self.rooms:
+            rooms = await get_rooms([room_id])
+
+            if room_id in rooms:
+                self.rooms[room_id], self.room_users[room_id] = rooms[room_id]
+
+        await self.send_frame(event['frames'][self.protocol.name])
 
     # Command to send to client
     commands = {
+        'subscribe': subscribe,
+        'unsubscribe': unsubscribe,
         'fetch_data': fetch_data,
+        'fetch_before': fetch_before,
+        'fetch_after': fetch_after,
         'new_message': new_message,
         'error_message': error_message
     }
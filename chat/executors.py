@@ -0,0 +1,144 @@
+import asyncio
+import contextvars
+import functools
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from django.conf import settings
+from django.db import close_old_connections
+from chatapp.metrics import registry
+from .metrics import DB_SECONDS
+
+
+class DatabaseExecutor:
+    """
+    Dedicated thread pool for the ORM work of the async consumers, so
+    database calls do not compete with the default asgiref executor
+    """
+
+    def __init__(self, max_workers=None):
+        self._max_workers = max_workers
+        self._executor = None
+        self._lock = threading.Lock()
+
+        # Metrics
+        self.pending = 0
+        self.active = 0
+        self.max_pending = 0
+        self.submitted = 0
+        self.completed = 0
+        self.failed = 0
+
+    @property
+    def max_workers(self):
+        return self._max_workers or settings.CHAT_DB_EXECUTOR_WORKERS
+
+    @property
+    def executor(self):
+        """
+        Create the thread pool on first use
+        """
+
+        if self._executor is None:
+            with self._lock:
+                if self._executor is None:
+                    self._executor = ThreadPoolExecutor(
+                        max_workers=self.max_workers,
+                        thread_name_prefix='chat-db')
+        return self._executor
+
+    def _call(self, func, *args, **kwargs):
+        """
+        Run a database call in a worker thread and clean up old connections
+        like `channels.db.database_sync_to_async` does
+        """
+
+        with self._lock:
+            self.pending -= 1
+            self.active += 1
+
+        close_old_connections()
+        start = time.perf_counter()
+
+        try:
+            return func(*args, **kwargs)
+        except Exception:
+            with self._lock:
+                self.failed += 1
+            raise
+        finally:
+            DB_SECONDS.observe(
+                time.perf_counter() - start, operation=func.__name__)
+            close_old_connections()
+
+            with self._lock:
+                self.active -= 1
+                self.completed += 1
+
+    async def run(self, func, *args, **kwargs):
+        """
+        Run `func` in the database pool and wait for the result
+        :param func: Sync callable doing ORM work
+        """
+
+        with self._lock:
+            self.pending += 1
+            self.submitted += 1
+            self.max_pending = max(self.max_pending, self.pending)
+
+        loop = asyncio.get_event_loop()
+
+        # Run in a copy of the caller context, like asgiref does, so the
+        # query counters of the caller see the call
+        context = contextvars.copy_context()
+
+        return await loop.run_in_executor(
+            self.executor, functools.partial(
+                context.run, self._call, func, *args, **kwargs))
+
+    def metrics(self):
+        """
+        Snapshot of the pool state, `pending` is the queue depth
+        """
+
+        with self._lock:
+            return {
+                'workers': self.max_workers,
+                'pending': self.pending,
+                'active': self.active,
+                'max_pending': self.max_pending,
+                'submitted': self.submitted,
+                'completed': self.completed,
+                'failed': self.failed,
+            }
+
+    def shutdown(self, wait=True):
+        """
+        Stop the worker threads
+        """
+
+        if self._executor is not None:
+            self._executor.shutdown(wait=wait)
+            self._executor = None
+
+
+db_executor = DatabaseExecutor()
+
+registry.gauge(
+    'chat_db_executor_pending', 'Database calls waiting for a worker.',
+    function=lambda: db_executor.pending)
+registry.gauge(
+    'chat_db_executor_active', 'Database calls running.',
+    function=lambda: db_executor.active)
+
+
+def database_to_async(func):
+    """
+    Decorator running a sync ORM function through `db_executor`
+    """
+
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        return await db_executor.run(func, *args, **kwargs)
+
+    return wrapper
@@ -0,0 +1,32 @@
+import datetime
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+from chat.models import ArchivedMessage
+
+
+class Command(BaseCommand):
+    """
+    Move old messages to the archive table, in batches so the hot table
+    is never locked for long. Reads of the API and of the websocket
+    history continue in the archive transparently. Run it periodically,
+    e.g. daily from cron.
+    """
+
+    help = 'Move messages older than CHAT_MESSAGE_ARCHIVE_DAYS to the archive'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--days', type=int, default=settings.CHAT_MESSAGE_ARCHIVE_DAYS,
+            help='Archive messages older than this number of days.')
+        parser.add_argument(
+            '--batch-size', type=int, default=1000,
+            help='Number of messages moved per transaction.')
+
+    def handle(self, *args, **options):
+        before = datetime.datetime.now(tz=timezone.utc) - datetime.timedelta(
+            days=options['days'])
+
+        archived = ArchivedMessage.objects.archive(before, options['batch_size'])
+
+        self.stdout.write(f'{archived} messages archived.')
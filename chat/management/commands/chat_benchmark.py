@@ -0,0 +1,413 @@
+import asyncio
+import datetime
+import json
+import operator
+import subprocess
+import time
+import timeit
+from channels.layers import channel_layers
+from channels.layers import InMemoryChannelLayer
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.urls import path
+from django.utils import timezone
+from django.utils.module_loading import import_string
+from chat.executors import db_executor
+from chat.management.databases import throwaway_database
+from chat.models import Message, Room
+from chat.protocols import encode_frames, json_protocol
+from chat.serializers import MessageProjection, MessageSerializer
+from chatapp import constants
+from chatapp.queries import QueryCounter
+from user.models import User
+
+
+def percentiles(values):
+    """
+    p50, p95, p99 and max of values in seconds, as milliseconds
+    :param values: List of durations in seconds
+    """
+
+    if not values:
+        return {}
+
+    values = sorted(values)
+
+    def rank(percent):
+        return values[min(len(values) - 1, int(len(values) * percent / 100))]
+
+    return {
+        key: round(value * 1000, 3) for key, value in (
+            ('p50', rank(50)),
+            ('p95', rank(95)),
+            ('p99', rank(99)),
+            ('max', values[-1]),
+        )
+    }
+
+
+def flatten(results, prefix=''):
+    """
+    Flatten nested result dicts to dotted keys
+    """
+
+    flat = {}
+
+    for key, value in results.items():
+        if isinstance(value, dict):
+            flat.update(flatten(value, f'{prefix}{key}.'))
+        else:
+            flat[f'{prefix}{key}'] = value
+
+    return flat
+
+
+def git_revision():
+    """
+    Commit of the working tree, None outside a git checkout
+    """
+
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+class Command(BaseCommand):
+    """
+    Benchmark scenarios:
+        - throughput: connect websocket clients through a chat consumer,
+          send messages round robin over the rooms and report connect
+          latency, fan-out latency from send to every member receiving the
+          message, message throughput and SQL queries per connection and
+          per message. Runs against a throwaway test database and an
+          in-memory channel layer.
+        - fanout: CPU time to deliver one chat message to every member of
+          a room of ROOM_MAXIMUM_USERS and of a large group, encoding the
+          frame per recipient versus once by the sender. Messages are
+          serialized with MessageProjection like the consumer does.
+        - serialize: messages serialized per second by MessageProjection,
+          which the consumer and the message list use, from instances and
+          from values() rows, and by MessageSerializer as the baseline.
+
+    `--output` writes the results and the run options as JSON, `--compare`
+    prints them against the JSON of an earlier run, e.g. of another commit.
+    """
+
+    help = 'Benchmark the chat consumer'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--scenario', default='throughput',
+                            choices=('throughput', 'fanout', 'serialize'))
+        parser.add_argument('--connections', type=int, default=500,
+                            help='Number of users, one websocket client each.')
+        parser.add_argument('--rooms', type=int, default=50,
+                            help='Number of rooms the clients are spread on.')
+        parser.add_argument('--messages', type=int, default=500,
+                            help='Number of chat messages to send.')
+        parser.add_argument('--concurrency', type=int, default=50,
+                            help='Clients connecting at the same time.')
+        parser.add_argument('--rate', type=float, default=0,
+                            help='Messages sent per second, 0 sends as fast as possible.')
+        parser.add_argument('--consumer', default='chat.consumers.ChatConsumer',
+                            help='Dotted path of the consumer class.')
+        parser.add_argument('--group-size', type=int, default=1000,
+                            help='Members of the large group of the fanout scenario.')
+        parser.add_argument('--output',
+                            help='Write the results as JSON to this file.')
+        parser.add_argument('--compare',
+                            help='JSON results of an earlier run to compare with.')
+
+    def handle(self, *args, **options):
+        results = getattr(self, options['scenario'])(**options)
+
+        report = {
+            'scenario': options['scenario'],
+            'revision': git_revision(),
+            'date': datetime.datetime.now(tz=timezone.utc).isoformat(),
+            'vendor': connection.vendor,
+            'options': {
+                key: options[key] for key in (
+                    'connections', 'rooms', 'messages', 'concurrency', 'rate',
+                    'consumer', 'group_size')
+            },
+            'results': results,
+        }
+
+        if options['output']:
+            with open(options['output'], 'w') as output:
+                json.dump(report, output, indent=2)
+
+        if options['compare']:
+            with open(options['compare']) as baseline:
+                self.compare(json.load(baseline), report)
+        else:
+            for key, value in flatten(results).items():
+                self.stdout.write(f'{key}: {value}')
+
+    def compare(self, baseline, report):
+        """
+        Print every result next to the baseline one with the change
+        """
+
+        if baseline.get('scenario') != report['scenario']:
+            raise CommandError(
+                f'Baseline is a {baseline.get("scenario")} run, '
+                f'not {report["scenario"]}.')
+
+        self.stdout.write(
+            f'baseline: {baseline.get("revision")}, '
+            f'current: {report["revision"]}')
+
+        old = flatten(baseline['results'])
+
+        for key, value in flatten(report['results']).items():
+            if isinstance(old.get(key), (int, float)) and old[key] \
+                    and isinstance(value, (int, float)):
+                change = (value - old[key]) / old[key] * 100
+                self.stdout.write(f'{key}: {old[key]} -> {value} ({change:+.1f}%)')
+            else:
+                self.stdout.write(f'{key}: {old.get(key)} -> {value}')
+
+    def throughput(self, **options):
+
+        with throwaway_database():
+            old_layer = channel_layers.set('default', InMemoryChannelLayer())
+
+            try:
+                users, rooms = self.seed(options['connections'], options['rooms'])
+                return asyncio.get_event_loop().run_until_complete(
+                    self.run(import_string(options['consumer']), users, rooms,
+                             options['messages'], options['concurrency'],
+                             options['rate']))
+            finally:
+                channel_layers.set('default', old_layer)
+
+    def seed(self, connections, rooms):
+        """
+        Create one user per connection, spread on the rooms
+        """
+
+        User.objects.bulk_create([
+            User(username=f'bench{i}', email=f'bench{i}@bench.com')
+            for i in range(connections)
+        ])
+        users = list(User.objects.order_by('id'))
+
+        Room.objects.bulk_create([
+            Room(name=f'Room {i}', label=f'bench-room-{i}', user=users[i % len(users)])
+            for i in range(rooms)
+        ])
+        rooms = list(Room.objects.order_by('id'))
+
+        Room.users.through.objects.bulk_create([
+            Room.users.through(room_id=rooms[i % len(rooms)].id, user_id=user.id)
+            for i, user in enumerate(users)
+        ])
+
+        return users, rooms
+
+    async def run(self, consumer, users, rooms, messages, concurrency, rate):
+        """
+        Connect every user to its room then send messages round robin over
+        the rooms and wait until every member received them
+        """
+
+        if hasattr(consumer, 'as_asgi'):
+            consumer = consumer.as_asgi()
+
+        application = URLRouter([
+            path('ws/chat/<int:room>/', consumer),
+        ])
+
+        semaphore = asyncio.Semaphore(concurrency)
+        connect_latencies = []
+
+        async def connect(user, room):
+            communicator = WebsocketCommunicator(
+                application, f'/ws/chat/{room.id}/')
+            communicator.scope['user'] = user
+
+            async with semaphore:
+                start = time.perf_counter()
+                connected, _ = await communicator.connect(timeout=30)
+                connect_latencies.append(time.perf_counter() - start)
+
+            if not connected:
+                raise CommandError(f'{user} could not connect to {room}.')
+
+            return room.id, communicator
+
+        with QueryCounter(all_threads=True) as connect_queries:
+            start = time.perf_counter()
+            clients = await asyncio.gather(*[
+                connect(user, rooms[i % len(rooms)]) for i, user in enumerate(users)
+            ])
+            connect_time = time.perf_counter() - start
+
+        # Pick a sender in every room
+        senders = {}
+        members = {}
+        for room_id, communicator in clients:
+            senders.setdefault(room_id, communicator)
+            members.setdefault(room_id, []).append(communicator)
+
+        expected = {}
+        for i in range(messages):
+            room_id = rooms[i % len(rooms)].id
+            for communicator in members[room_id]:
+                expected[communicator] = expected.get(communicator, 0) + 1
+
+        sent = {}
+        fanout_latencies = []
+
+        async def drain(communicator, count):
+            while count:
+                content = json.loads(await communicator.receive_from(timeout=60))
+
+                # room_updated frames of the user inbox are not counted
+                if content.get('command') != 'new_message':
+                    continue
+
+                fanout_latencies.append(
+                    time.perf_counter() - sent[content['message']['message']])
+                count -= 1
+
+        with QueryCounter(all_threads=True) as message_queries:
+            start = time.perf_counter()
+            receivers = asyncio.gather(*[
+                drain(communicator, count) for communicator, count in expected.items()
+            ])
+
+            for i in range(messages):
+                room_id = rooms[i % len(rooms)].id
+                text = f'Message {i}'
+                sent[text] = time.perf_counter()
+                await senders[room_id].send_json_to({
+                    'command': 'new_message',
+                    'message': text,
+                })
+
+                if rate:
+                    await asyncio.sleep(
+                        max(0, start + (i + 1) / rate - time.perf_counter()))
+                else:
+                    # Let the consumers run between sends
+                    await asyncio.sleep(0)
+
+            await receivers
+            message_time = time.perf_counter() - start
+
+        for _, communicator in clients:
+            await communicator.disconnect()
+
+        return {
+            'connections': len(clients),
+            'connect_seconds': round(connect_time, 3),
+            'connections_per_second': round(len(clients) / connect_time, 1),
+            'connect_latency_ms': percentiles(connect_latencies),
+            'queries_per_connection': round(connect_queries.count / len(clients), 2),
+            'messages': messages,
+            'frames_delivered': sum(expected.values()),
+            'message_seconds': round(message_time, 3),
+            'messages_per_second': round(messages / message_time, 1),
+            'fanout_latency_ms': percentiles(fanout_latencies),
+            'queries_per_message': round(message_queries.count / messages, 2),
+            'db_executor': db_executor.metrics(),
+        }
+
+    def fanout(self, **options):
+        consumer = import_string(options['consumer'])
+        results = {}
+
+        for members in (constants.ROOM_MAXIMUM_USERS, options['group_size']):
+            per_recipient, once = asyncio.get_event_loop().run_until_complete(
+                self.run_fanout(consumer, members, options['messages']))
+
+            results[f'{members}_members_encode_per_recipient_us'] = per_recipient
+            results[f'{members}_members_encode_once_us'] = once
+
+        return results
+
+    async def run_fanout(self, consumer, members, messages):
+        """
+        CPU microseconds per message delivered to `members` consumers
+        """
+
+        async def discard(message):
+            pass
+
+        consumers = []
+        for _ in range(members):
+            instance = consumer()
+            instance.base_send = discard
+            instance.protocol = json_protocol
+            consumers.append(instance)
+
+        user = User(id=1, username='bench', first_name='Bench')
+        message = Message(id=1, user=user, room=Room(id=1), message='Benchmark',
+                          created=datetime.datetime.now(tz=timezone.utc))
+
+        def content():
+            return {
+                'command': 'new_message',
+                'message': MessageProjection.from_instance(message)
+            }
+
+        start = time.process_time()
+        for _ in range(messages):
+            event = {'type': 'chat_message', 'message': content()}
+            for instance in consumers:
+                await instance.send(text_data=json.dumps(event['message']))
+        per_recipient = time.process_time() - start
+
+        start = time.process_time()
+        for _ in range(messages):
+            event = {'type': 'chat_message', 'frames': encode_frames(content())}
+            for instance in consumers:
+                await instance.chat_message(event)
+        once = time.process_time() - start
+
+        return (round(per_recipient / messages * 1e6, 1),
+                round(once / messages * 1e6, 1))
+
+    def serialize(self, **options):
+        """
+        Serialize `messages` messages with each serializer, best of 5 runs
+        """
+
+        users = [
+            User(id=i, username=f'bench{i}', first_name='Bench', last_name=str(i))
+            for i in range(1, 11)
+        ]
+        created = datetime.datetime.now(tz=timezone.utc)
+        messages = [
+            Message(id=i, user=users[i % len(users)], room_id=1,
+                    message=f'Message {i}', created=created)
+            for i in range(options['messages'])
+        ]
+        rows = [
+            {path: operator.attrgetter(path.replace('__', '.'))(message)
+             for path in MessageProjection.paths}
+            for message in messages
+        ]
+
+        def per_second(func, items):
+            best = min(timeit.repeat(lambda: func(items), number=1, repeat=5))
+            return round(len(items) / best, 1)
+
+        serializer = per_second(
+            lambda items: MessageSerializer(items, many=True).data, messages)
+        instances = per_second(MessageProjection.from_instances, messages)
+        values = per_second(MessageProjection.from_rows, rows)
+
+        return {
+            'serializer_per_second': serializer,
+            'projection_instances_per_second': instances,
+            'projection_values_per_second': values,
+            'speedup': round(values / serializer, 1),
+        }
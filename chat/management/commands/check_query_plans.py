@@ -0,0 +1,175 @@
+import re
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from chat.management.databases import throwaway_database
+from chat.models import ArchivedMessage, Message, Room
+from chatapp import constants
+from chatapp.paginations import CompositeKeysetPagination
+from user.models import Friend, FriendEdge, User
+
+FULL_SCAN = 'full scan'
+TEMP_SORT = 'temp sort'
+
+# Plan line patterns of each problem per database vendor
+PATTERNS = {
+    'sqlite': {
+        FULL_SCAN: re.compile(r'\bSCAN\b'),
+        TEMP_SORT: re.compile(r'\bUSE TEMP B-TREE\b'),
+    },
+    'postgresql': {
+        FULL_SCAN: re.compile(r'\bSeq Scan\b'),
+        TEMP_SORT: re.compile(r'(^|->)\s*Sort\b'),
+    },
+}
+
+
+def find_problems(plan, vendor):
+    """
+    Get the plan lines showing a full scan or a temporary sort
+    :param plan: Text of EXPLAIN
+    :param vendor: Database vendor
+    :returns: List of (problem, plan line)
+    """
+
+    return [
+        (problem, line.strip())
+        for line in plan.splitlines()
+        for problem, pattern in PATTERNS[vendor].items()
+        if pattern.search(line)
+    ]
+
+
+class Command(BaseCommand):
+    """
+    Run EXPLAIN on the hot queries against a seeded database and fail when
+    one of them scans a whole table or sorts in a temporary structure. On
+    PostgreSQL sequential scans and sorts are disabled first, so a plan
+    still using them means no index can serve the query whatever the
+    table sizes. Seed data is rolled back.
+    """
+
+    help = 'Check the hot queries are served by indexes'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--current-database', action='store_true',
+            help='Check the configured database instead of a throwaway one.')
+
+    def handle(self, *args, **options):
+
+        if connection.vendor not in PATTERNS:
+            raise CommandError(
+                f'Query plans of {connection.vendor} are not supported.')
+
+        if options['current_database']:
+            failures = self.check_plans(options['verbosity'])
+        else:
+            with throwaway_database():
+                failures = self.check_plans(options['verbosity'])
+
+        if failures:
+            raise CommandError(f'{failures} queries are not served by indexes.')
+
+    def check_plans(self, verbosity):
+        """
+        Explain every hot query
+        :returns: Number of queries with problems
+        """
+
+        failures = 0
+
+        with transaction.atomic():
+
+            if connection.vendor == 'postgresql':
+                with connection.cursor() as cursor:
+                    cursor.execute('SET LOCAL enable_seqscan = off')
+                    cursor.execute('SET LOCAL enable_sort = off')
+
+            for name, queryset, allowed in self.hot_queries(*self.seed()):
+                plan = queryset.explain()
+                problems = [
+                    (problem, line)
+                    for problem, line in find_problems(plan, connection.vendor)
+                    if problem not in allowed
+                ]
+
+                if problems:
+                    failures += 1
+                    self.stdout.write(self.style.ERROR(f'FAIL {name}'))
+
+                    for problem, line in problems:
+                        self.stdout.write(f'    {problem}: {line}')
+                else:
+                    self.stdout.write(self.style.SUCCESS(f'OK   {name}'))
+
+                if verbosity > 1:
+                    self.stdout.write(plan)
+
+            transaction.set_rollback(True)
+
+        return failures
+
+    def seed(self):
+        """
+        Create users, friendship, a room and messages to explain against
+        """
+
+        user = User.objects.create_user(
+            'plan-check-1', 'plan-check-1@plan.check', 'password')
+        friend = User.objects.create_user(
+            'plan-check-2', 'plan-check-2@plan.check', 'password')
+
+        Friend.objects.create(from_user=user, to_user=friend)
+
+        room = Room.objects.create(
+            user=user, label='plan-check', name='Plan check')
+        room.users.add(user, friend)
+
+        Message.objects.bulk_create([
+            Message(room=room, user=user, message=f'Message {i}')
+            for i in range(10)
+        ])
+        message = Message.objects.filter(room=room).order_by('id')[5]
+
+        return user, friend, room, message
+
+    def hot_queries(self, user, friend, room, message):
+        """
+        List of (name, queryset, allowed problems)
+        """
+
+        keyset = CompositeKeysetPagination(('-created', '-id'))
+        keyset.reverse = False
+
+        return [
+            ('Message.objects.messages',
+             Message.objects.messages(
+                 user, room.id).hot[:constants.MESSAGE_MAXIMUM], ()),
+            ('Message.objects.messages archive',
+             Message.objects.messages(
+                 user, room.id).cold[:constants.MESSAGE_MAXIMUM], ()),
+            ('Message.objects.messages_before',
+             Message.objects.messages_before(room.id, message.id), ()),
+            ('Message.objects.messages_after',
+             Message.objects.messages_after(room.id, message.id), ()),
+            ('Message keyset page',
+             Message.objects.filter(room=room).order_by(*keyset.ordering).filter(
+                 keyset.after([message.created, message.id]))[:10], ()),
+            ('ArchivedMessage.objects.messages_before',
+             ArchivedMessage.objects.messages_before(room.id, message.id), ()),
+            ('ArchivedMessage.objects.messages_after',
+             ArchivedMessage.objects.messages_after(room.id, message.id), ()),
+
+            # Joined from the memberships of the user, so the sort is over
+            # that user's rooms only. An index would need `updated` copied to
+            # every membership, rewritten for each member on every message
+            ('Room.objects.rooms', Room.objects.rooms(user)[:10], (TEMP_SORT,)),
+
+            ('Friend.objects.friendship',
+             Friend.objects.friendship(user, friend), ()),
+            ('FriendEdge are_friends',
+             FriendEdge.objects.filter(user=user, friend=friend), ()),
+
+            ('Friend.objects.friends',
+             Friend.objects.friends(user).order_by('-id')[:10], ()),
+        ]
@@ -0,0 +1,26 @@
+import os
+import tempfile
+from contextlib import contextmanager
+from django.db import connection
+
+
+@contextmanager
+def throwaway_database():
+    """
+    Create a migrated test database for a management command and destroy
+    it afterwards
+    """
+
+    # Shared-cache in-memory SQLite locks whole tables between threads,
+    # use a temporary file instead
+    if connection.vendor == 'sqlite':
+        connection.settings_dict['TEST']['NAME'] = os.path.join(
+            tempfile.mkdtemp(), 'chat_throwaway.sqlite3')
+
+    old_name = connection.creation.create_test_db(
+        verbosity=0, autoclobber=True, serialize=False)
+
+    try:
+        yield
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0)
@@ -0,0 +1,38 @@
+from chatapp.metrics import registry
+
+COMMAND_SECONDS = registry.histogram(
+    'chat_command_seconds', 'Time to handle a websocket command.', ['command'])
+
+DB_SECONDS = registry.histogram(
+    'chat_db_seconds', 'Time of a database call in the executor.', ['operation'])
+
+SERIALIZE_SECONDS = registry.histogram(
+    'chat_serialize_seconds', 'Time to serialize, encode or decode.', ['operation'])
+
+CHANNEL_LAYER_SECONDS = registry.histogram(
+    'chat_channel_layer_seconds', 'Time of a channel layer call.', ['operation'])
+
+FRAMES_RECEIVED = registry.counter(
+    'chat_frames_received_total', 'Websocket frames received.', ['protocol'])
+
+FRAMES_SENT = registry.counter(
+    'chat_frames_sent_total', 'Websocket frames sent.', ['protocol'])
+
+# Text frames count characters, bytes for the ASCII JSON the server sends
+BYTES_RECEIVED = registry.counter(
+    'chat_received_bytes_total', 'Size of the websocket frames received.',
+    ['protocol'])
+
+BYTES_SENT = registry.counter(
+    'chat_sent_bytes_total', 'Size of the websocket frames sent.', ['protocol'])
+
+CONNECTIONS = registry.gauge(
+    'chat_connections', 'Open websocket connections.')
+
+ROOM_CONNECTIONS = registry.gauge(
+    'chat_room_connections', 'Open websocket connections subscribed to a room.',
+    ['room'])
+
+MESSAGES_DROPPED = registry.counter(
+    'chat_messages_dropped_total',
+    'Buffered messages dropped because they could not be stored.')
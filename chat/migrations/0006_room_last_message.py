@@ -0,0 +1,43 @@
+# Generated by Django 2.2.28 on 2026-10-18 08:49
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def set_last_messages(apps, schema_editor):
+    """
+    Point every room to its newest message
+    """
+
+    Room = apps.get_model('chat', 'Room')
+    Message = apps.get_model('chat', 'Message')
+
+    for room_id in Room.objects.values_list('id', flat=True):
+        message = Message.objects.filter(room_id=room_id).order_by('-id').first()
+
+        if message:
+            Room.objects.filter(pk=room_id).update(
+                last_message=message.id, last_sender=message.user_id)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('chat', '0005_room_updated_message_room_created_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='room',
+            name='last_message',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='chat.Message'),
+        ),
+        migrations.AddField(
+            model_name='room',
+            name='last_sender',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.RunPython(set_last_messages, migrations.RunPython.noop),
+    ]
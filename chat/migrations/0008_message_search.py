@@ -0,0 +1,78 @@
+from django.db import migrations
+
+TABLES = ('chat_message', 'chat_archivedmessage')
+
+POSTGRES_VECTOR = "to_tsvector('simple', subject || ' ' || message)"
+
+
+def sqlite_statements(table):
+    """
+    FTS5 index of a message table, external content kept in sync by
+    triggers
+    """
+
+    fts = f'{table}_fts'
+
+    return (
+        f"CREATE VIRTUAL TABLE {fts} USING fts5(message, subject, "
+        f"content='{table}', content_rowid='id', "
+        f"tokenize='unicode61 remove_diacritics 2')",
+
+        f"CREATE TRIGGER {fts}_insert AFTER INSERT ON {table} BEGIN "
+        f"INSERT INTO {fts}(rowid, message, subject) "
+        f"VALUES (new.id, new.message, new.subject); END",
+
+        f"CREATE TRIGGER {fts}_delete AFTER DELETE ON {table} BEGIN "
+        f"INSERT INTO {fts}({fts}, rowid, message, subject) "
+        f"VALUES ('delete', old.id, old.message, old.subject); END",
+
+        f"CREATE TRIGGER {fts}_update AFTER UPDATE OF message, subject "
+        f"ON {table} BEGIN "
+        f"INSERT INTO {fts}({fts}, rowid, message, subject) "
+        f"VALUES ('delete', old.id, old.message, old.subject); "
+        f"INSERT INTO {fts}(rowid, message, subject) "
+        f"VALUES (new.id, new.message, new.subject); END",
+
+        # Index the existing messages
+        f"INSERT INTO {fts}({fts}) VALUES ('rebuild')",
+    )
+
+
+def create_search_index(apps, schema_editor):
+    vendor = schema_editor.connection.vendor
+
+    for table in TABLES:
+        if vendor == 'sqlite':
+            for sql in sqlite_statements(table):
+                schema_editor.execute(sql)
+
+        elif vendor == 'postgresql':
+            schema_editor.execute(
+                f'CREATE INDEX {table}_search_idx ON {table} '
+                f'USING GIN ({POSTGRES_VECTOR})')
+
+
+def drop_search_index(apps, schema_editor):
+    vendor = schema_editor.connection.vendor
+
+    for table in TABLES:
+        if vendor == 'sqlite':
+            for trigger in ('insert', 'delete', 'update'):
+                schema_editor.execute(
+                    f'DROP TRIGGER IF EXISTS {table}_fts_{trigger}')
+
+            schema_editor.execute(f'DROP TABLE IF EXISTS {table}_fts')
+
+        elif vendor == 'postgresql':
+            schema_editor.execute(f'DROP INDEX IF EXISTS {table}_search_idx')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0007_archivedmessage'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_index, drop_search_index),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 2.2.28 on 2026-10-18 09:21
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0008_message_search'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='room',
+            name='modified',
+            field=models.DateTimeField(auto_now=True),
+        ),
+    ]
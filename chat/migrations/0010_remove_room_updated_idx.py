@@ -0,0 +1,17 @@
+# Generated by Django 2.2.28 on 2026-10-18 10:05
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0009_room_modified'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='room',
+            name='chat_room_updated_idx',
+        ),
+    ]
@@ -1,10 +1,13 @@
-from django.db import models
-import datetime
+from django.db import models, transaction
+from django.db.models.signals import post_init, post_save
+from django.db.models import Count, Max, Prefetch, Q, Sum
 from django.utils import timezone
 from rest_framework.exceptions import ValidationError, NotFound
 from django.shortcuts import get_object_or_404
 from user.models import User, Friend
 from chatapp import constants
+from .querysets import ChainedQuerySet
+from .signals import latest_message_updated, room_members_changed
 
 
 class RoomManager(models.Manager):
@@ -24,76 +27,200 @@ class RoomManager(models.Manager):
 
     def rooms(self, user):
         """
-        Get the rooms user created or joined
+        Get the rooms user created or joined, with their creator and members
+        and the profiles of all of them, in one query for the rooms and one
+        for the members whatever their number
         """
 
-        return Room.objects.filter(users__id__exact=user.id).order_by('-updated')
+        return Room.objects.filter(users__id__exact=user.id).select_related(
+            'user__profile').prefetch_related(Prefetch(
+                'users', queryset=User.objects.select_related('profile'))
+        ).order_by('-updated')
 
 
+    def clean_user_ids(self, users, message):
+        """
+        Check a list of user ID from a request
+        :param users: List of user ID
+        :param message: Error message when users is not a list or is empty
+        :returns: List of user ID without duplicates, in order
+        """
+
+        if not isinstance(users, (list,)) or not len(users):
+            raise ValidationError(message)
+
+        try:
+            return list(dict.fromkeys(int(user) for user in users))
+        except (TypeError, ValueError):
+            raise ValidationError('Users must a list of user ID.')
+
+    def check_size(self, count):
+        """
+        Check a room of `count` members has at most ROOM_MAXIMUM_USERS
+        """
+
+        if count > constants.ROOM_MAXIMUM_USERS:
+            raise ValidationError(
+                f'Maximum {constants.ROOM_MAXIMUM_USERS} users in a room.')
+
+    def lock_members(self, room):
+        """
+        Stamp a room modified, which locks it until the end of the
+        transaction, so concurrent membership changes of that room run one
+        after the other
+        :returns: Set of member ID
+        """
+
+        self.touch(room.id)
+        return set(Room.users.through.objects.filter(
+            room=room).values_list('user_id', flat=True))
+
     def add_users(self, request_user, room_id, users):
         """
-        Add new users to existed room
+        Add new users to existed room. Every user is checked before one
+        bulk insert of the memberships, so either all of them are added or
+        none is
         :param request_user: User logged in request
         :param room_id: Room ID
         :param users: List of user ID added to room
         """
 
-        if not isinstance(users, (list,)) or not len(users):
-            raise ValidationError('New users must a list and not empty.')
-
+        user_ids = self.clean_user_ids(
+            users, 'New users must a list and not empty.')
         room = Room.objects.get_room(room_id)
-        room_users = room.users.all()
 
-        for new_user in users:
+        # Check users are existed
+        existed = set(User.objects.filter(
+            pk__in=user_ids).values_list('id', flat=True))
 
-            # Check max users in a room
-            if len(room_users) >= constants.ROOM_MAXIMUM_USERS:
-                raise ValidationError(
-                    f'Maximum {constants.ROOM_MAXIMUM_USERS} users in a room.')
+        if len(existed) < len(user_ids):
+            raise NotFound('User matching query does not exist.')
 
-            new_user = User.objects.get_user(new_user)
+        # Check users are friends of request user
+        friends = Friend.objects.friends_among(request_user, user_ids)
 
-            # Check user is not friendship
-            if not Friend.objects.are_friends(request_user, new_user) \
-                and request_user != new_user:
-                raise ValidationError(
-                    f'You do not add user is not your friend.')
+        if any(user_id not in friends and user_id != request_user.id
+               for user_id in user_ids):
+            raise ValidationError(
+                'You do not add user is not your friend.')
+
+        with transaction.atomic():
+            member_ids = self.lock_members(room)
 
             # Check user is existed
-            if new_user in room_users:
+            if member_ids.intersection(user_ids):
                 raise ValidationError(
                     'You do not add user is existed in this room.')
 
-            room.users.add(new_user)
+            self.check_size(len(member_ids) + len(user_ids))
+
+            Room.users.through.objects.bulk_create([
+                Room.users.through(room_id=room.id, user_id=user_id)
+                for user_id in user_ids
+            ])
+
+            room_members_changed.send(
+                sender=Room, room_id=room.id, added=user_ids, removed=[])
 
         return room
 
     def remove_users(self, room_id, users):
         """
-        Remove users from existed room
+        Remove users from existed room with one bulk delete, either all of
+        them or none
         :param room_id: Room ID
         :param users: List of user ID removed from room
         """
-        if not isinstance(users, (list,)) or not len(users):
-            raise ValidationError('Users must a list and not empty.')
 
-        room = Room.objects.get(pk=room_id)
-        room_users = room.users.all()
+        user_ids = self.clean_user_ids(
+            users, 'Users must a list and not empty.')
+        room = Room.objects.get_room(room_id)
+
+        # Check users are existed
+        existed = set(User.objects.filter(
+            pk__in=user_ids).values_list('id', flat=True))
 
-        for user in users:
+        if len(existed) < len(user_ids):
+            raise NotFound('User matching query does not exist.')
 
-            # Check user is existed or not
-            user = User.objects.get_user(user)
+        with transaction.atomic():
+            member_ids = self.lock_members(room)
 
             # Check user does not exist in the room
-            if user not in room_users:
+            if not member_ids.issuperset(user_ids):
                 raise ValidationError(
                     'You do not remove user does not exist from this room.')
 
-            room.users.remove(user)
+            Room.users.through.objects.filter(
+                room=room, user_id__in=user_ids).delete()
+
+            room_members_changed.send(
+                sender=Room, room_id=room.id, added=[], removed=user_ids)
 
         return room
 
+    def touch(self, room_id):
+        """
+        Stamp a room modified, for the validators of conditional requests
+        """
+        Room.objects.filter(pk=room_id).update(modified=timezone.now())
+
+    def touch_sender_rooms(self, user):
+        """
+        Stamp modified the rooms showing the name of a user: the rooms of
+        its messages, archived or not, also after it left them, and the
+        rooms it created
+        """
+
+        Room.objects.filter(
+            Q(user=user)
+            | Q(pk__in=Message.objects.filter(user=user).values('room'))
+            | Q(pk__in=ArchivedMessage.objects.filter(user=user).values('room'))
+        ).update(modified=timezone.now())
+
+    def rooms_validator(self, user):
+        """
+        Values the room list of a user depends on, the rooms, their members
+        and the members' profiles, with one aggregate query over the
+        memberships of its rooms
+        :returns: List of values
+        """
+
+        stamps = Room.users.through.objects.filter(
+            room__in=Room.users.through.objects.filter(user=user).values('room')
+        ).aggregate(
+            memberships=Count('id'),
+            latest_membership=Max('id'),
+            last_messages=Sum('room__last_message'),
+            updated=Max('room__updated'),
+            modified=Max('room__modified'),
+            user_modified=Max('user__modified'),
+            profile_modified=Max('user__profile__modified'),
+        )
+
+        return sorted(stamps.items())
+
+    def messages_validator(self, user, room_id):
+        """
+        Values the messages of a room and their senders depend on, with one
+        query
+        :returns: List of values or None if user is not member of the room
+        """
+
+        try:
+            room_id = int(room_id)
+        except (TypeError, ValueError):
+            return None
+
+        # Renamed senders stamp their rooms modified
+        stamps = Room.objects.filter(pk=room_id, users=user).values_list(
+            'last_message', 'updated', 'modified').first()
+
+        if stamps is None:
+            return None
+
+        return [room_id, *stamps]
+
     def is_member(self, room, user):
         """
         Check is member in the room
@@ -107,17 +234,45 @@ class RoomManager(models.Manager):
 
         return user in room.users.all()
 
-    def set_latest_message(self, room, message):
+    def set_latest_message(self, message):
         """
-        Set latest message to a room
-        :param room: Room instance
-        :param message: Message text
+        Point a room to a stored message with one conditional UPDATE. A
+        room already pointing to a newer message, by date then by id, is
+        left as is, so concurrent senders never move it backwards
+        :param message: Saved Message instance
+        :returns: True if the room was updated
         """
 
-        room = Room.objects.get_room(room.id)
-        room.latest_message = message
-        room.updated = datetime.datetime.now(tz=timezone.utc)
-        room.save()
+        newer = Q(updated__lt=message.created) | Q(updated=message.created) & (
+            Q(last_message__isnull=True) | Q(last_message_id__lt=message.id))
+
+        updated = Room.objects.filter(newer, pk=message.room_id).update(
+            latest_message=message.message,
+            last_message=message.id,
+            last_sender=message.user_id,
+            updated=message.created)
+
+        if updated:
+            latest_message_updated.send(
+                sender=Room, room_id=message.room_id, message=message.message,
+                updated=message.created)
+
+        return bool(updated)
+
+    def set_latest_messages(self, messages):
+        """
+        Set latest messages to their rooms with one UPDATE per room
+        :param messages: Stored Message instances with their ids, oldest
+            first
+        """
+
+        latest = {}
+
+        for message in messages:
+            latest[message.room_id] = message
+
+        for message in latest.values():
+            self.set_latest_message(message)
 
 
 class MessageManager(models.Manager):
@@ -127,7 +282,7 @@ class MessageManager(models.Manager):
 
     def messages(self, user, room_id):
         """
-        Get last messages
+        Get last messages, the archived ones after the others
         :param user: User requested
         :param room_id: Id of room
         """
@@ -139,7 +294,128 @@ class MessageManager(models.Manager):
             raise ValidationError(
                 'You do not get messages from the room you are not joined.')
 
-        return Message.objects.select_related().filter(room=room).order_by('-created')
+        return ChainedQuerySet(
+            Message.objects.select_related().filter(room=room).order_by('-created'),
+            ArchivedMessage.objects.select_related().filter(
+                room=room).order_by('-created'))
+
+    def messages_before(self, room_id, message_id=None,
+                        limit=constants.MESSAGE_CHUNK_SIZE):
+        """
+        Get messages older than a message, newest first. Served by the
+        (room, id) index so the cost does not depend on the depth
+        :param room_id: Id of room
+        :param message_id: Id of message, the latest messages if None
+        :param limit: Maximum number of messages
+        """
+
+        queryset = Message.objects.select_related('user').filter(room_id=room_id)
+
+        if message_id is not None:
+            queryset = queryset.filter(id__lt=message_id)
+
+        return queryset.order_by('-id')[:limit]
+
+    def messages_after(self, room_id, message_id,
+                       limit=constants.MESSAGE_CHUNK_SIZE):
+        """
+        Get messages newer than a message, oldest first
+        :param room_id: Id of room
+        :param message_id: Id of message
+        :param limit: Maximum number of messages
+        """
+
+        return Message.objects.select_related('user').filter(
+            room_id=room_id, id__gt=message_id).order_by('id')[:limit]
+
+    def history_before(self, room_id, message_id=None,
+                       limit=constants.MESSAGE_CHUNK_SIZE):
+        """
+        Like `messages_before`, continued in the archive when the hot
+        table has fewer than `limit` older messages
+        :returns: List of messages, newest first
+        """
+
+        messages = list(self.messages_before(room_id, message_id, limit))
+
+        if len(messages) < limit:
+            messages += ArchivedMessage.objects.messages_before(
+                room_id, message_id, limit)
+            messages = sorted(messages, key=lambda message: -message.id)[:limit]
+
+        return messages
+
+    def history_after(self, room_id, message_id,
+                      limit=constants.MESSAGE_CHUNK_SIZE):
+        """
+        Like `messages_after`, including the archive. Archived messages
+        are older than the hot ones of their room, so the archive lookup is
+        an empty index range unless `message_id` is archived too
+        :returns: List of messages, oldest first
+        """
+
+        messages = list(ArchivedMessage.objects.messages_after(
+            room_id, message_id, limit))
+        messages += self.messages_after(room_id, message_id, limit)
+
+        return sorted(messages, key=lambda message: message.id)[:limit]
+
+
+class ArchivedMessageManager(models.Manager):
+    """
+    Archived message manager
+    """
+
+    def messages_before(self, room_id, message_id=None,
+                        limit=constants.MESSAGE_CHUNK_SIZE):
+        """
+        Get archived messages older than a message, newest first
+        """
+
+        queryset = self.select_related('user').filter(room_id=room_id)
+
+        if message_id is not None:
+            queryset = queryset.filter(id__lt=message_id)
+
+        return queryset.order_by('-id')[:limit]
+
+    def messages_after(self, room_id, message_id,
+                       limit=constants.MESSAGE_CHUNK_SIZE):
+        """
+        Get archived messages newer than a message, oldest first
+        """
+
+        return self.select_related('user').filter(
+            room_id=room_id, id__gt=message_id).order_by('id')[:limit]
+
+    def archive(self, before, batch_size=1000):
+        """
+        Move messages created before a date to the archive, keeping their
+        ids. Messages rooms point to as their latest stay.
+        :param before: Datetime
+        :param batch_size: Number of messages moved per transaction
+        :returns: Number of archived messages
+        """
+
+        fields = [field.attname for field in ArchivedMessage._meta.concrete_fields]
+        archived = 0
+
+        while True:
+            with transaction.atomic():
+                batch = list(Message.objects.filter(created__lt=before).exclude(
+                    id__in=Room.objects.filter(
+                        last_message__isnull=False).values('last_message'),
+                ).order_by('id').values(*fields)[:batch_size])
+
+                if not batch:
+                    return archived
+
+                ArchivedMessage.objects.bulk_create(
+                    [ArchivedMessage(**values) for values in batch])
+                Message.objects.filter(
+                    id__in=[values['id'] for values in batch]).delete()
+
+            archived += len(batch)
 
 
 class Room(models.Model):
@@ -154,7 +430,14 @@ class Room(models.Model):
     users = models.ManyToManyField(User, related_name='room_users', default=user)
     created = models.DateTimeField(auto_now_add=True, editable=False)
     updated = models.DateTimeField(auto_now_add=True, editable=True)
+    modified = models.DateTimeField(auto_now=True)
     latest_message = models.TextField(blank=True)
+    last_message = models.ForeignKey(
+        'Message', on_delete=models.SET_NULL, null=True, blank=True,
+        related_name='+')
+    last_sender = models.ForeignKey(
+        User, on_delete=models.SET_NULL, null=True, blank=True,
+        related_name='+')
     photo = models.ImageField(blank=True)
 
     objects = RoomManager()
@@ -166,7 +449,23 @@ class Room(models.Model):
         return self.name
 
 
-class Message(models.Model):
+class BaseMessage(models.Model):
+    """
+    Fields of the hot and the archived messages
+    """
+
+    subject = models.CharField(max_length=1000, blank=True)
+    message = models.TextField()
+    created = models.DateTimeField(auto_now_add=True, editable=False)
+
+    class Meta:
+        abstract = True
+
+    def __str__(self):
+        return f'Message from {self.user}'
+
+
+class Message(BaseMessage):
     """
     Message model
     """
@@ -174,18 +473,71 @@ class Message(models.Model):
     room = models.ForeignKey(Room, on_delete=models.CASCADE)
     user = models.ForeignKey(
         User, on_delete=models.CASCADE, related_name='message_sender')
-    subject = models.CharField(max_length=1000, blank=True)
-    message = models.TextField()
-    created = models.DateTimeField(auto_now_add=True, editable=False)
 
     objects = MessageManager()
 
     class Meta:
         ordering = ('-id',)
-
-    def __str__(self):
-        return f'Message from {self.user}'
+        indexes = [
+            models.Index(fields=['room', 'id'], name='chat_message_room_id_idx'),
+            models.Index(fields=['room', 'created'],
+                         name='chat_message_room_created_idx'),
+        ]
 
     def save(self, *args, **kwargs):
-        Room.objects.set_latest_message(self.room, self.message)
-        super(Message, self).save(*args, **kwargs)
+        adding = self._state.adding
+
+        with transaction.atomic():
+            super(Message, self).save(*args, **kwargs)
+
+            if adding:
+                Room.objects.set_latest_message(self)
+
+
+class ArchivedMessage(BaseMessage):
+    """
+    Message moved out of the hot table by the `archive_messages` command
+    """
+
+    id = models.IntegerField(primary_key=True)
+    room = models.ForeignKey(Room, on_delete=models.CASCADE, related_name='+')
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='+')
+
+    # Keeps the date of the message
+    created = models.DateTimeField(editable=False)
+
+    objects = ArchivedMessageManager()
+
+    class Meta:
+        ordering = ('-id',)
+        indexes = [
+            models.Index(fields=['room', 'id'],
+                         name='chat_archive_room_id_idx'),
+            models.Index(fields=['room', 'created'],
+                         name='chat_archive_room_created_idx'),
+        ]
+
+
+# Message pages show the names of the senders, their rooms change with them
+SENDER_FIELDS = ('username', 'first_name', 'last_name')
+
+
+def sender_names(user):
+    # Deferred fields are not loaded
+    return [user.__dict__.get(field) for field in SENDER_FIELDS]
+
+
+def remember_sender_names(sender, instance, **kwargs):
+    instance._sender_names = sender_names(instance)
+
+
+def touch_sender_rooms(sender, instance, created, **kwargs):
+    names = sender_names(instance)
+
+    if not created and names != instance._sender_names:
+        Room.objects.touch_sender_rooms(instance)
+
+    instance._sender_names = names
+
+post_init.connect(remember_sender_names, sender=User)
+post_save.connect(touch_sender_rooms, sender=User)
@@ -0,0 +1,126 @@
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.db import transaction
+from django.dispatch import receiver
+from rest_framework.fields import DateTimeField
+from chatapp import constants
+from .batching import BackgroundBatcher
+from .models import Room
+from .protocols import encode_frames
+from .signals import latest_message_updated, room_members_changed
+
+
+class RoomUpdateNotifier:
+    """
+    Push `room_updated` events to the personal group of every member of a
+    room when its latest message changes. Updates are coalesced per room,
+    a burst of messages yields one push per interval.
+    """
+
+    def __init__(self, interval, batch_size=1000):
+        """
+        :param interval: Milliseconds between pushes
+        :param batch_size: Number of pending updates triggering a push
+        """
+
+        # Nobody is left to push to when the process exits, and the
+        # channel layer can no longer run its event loop by then
+        self.batcher = BackgroundBatcher(
+            self.send_updates, interval, batch_size,
+            name='chat-room-notifier', flush_on_exit=False)
+
+    def room_updated(self, room_id, message, updated):
+        """
+        Queue an update of a room
+        """
+        self.batcher.add((room_id, message, updated))
+
+    def flush(self):
+        return self.batcher.flush()
+
+    def send_updates(self, updates):
+        """
+        Send the latest update of each room to its members
+        """
+
+        channel_layer = get_channel_layer()
+
+        if channel_layer is None:
+            return
+
+        latest = {}
+
+        for room_id, message, updated in updates:
+            latest[room_id] = (message, updated)
+
+        frames = {
+            room_id: encode_frames({
+                'command': 'room_updated',
+                'room_id': room_id,
+                'latest_message': message[:constants.ROOM_PREVIEW_LENGTH],
+                'updated': DateTimeField().to_representation(updated),
+            })
+            for room_id, (message, updated) in latest.items()
+        }
+
+        members = Room.users.through.objects.filter(
+            room_id__in=latest).values_list('room_id', 'user_id')
+
+        for room_id, user_id in members:
+            async_to_sync(channel_layer.group_send)(
+                f'{constants.CHAT_USER_PREFIX}{user_id}',
+                {
+                    'type': 'room_updated',
+                    'frames': frames[room_id]
+                }
+            )
+
+
+room_notifier = RoomUpdateNotifier(settings.CHAT_ROOM_UPDATE_INTERVAL)
+
+
+@receiver(latest_message_updated)
+def notify_room_updated(sender, room_id, message, updated, **kwargs):
+    """
+    Queue the update once the transaction is committed
+    """
+
+    transaction.on_commit(
+        lambda: room_notifier.room_updated(room_id, message, updated))
+
+
+def send_members_changed(room_id, added, removed):
+    """
+    Send one `members_changed` event to the connections of a room
+    """
+
+    channel_layer = get_channel_layer()
+
+    if channel_layer is None:
+        return
+
+    async_to_sync(channel_layer.group_send)(
+        f'{constants.CHAT_ROOM_PREFIX}{room_id}',
+        {
+            'type': 'members_changed',
+            'room_id': room_id,
+            'removed': removed,
+            'frames': encode_frames({
+                'command': 'members_changed',
+                'room_id': room_id,
+                'added': added,
+                'removed': removed,
+            }),
+        }
+    )
+
+
+@receiver(room_members_changed)
+def notify_members_changed(sender, room_id, added, removed, **kwargs):
+    """
+    Send the change once the transaction is committed
+    """
+
+    transaction.on_commit(
+        lambda: send_members_changed(room_id, added, removed))
@@ -0,0 +1,181 @@
+import json
+import zlib
+from django.core import serializers
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+def json_serialize(data):
+    """
+    Serializer data to json
+    """
+    return json.loads(serializers.serialize('json', data))
+
+
+class JsonProtocol:
+    """
+    Default protocol, JSON text frames with full keys
+    """
+
+    name = 'json'
+    subprotocol = None
+
+    def encode(self, content):
+        """
+        Encode content to a frame
+        """
+        return json.dumps(content)
+
+    def decode(self, text_data=None, bytes_data=None):
+        """
+        Decode a frame to content
+        """
+
+        if not text_data:
+            raise ValueError('No text section for incoming WebSocket frame!')
+
+        return json.loads(text_data)
+
+    def room_data(self, room, room_users, version=None):
+        """
+        Room fields of the `fetch_data` command
+        :param room: Room instance
+        :param room_users: Users of the room
+        :param version: Room version known by the client, unused
+        """
+
+        return {
+            'room': json_serialize([room, ])[0],
+            'room_users': json_serialize(room_users)
+        }
+
+
+class CompactProtocol(JsonProtocol):
+    """
+    msgpack binary frames with short keys. `fetch_data` sends a small room
+    dict plus its version, and leaves the room out when the client already
+    has that version.
+    """
+
+    name = 'msgpack'
+    subprotocol = 'chat.msgpack.v1'
+
+    keys = {
+        'command': 'c',
+        'message': 'm',
+        'messages': 'ms',
+        'message_id': 'mi',
+        'room': 'r',
+        'room_users': 'ru',
+        'room_version': 'rv',
+        'room_id': 'ri',
+        'rooms': 'rs',
+        'latest_message': 'lm',
+        'updated': 'up',
+        'last_seen_message_id': 'ls',
+        'resumed': 'rd',
+        'user': 'u',
+        'id': 'i',
+        'name': 'n',
+        'photo': 'p',
+        'username': 'un',
+        'full_name': 'fn',
+        'created': 't',
+        'limit': 'l',
+        'cursor': 'cr',
+        'has_more': 'hm',
+        'done': 'd',
+        'added': 'a',
+        'removed': 'rm',
+    }
+    full_keys = {value: key for key, value in keys.items()}
+
+    def encode(self, content):
+        return msgpack.packb(self.rename(content, self.keys), use_bin_type=True)
+
+    def decode(self, text_data=None, bytes_data=None):
+
+        if not bytes_data:
+            raise ValueError('No bytes section for incoming WebSocket frame!')
+
+        return self.rename(msgpack.unpackb(bytes_data, raw=False), self.full_keys)
+
+    def rename(self, content, keys):
+        """
+        Rename the keys of nested dicts
+        """
+
+        if isinstance(content, dict):
+            return {
+                keys.get(key, key): self.rename(value, keys)
+                for key, value in content.items()
+            }
+
+        if isinstance(content, list):
+            return [self.rename(value, keys) for value in content]
+
+        return content
+
+    def room_data(self, room, room_users, version=None):
+        room_data = {
+            'id': room.id,
+            'name': room.name,
+            'photo': room.photo.name,
+            'room_users': [{
+                'id': user.id,
+                'username': user.username,
+                'full_name': user.full_name,
+            } for user in room_users],
+        }
+
+        room_version = format(zlib.crc32(
+            json.dumps(room_data, sort_keys=True).encode()), 'x')
+
+        if room_version == version:
+            return {'room_version': room_version}
+
+        room_users = room_data.pop('room_users')
+
+        return {
+            'room': room_data,
+            'room_users': room_users,
+            'room_version': room_version,
+        }
+
+
+json_protocol = JsonProtocol()
+
+# Supported subprotocols
+protocols = {}
+
+if msgpack is not None:
+    protocols[CompactProtocol.subprotocol] = CompactProtocol()
+
+
+def negotiate(subprotocols):
+    """
+    Pick the protocol of the first supported subprotocol the client offers
+    :param subprotocols: Subprotocols of the connection scope
+    """
+
+    for subprotocol in subprotocols or []:
+        if subprotocol in protocols:
+            return protocols[subprotocol]
+
+    return json_protocol
+
+
+def encode_frames(content):
+    """
+    Encode content once for every protocol, keyed by protocol name
+    """
+
+    frames = {json_protocol.name: json_protocol.encode(content)}
+
+    for protocol in protocols.values():
+        frames[protocol.name] = protocol.encode(content)
+
+    return frames
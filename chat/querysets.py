@@ -0,0 +1,120 @@
+class ChainedQuerySet:
+    """
+    Read-only concatenation of a hot and a cold queryset with the same
+    ordering, every row of `hot` coming before every row of `cold`. Slices
+    only query `cold` once they go past the end of `hot`. Supports what
+    the filters and the paginators of the API use.
+    """
+
+    def __init__(self, hot, cold):
+        self.hot = hot
+        self.cold = cold
+        self._hot_count = None
+        self._cold_count = None
+
+    @property
+    def model(self):
+        return self.hot.model
+
+    @property
+    def ordered(self):
+        return self.hot.ordered
+
+    def _chain(self, method, *args, **kwargs):
+        return ChainedQuerySet(getattr(self.hot, method)(*args, **kwargs),
+                               getattr(self.cold, method)(*args, **kwargs))
+
+    def filter(self, *args, **kwargs):
+        return self._chain('filter', *args, **kwargs)
+
+    def exclude(self, *args, **kwargs):
+        return self._chain('exclude', *args, **kwargs)
+
+    def distinct(self, *fields):
+        return self._chain('distinct', *fields)
+
+    def values(self, *fields):
+        return self._chain('values', *fields)
+
+    def order_by(self, *fields):
+        """
+        Order both querysets, the ordering must keep every row of `hot`
+        before every row of `cold`
+        """
+        return self._chain('order_by', *fields)
+
+    def reverse(self):
+        """
+        Reverse the ordering, the cold rows then come first
+        """
+        return ChainedQuerySet(self.cold.reverse(), self.hot.reverse())
+
+    def hot_count(self):
+        if self._hot_count is None:
+            self._hot_count = self.hot.count()
+        return self._hot_count
+
+    def count(self):
+        if self._cold_count is None:
+            self._cold_count = self.cold.count()
+        return self.hot_count() + self._cold_count
+
+    def bounded_count(self, limit):
+        """
+        Count up to `limit` rows, the cold ones only if needed
+        """
+
+        count = self.hot[:limit].count()
+
+        if count < limit:
+            count += self.cold[:limit - count].count()
+
+        return count
+
+    def estimate_count(self):
+        """
+        Estimate of both querysets, None if one has no statistics
+        """
+
+        from chatapp.paginations import estimate_count
+
+        hot, cold = estimate_count(self.hot), estimate_count(self.cold)
+        return None if hot is None or cold is None else hot + cold
+
+    def __len__(self):
+        return self.count()
+
+    def __iter__(self):
+        yield from self.hot
+        yield from self.cold
+
+    def __getitem__(self, key):
+
+        if isinstance(key, int):
+            items = self[key:key + 1]
+
+            if not items:
+                raise IndexError('ChainedQuerySet index out of range')
+
+            return items[0]
+
+        if key.step is not None or (key.start or 0) < 0 \
+                or (key.stop is not None and key.stop < 0):
+            raise ValueError('ChainedQuerySet supports positive slices only.')
+
+        start = key.start or 0
+        stop = key.stop
+
+        items = list(self.hot[start:stop])
+
+        # Filled from the hot rows, or nothing is archived
+        if stop is not None and len(items) == stop - start \
+                or self._cold_count == 0:
+            return items
+
+        # Went past the end of the hot rows
+        hot_count = start + len(items) if items else self.hot_count()
+        cold_start = max(0, start - hot_count)
+        cold_stop = None if stop is None else stop - hot_count
+
+        return items + list(self.cold[cold_start:cold_stop])
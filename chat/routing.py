@@ -4,6 +4,7 @@ from django.urls import path
 from . import consumers
 
 websocket_urlpatterns = [
+    path('ws/chat/', consumers.ChatConsumer),
     path('ws/chat/<int:room>/', consumers.ChatConsumer),
 ]
 
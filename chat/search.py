@@ -0,0 +1,195 @@
+import base64
+import binascii
+import html
+import json
+import re
+from django.db import connection
+from rest_framework.exceptions import ValidationError
+from chatapp import constants
+from .models import ArchivedMessage, Message, Room
+
+# Tables holding messages, full text indexed by migration 0008
+TABLES = (Message._meta.db_table, ArchivedMessage._meta.db_table)
+
+# Private use characters around the matches of a snippet, replaced by
+# <mark> tags once the snippet is HTML escaped
+START, STOP = '\ue000', '\ue001'
+
+# Expression of the GIN index of migration 0008, the search queries must
+# repeat it exactly
+POSTGRES_VECTOR = "to_tsvector('simple', subject || ' ' || message)"
+
+
+def encode_cursor(rank, message_id):
+    return base64.urlsafe_b64encode(
+        json.dumps([rank, message_id]).encode()).decode()
+
+
+def decode_cursor(cursor):
+    """
+    :returns: (rank, message ID)
+    """
+
+    try:
+        rank, message_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        return float(rank), int(message_id)
+    except (binascii.Error, ValueError, TypeError):
+        raise ValidationError('Cursor is invalid.')
+
+
+def highlight(snippet):
+    """
+    HTML escape a snippet and mark its matches
+    """
+
+    return html.escape(snippet).replace(START, '<mark>').replace(STOP, '</mark>')
+
+
+class SqliteSearch:
+    """
+    FTS5 search, bm25 rank where lower is better
+    """
+
+    def match(self, terms):
+        # Quoted terms are literal, the last one is a prefix while typing
+        return ' '.join(f'"{term}"' for term in terms) + '*'
+
+    def ranked(self, table):
+        fts = f'{table}_fts'
+        return (
+            f'SELECT m.id AS id, bm25({fts}) AS rank FROM {fts} '
+            f'JOIN {table} m ON m.id = {fts}.rowid '
+            f'WHERE {fts} MATCH %s AND m.room_id IN ({{rooms}})')
+
+    def ranked_params(self, match):
+        return [match]
+
+    def snippets(self, table):
+        fts = f'{table}_fts'
+        return (
+            f"SELECT rowid, snippet({fts}, -1, %s, %s, '…', 12) FROM {fts} "
+            f'WHERE {fts} MATCH %s AND rowid IN ({{ids}})')
+
+    def snippet_params(self, match):
+        return [START, STOP, match]
+
+
+class PostgresSearch:
+    """
+    Full text search on the GIN index, negative ts_rank so lower is better
+    like in SQLite
+    """
+
+    def match(self, terms):
+        return ' & '.join(terms) + ':*'
+
+    def ranked(self, table):
+        return (
+            f"SELECT id, -ts_rank({POSTGRES_VECTOR}, "
+            f"to_tsquery('simple', %s))::float8 AS rank FROM {table} "
+            f"WHERE {POSTGRES_VECTOR} @@ to_tsquery('simple', %s) "
+            f'AND room_id IN ({{rooms}})')
+
+    def ranked_params(self, match):
+        return [match, match]
+
+    def snippets(self, table):
+        return (
+            f"SELECT id, ts_headline('simple', message, to_tsquery('simple', %s), "
+            f"%s) FROM {table} WHERE id IN ({{ids}})")
+
+    def snippet_params(self, match):
+        return [match, f'StartSel={START}, StopSel={STOP}, MaxWords=20, MinWords=5']
+
+
+backends = {
+    'sqlite': SqliteSearch(),
+    'postgresql': PostgresSearch(),
+}
+
+
+def search_messages(user, query, room_id=None, cursor=None,
+                    limit=constants.MESSAGE_SEARCH_LIMIT):
+    """
+    Search the messages, archived ones included, of the rooms user is
+    member of, best match first
+    :param user: User searching
+    :param query: Words to search, the last one can be incomplete
+    :param room_id: Only search this room
+    :param cursor: Cursor of the previous page
+    :param limit: Maximum number of messages
+    :returns: (list of (message, snippet), cursor of the next page or None)
+    """
+
+    terms = re.findall(r'\w+', query or '')
+
+    if not terms:
+        raise ValidationError('Search query is require.')
+
+    backend = backends.get(connection.vendor)
+
+    if backend is None:
+        raise ValidationError(
+            f'Search is not supported on {connection.vendor}.')
+
+    match = backend.match(terms)
+    rooms = f'SELECT room_id FROM {Room.users.through._meta.db_table} ' \
+            f'WHERE user_id = %s'
+    room_params = [user.id]
+
+    if room_id is not None:
+        rooms += ' AND room_id = %s'
+        room_params.append(room_id)
+
+    ranked = ' UNION ALL '.join(
+        backend.ranked(table).format(rooms=rooms) for table in TABLES)
+    params = (backend.ranked_params(match) + room_params) * len(TABLES)
+
+    sql = f'SELECT id, rank FROM ({ranked}) ranked'
+
+    if cursor:
+        rank, message_id = decode_cursor(cursor)
+        sql += ' WHERE rank > %s OR (rank = %s AND id < %s)'
+        params += [rank, rank, message_id]
+
+    sql += ' ORDER BY rank, id DESC LIMIT %s'
+    params.append(limit + 1)
+
+    with connection.cursor() as db:
+        db.execute(sql, params)
+        rows = db.fetchall()
+
+    next_cursor = None
+
+    if len(rows) > limit:
+        rows = rows[:limit]
+        message_id, rank = rows[-1]
+        next_cursor = encode_cursor(rank, message_id)
+
+    if not rows:
+        return [], None
+
+    # Snippets and messages of the page only
+    ids = [message_id for message_id, rank in rows]
+    placeholders = ', '.join(['%s'] * len(ids))
+    snippets = {}
+
+    with connection.cursor() as db:
+        for table in TABLES:
+            db.execute(backend.snippets(table).format(ids=placeholders),
+                       backend.snippet_params(match) + ids)
+            snippets.update(db.fetchall())
+
+    messages = Message.objects.select_related('user').in_bulk(ids)
+    missing = [message_id for message_id in ids if message_id not in messages]
+
+    if missing:
+        messages.update(
+            ArchivedMessage.objects.select_related('user').in_bulk(missing))
+
+    results = [
+        (messages[message_id], highlight(snippets.get(message_id, '')))
+        for message_id in ids if message_id in messages
+    ]
+
+    return results, next_cursor
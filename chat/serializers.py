@@ -1,17 +1,67 @@
 from rest_framework import serializers
+from rest_framework.relations import MANY_RELATION_KWARGS
 from rest_framework.exceptions import ValidationError
-from chatapp import constants
+from chatapp.projections import Projection
 from user.models import User, Friend
 from user.serializers import UserSerializer
 from .models import Room, Message
 
 
+class BulkManyRelatedField(serializers.ManyRelatedField):
+    """
+    Many related field getting all its instances in one query instead of
+    one query per primary key
+    """
+
+    def to_internal_value(self, data):
+        if isinstance(data, str) or not hasattr(data, '__iter__'):
+            self.fail('not_a_list', input_type=type(data).__name__)
+        if not self.allow_empty and len(data) == 0:
+            self.fail('empty')
+
+        child = self.child_relation
+
+        ids = []
+
+        for pk in data:
+            try:
+                ids.append(int(pk))
+            except (TypeError, ValueError):
+                child.fail('incorrect_type', data_type=type(pk).__name__)
+
+        instances = child.get_queryset().in_bulk(ids)
+
+        for pk in ids:
+            if pk not in instances:
+                child.fail('does_not_exist', pk_value=pk)
+
+        return [instances[pk] for pk in ids]
+
+
+class BulkPrimaryKeyRelatedField(serializers.PrimaryKeyRelatedField):
+    """
+    Primary key related field using `BulkManyRelatedField` for many=True
+    """
+
+    @classmethod
+    def many_init(cls, *args, **kwargs):
+        list_kwargs = {'child_relation': cls(*args, **kwargs)}
+
+        for key in kwargs:
+            if key in MANY_RELATION_KWARGS:
+                list_kwargs[key] = kwargs[key]
+
+        return BulkManyRelatedField(**list_kwargs)
+
+
 class RoomSerializer(serializers.ModelSerializer):
     """
     Room Serializer
     """
 
     user = UserSerializer(read_only=True)
+    users = BulkPrimaryKeyRelatedField(
+        many=True, allow_empty=False, queryset=User.objects.all())
 
     class Meta:
         model = Room
@@ -25,20 +75,18 @@ class RoomSerializer(serializers.ModelSerializer):
             'photo',
             'updated',
             'latest_message',
+            'last_message',
+            'last_sender',
         )
 
         read_only_fields = (
             'id',
             'label',
             'latest_message',
+            'last_message',
+            'last_sender',
         )
 
-        extra_kwargs = {
-            'users': {
-                'required': True
-            }
-        }
-
     def validate_users(self, value):
         """
         Add creator to the list if not and validate the user list should
@@ -58,26 +106,29 @@ class RoomSerializer(serializers.ModelSerializer):
             raise ValidationError(['The chat room require at least 2 members.'])
 
         # Check max users in a room
-        if len(value) >= constants.ROOM_MAXIMUM_USERS:
-            raise ValidationError(
-                f'Maximum {constants.ROOM_MAXIMUM_USERS} users in a room.')
+        Room.objects.check_size(len(value))
+
+        friends = Friend.objects.friends_among(
+            user, [new_user.id for new_user in value])
 
         for new_user in value:
 
             # Check user friendship
-            if not Friend.objects.are_friends(user, new_user) \
-                and user != new_user:
+            if new_user.id not in friends and user != new_user:
                 raise ValidationError(
-                    f'You do not add user is not your friend.')
+                    'You do not add user is not your friend.')
 
         return value
 
     def to_representation(self, instance):
         """
-        Serializer for foreign key
+        Serializer for foreign key, swapped in once for all the rooms of a
+        list
         """
 
-        self.fields['users'] = UserSerializer(many=True)
+        if not isinstance(self.fields['users'], serializers.ListSerializer):
+            self.fields['users'] = UserSerializer(many=True)
+
         return super(RoomSerializer, self).to_representation(instance)
 
 
@@ -125,3 +176,26 @@ class MessageSerializer(serializers.ModelSerializer):
             raise ValidationError(
                 'You do not send message because you are not member in this room.')
         return room
+
+
+def full_name(first_name, last_name):
+    return f'{first_name} {last_name}'.strip()
+
+
+class MessageProjection(Projection):
+    """
+    Fast path of MessageSerializer for reading messages, archived ones
+    included
+    """
+
+    fields = (
+        ('id', 'id'),
+        ('user', (
+            ('id', 'user_id'),
+            ('username', 'user__username'),
+            ('full_name', ('user__first_name', 'user__last_name'), full_name),
+        )),
+        ('room', 'room_id'),
+        ('message', 'message'),
+        ('created', 'created', serializers.DateTimeField().to_representation),
+    )
@@ -0,0 +1,7 @@
+from django.dispatch import Signal
+
+# Sent when the latest message of a room changes
+latest_message_updated = Signal(providing_args=['room_id', 'message', 'updated'])
+
+# Sent when users are added to or removed from a room
+room_members_changed = Signal(providing_args=['room_id', 'added', 'removed'])
@@ -8,6 +8,8 @@ from rest_framework.decorators import action
 from rest_framework.permissions import IsAuthenticated
 from rest_framework.filters import SearchFilter
 
+from chatapp import constants
+from chatapp.conditional import conditional
 from chatapp.permissions import (
     IsAdminOrIsSelf,
     IsSelfOrAdminUpdateDeleteOnly,
@@ -16,8 +18,11 @@ from chatapp.permissions import (
 from .serializers import (
     RoomSerializer,
     MessageSerializer,
+    MessageProjection,
 )
 from .models import Room, Message
+from .search import search_messages
+from .writers import get_message_writer
 
 
 class RoomViewSet(viewsets.ModelViewSet):
@@ -30,10 +35,13 @@ class RoomViewSet(viewsets.ModelViewSet):
     permission_classes = (IsAuthenticated, IsSelfOrAdminUpdateDeleteOnly)
     filter_backends = (SearchFilter,)
     search_fields = ('name',)
+    keyset_ordering = ('-updated', '-id')
 
+    @conditional(lambda view, request: Room.objects.rooms_validator(
+        request.user))
     def list(self, request):
         """
-        Get rooms
+        Get rooms, `pagination=cursor` for keyset pages
         """
         queryset = Room.objects.rooms(user=request.user)
         queryset = self.filter_queryset(queryset)
@@ -93,10 +101,14 @@ class MessageViewSet(viewsets.ModelViewSet):
     permission_classes = (IsAuthenticated,)
     filter_backends = (SearchFilter,)
     search_fields = ('message', 'subject')
+    keyset_ordering = ('-created', '-id')
 
+    @conditional(lambda view, request: Room.objects.messages_validator(
+        request.user, request.query_params.get('room')))
     def list(self, request):
         """
-        Get user messages from a room
+        Get user messages from a room, `pagination=cursor` for keyset
+        pages
         """
 
         try:
@@ -106,21 +118,74 @@ class MessageViewSet(viewsets.ModelViewSet):
 
             queryset = Message.objects.messages(request.user, room_id)
             queryset = self.filter_queryset(queryset)
-            page = self.paginate_queryset(queryset)
-            serializer = MessageSerializer(
-                page, many=True, context={'request': request})
-            return self.get_paginated_response(serializer.data)
+            page = self.paginate_queryset(MessageProjection.values(queryset))
+            return self.get_paginated_response(MessageProjection.from_rows(page))
 
         except ValidationError as e:
             return Response({'detail': e.detail[0]},
                             status.HTTP_400_BAD_REQUEST)
 
+    @action(detail=False, methods=['get'])
+    def search(self, request):
+        """
+        Full text search in the messages of user rooms, best match first.
+        Query params: `q` words to search, `room` to search one room only,
+        `limit` and `cursor` of the next page
+        """
+
+        try:
+            try:
+                room_id = request.query_params.get('room')
+                room_id = int(room_id) if room_id else None
+                limit = int(request.query_params.get(
+                    'limit', constants.MESSAGE_SEARCH_LIMIT))
+            except ValueError:
+                raise ValidationError('Room and limit must be integers.')
+
+            results, cursor = search_messages(
+                request.user, request.query_params.get('q'), room_id,
+                request.query_params.get('cursor'),
+                max(1, min(limit, constants.MESSAGE_MAXIMUM)))
+
+        except ValidationError as e:
+            return Response({'detail': e.detail[0]},
+                            status.HTTP_400_BAD_REQUEST)
+
+        data = []
+
+        for message, snippet in results:
+            item = MessageSerializer(message, context={'request': request}).data
+            item['snippet'] = snippet
+            data.append(item)
+
+        return Response({
+            'next': cursor,
+            'results': data,
+        })
+
     def perform_create(self, serializer):
         """
         Add `user` param as request user when creating new message
         """
 
-        serializer.save(user=self.request.user)
+        message = Message(user=self.request.user, **serializer.validated_data)
+        serializer.instance = get_message_writer().write(message)
+
+    def perform_update(self, serializer):
+        """
+        Stamp the room modified, its message pages changed
+        """
+
+        serializer.save()
+        Room.objects.touch(serializer.instance.room_id)
+
+    def perform_destroy(self, instance):
+        """
+        Stamp the room modified, its message pages changed
+        """
+
+        instance.delete()
+        Room.objects.touch(instance.room_id)
 
 
 @login_required
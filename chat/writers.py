@@ -0,0 +1,176 @@
+import datetime
+import logging
+import threading
+from contextlib import nullcontext
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.db import DatabaseError, connection, transaction
+from django.utils import timezone
+from .batching import BackgroundBatcher
+from .metrics import MESSAGES_DROPPED
+from .models import Message, Room
+
+logger = logging.getLogger(__name__)
+
+# SQLite has one write lock for the whole database. A transaction waiting
+# for it while another one commits can fail right away with "database is
+# locked", so the database executor threads write messages one at a time
+_sqlite_write_lock = threading.Lock()
+
+
+def write_lock():
+    """
+    Lock serializing message writes of the process on SQLite, no lock on
+    the other databases
+    """
+
+    if connection.vendor == 'sqlite':
+        return _sqlite_write_lock
+
+    return nullcontext()
+
+
+class MessageWriter:
+    """
+    Sync durability: the message is stored before it is broadcast
+    """
+
+    buffered = False
+
+    def write(self, message):
+        """
+        Store a new message
+        :param message: Unsaved Message instance
+        """
+
+        with write_lock():
+            message.save()
+
+        return message
+
+    def flush(self):
+        return 0
+
+
+class BufferedMessageWriter(MessageWriter):
+    """
+    Buffered durability: the message is broadcast right away and stored
+    later with the other pending messages in one bulk INSERT, plus one
+    `latest_message` UPDATE per room. Buffered messages are broadcast
+    without `id`, so the consumers turn off resuming and history fetches,
+    and they are lost if the process dies before the flush.
+    """
+
+    buffered = True
+
+    def __init__(self, interval, batch_size):
+        """
+        :param interval: Maximum milliseconds a message stays buffered
+        :param batch_size: Number of buffered messages triggering a flush
+        """
+
+        self.batcher = BackgroundBatcher(
+            self.write_messages, interval, batch_size,
+            name='chat-message-writer')
+
+    def write(self, message):
+        """
+        Buffer a new message
+        :param message: Unsaved Message instance
+        """
+
+        # Set now so the broadcast carries a date, the flush sets its own
+        message.created = datetime.datetime.now(tz=timezone.utc)
+        self.batcher.add(message)
+        return message
+
+    def flush(self):
+        """
+        Store the buffered messages now
+        """
+
+        return self.batcher.flush()
+
+    def write_messages(self, messages):
+        """
+        Store a batch of messages. When the batch fails, e.g. a message to a
+        room deleted since, its rooms are stored one by one and the messages
+        of a failing room one by one, so a bad row only drops itself
+        """
+
+        try:
+            self.store(messages)
+            return
+        except DatabaseError:
+            logger.warning('Storing %d buffered messages failed, retrying '
+                           'room by room.', len(messages))
+
+        rooms = {}
+
+        for message in messages:
+            rooms.setdefault(message.room_id, []).append(message)
+
+        for room_messages in rooms.values():
+            try:
+                self.store(room_messages)
+                continue
+            except DatabaseError:
+                pass
+
+            for message in room_messages:
+                try:
+                    self.store([message])
+                except DatabaseError:
+                    MESSAGES_DROPPED.inc()
+                    logger.exception('Dropped a buffered message of room %s.',
+                                     message.room_id)
+
+    def store(self, messages):
+        """
+        Store messages in one transaction
+        """
+
+        try:
+            with write_lock(), transaction.atomic():
+
+                if connection.features.can_return_ids_from_bulk_insert:
+                    Message.objects.bulk_create(messages)
+                    Room.objects.set_latest_messages(messages)
+                else:
+                    # One INSERT each, which gives the ids
+                    for message in messages:
+                        message.save()
+
+        except DatabaseError:
+            # Ids given in the rolled back transaction do not exist
+            for message in messages:
+                message.id = None
+                message._state.adding = True
+            raise
+
+
+_writers = {}
+
+
+def get_message_writer():
+    """
+    Get the message writer for the `CHAT_MESSAGE_DURABILITY` setting
+    """
+
+    durability = settings.CHAT_MESSAGE_DURABILITY
+    interval = settings.CHAT_WRITE_BEHIND_INTERVAL
+    batch_size = settings.CHAT_WRITE_BEHIND_BATCH_SIZE
+    key = (durability, interval, batch_size)
+
+    if key not in _writers:
+
+        if durability == 'sync':
+            _writers[key] = MessageWriter()
+        elif durability == 'buffered':
+            _writers[key] = BufferedMessageWriter(interval, batch_size)
+        else:
+            raise ImproperlyConfigured(
+                f'CHAT_MESSAGE_DURABILITY must be "sync" or "buffered", '
+                f'not "{durability}".')
+
+    return _writers[key]
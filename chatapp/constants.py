@@ -1,7 +1,29 @@
 # Room
 ROOM_MAXIMUM_USERS = 10
 
+# Maximum rooms subscribed by a websocket connection
+ROOM_SUBSCRIPTION_MAXIMUM = 100
+
 # Message
 MESSAGE_MAXIMUM = 50
 
+# Maximum messages of a history page and of a streamed chunk of it
+MESSAGE_HISTORY_MAXIMUM = 500
+MESSAGE_CHUNK_SIZE = 50
+
+# Maximum missed messages replayed to a reconnecting client, above that it
+# gets a full snapshot
+MESSAGE_RESUME_MAXIMUM = 200
+
+# Messages of a search results page
+MESSAGE_SEARCH_LIMIT = 20
+
+# Length of the latest message preview pushed to room lists
+ROOM_PREVIEW_LENGTH = 100
+
+# Friend suggestions returned, and friends walked per user to find them
+FRIEND_SUGGESTION_LIMIT = 20
+FRIEND_SUGGESTION_FANOUT = 200
+
 CHAT_ROOM_PREFIX = 'CHAT_ROOM_'
+CHAT_USER_PREFIX = 'CHAT_USER_'
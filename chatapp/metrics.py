@@ -0,0 +1,274 @@
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+
+# Seconds, from sub-millisecond in-memory calls to slow queries
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                   0.25, 0.5, 1, 2.5, 5, 10)
+
+
+def format_labels(names, values, extra=()):
+    """
+    Prometheus label set, e.g. `{command="fetch_data"}`
+    """
+
+    pairs = list(zip(names, values)) + list(extra)
+
+    if not pairs:
+        return ''
+
+    labels = ','.join(
+        '{}="{}"'.format(name, str(value).replace('\\', '\\\\')
+                         .replace('"', '\\"').replace('\n', '\\n'))
+        for name, value in pairs)
+
+    return '{' + labels + '}'
+
+
+class Metric:
+    """
+    Base metric, one value per label set. Updates take a lock and a dict
+    lookup, cheap enough to record on every frame
+    """
+
+    type = None
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def key(self, labels):
+        """
+        Label values in the order of the label names
+        """
+
+        if set(labels) != set(self.labels):
+            raise ValueError(
+                f'{self.name} expects labels {self.labels}, got {tuple(labels)}.')
+
+        return tuple(labels[name] for name in self.labels)
+
+    def remove(self, **labels):
+        """
+        Drop the series of a label set
+        """
+
+        with self._lock:
+            self._values.pop(self.key(labels), None)
+
+    def clear(self):
+        with self._lock:
+            self._values.clear()
+
+    def samples(self):
+        """
+        List of (suffix, label text, value)
+        """
+
+        with self._lock:
+            return [('', format_labels(self.labels, key), value)
+                    for key, value in self._values.items()]
+
+    def render(self):
+        lines = [
+            f'# HELP {self.name} {self.documentation}',
+            f'# TYPE {self.name} {self.type}',
+        ]
+
+        for suffix, labels, value in self.samples():
+            lines.append(f'{self.name}{suffix}{labels} {value}')
+
+        return '\n'.join(lines)
+
+
+class Counter(Metric):
+    """
+    Value that only goes up
+    """
+
+    type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def get(self, **labels):
+        with self._lock:
+            return self._values.get(self.key(labels), 0)
+
+
+class Gauge(Metric):
+    """
+    Value that goes up and down, or read from a function at scrape time
+    """
+
+    type = 'gauge'
+
+    def __init__(self, name, documentation, labels=(), function=None):
+        """
+        :param function: Callable returning the value of a gauge without
+            labels, called on every render
+        """
+
+        super().__init__(name, documentation, labels)
+        self.function = function
+
+    def set(self, value, **labels):
+        key = self.key(labels)
+
+        with self._lock:
+            self._values[key] = value
+
+    def inc(self, amount=1, **labels):
+        """
+        Add to the value
+        :returns: New value
+        """
+
+        key = self.key(labels)
+
+        with self._lock:
+            value = self._values[key] = self._values.get(key, 0) + amount
+
+        return value
+
+    def dec(self, amount=1, **labels):
+        return self.inc(-amount, **labels)
+
+    def get(self, **labels):
+        if self.function is not None:
+            return self.function()
+
+        with self._lock:
+            return self._values.get(self.key(labels), 0)
+
+    def samples(self):
+        if self.function is not None:
+            return [('', '', self.function())]
+
+        return super().samples()
+
+
+class Histogram(Metric):
+    """
+    Distribution of observed values in cumulative buckets, with their sum
+    and count
+    """
+
+    type = 'histogram'
+
+    def __init__(self, name, documentation, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self.key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+
+        with self._lock:
+            series = self._values.get(key)
+
+            if series is None:
+                # Per bucket counts plus +Inf, sum
+                series = self._values[key] = [[0] * (len(self.buckets) + 1), 0]
+
+            series[0][index] += 1
+            series[1] += value
+
+    @contextmanager
+    def time(self, **labels):
+        """
+        Observe the seconds spent in the block, also around awaits
+        """
+
+        start = time.perf_counter()
+
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def get(self, **labels):
+        """
+        (count, sum) of a label set
+        """
+
+        with self._lock:
+            series = self._values.get(self.key(labels))
+
+            if series is None:
+                return 0, 0
+
+            return sum(series[0]), series[1]
+
+    def samples(self):
+        with self._lock:
+            values = [(key, list(counts), total)
+                      for key, (counts, total) in self._values.items()]
+
+        samples = []
+
+        for key, counts, total in values:
+            cumulative = 0
+
+            for bound, count in zip(self.buckets + (float('+inf'),), counts):
+                cumulative += count
+                le = '+Inf' if bound == float('+inf') else repr(float(bound))
+                samples.append((
+                    '_bucket', format_labels(self.labels, key, [('le', le)]),
+                    cumulative))
+
+            samples.append(('_sum', format_labels(self.labels, key), total))
+            samples.append(('_count', format_labels(self.labels, key), cumulative))
+
+        return samples
+
+
+class Registry:
+    """
+    In-process metric registry. Every worker process has its own, scrape
+    each of them
+    """
+
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        """
+        Add a metric, or get the one already registered under its name
+        """
+
+        with self._lock:
+            return self._metrics.setdefault(metric.name, metric)
+
+    def counter(self, name, documentation, labels=()):
+        return self.register(Counter(name, documentation, labels))
+
+    def gauge(self, name, documentation, labels=(), function=None):
+        return self.register(Gauge(name, documentation, labels, function))
+
+    def histogram(self, name, documentation, labels=(), buckets=DEFAULT_BUCKETS):
+        return self.register(Histogram(name, documentation, labels, buckets))
+
+    def get(self, name):
+        return self._metrics.get(name)
+
+    def render(self):
+        """
+        Prometheus text exposition format
+        """
+
+        with self._lock:
+            metrics = list(self._metrics.values())
+
+        return '\n'.join(metric.render() for metric in metrics) + '\n'
+
+
+registry = Registry()
@@ -0,0 +1,36 @@
+import logging
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from .queries import QueryCounter
+
+logger = logging.getLogger(__name__)
+
+
+class QueryCountMiddleware:
+    """
+    Count the SQL queries and database time of every request, in DEBUG
+    only. Adds them to the response as `X-Query-Count` and
+    `X-Query-Duration` (milliseconds) headers and logs them.
+    """
+
+    def __init__(self, get_response):
+
+        if not settings.DEBUG:
+            raise MiddlewareNotUsed()
+
+        self.get_response = get_response
+
+    def __call__(self, request):
+
+        with QueryCounter() as queries:
+            response = self.get_response(request)
+
+        duration = f'{queries.duration * 1000:.2f}'
+
+        response['X-Query-Count'] = str(queries.count)
+        response['X-Query-Duration'] = duration
+
+        logger.debug('%s %s: %d queries in %s ms', request.method,
+                     request.path, queries.count, duration)
+
+        return response
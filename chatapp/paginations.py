@@ -1,15 +1,298 @@
+import base64
+import binascii
+import datetime
+import json
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.core.paginator import Paginator
+from django.db import DatabaseError, connections, transaction
+from django.db.models import Q
+from django.utils.functional import cached_property
 from rest_framework import pagination
+from rest_framework.exceptions import NotFound
 from rest_framework.response import Response
+from rest_framework.settings import api_settings
+from rest_framework.utils.urls import remove_query_param, replace_query_param
+
+
+def bounded_count(queryset, limit):
+    """
+    Count the rows of a queryset, up to `limit`
+    """
+
+    if hasattr(queryset, 'bounded_count'):
+        return queryset.bounded_count(limit)
+
+    return queryset[:limit].count()
+
+
+def estimate_count(queryset):
+    """
+    Estimate the rows of a queryset from the planner statistics, the table
+    size for an unfiltered queryset and on PostgreSQL the plan rows of a
+    filtered one
+    :returns: Estimated number of rows or None without statistics
+    """
+
+    if hasattr(queryset, 'estimate_count'):
+        return queryset.estimate_count()
+
+    connection = connections[queryset.db]
+    table = queryset.model._meta.db_table
+    filtered = bool(queryset.query.where) or queryset.query.distinct
+
+    try:
+        # Savepoint, a failure must not break the transaction of the request
+        with transaction.atomic(using=queryset.db), connection.cursor() as cursor:
+
+            if connection.vendor == 'postgresql' and filtered:
+                sql, params = queryset.query.sql_with_params()
+                cursor.execute(f'EXPLAIN (FORMAT JSON) {sql}', params)
+                plan = cursor.fetchone()[0]
+                plan = json.loads(plan) if isinstance(plan, str) else plan
+                return int(plan[0]['Plan']['Plan Rows'])
+
+            if connection.vendor == 'postgresql':
+                cursor.execute(
+                    'SELECT reltuples FROM pg_class WHERE oid = %s::regclass',
+                    [table])
+                row = cursor.fetchone()
+                return int(row[0]) if row and row[0] >= 0 else None
+
+            if connection.vendor == 'sqlite' and not filtered:
+                # Every stat of a table starts with its number of rows
+                cursor.execute(
+                    'SELECT stat FROM sqlite_stat1 WHERE tbl = %s LIMIT 1',
+                    [table])
+                row = cursor.fetchone()
+                return int(row[0].split()[0]) if row else None
+
+    # No statistics table before the first ANALYZE
+    except DatabaseError:
+        return None
+
+    return None
+
+
+class EstimatedCountPaginator(Paginator):
+    """
+    Paginator counting exactly up to PAGINATION_COUNT_THRESHOLD rows, and
+    above that estimating the count from the planner statistics, which
+    sets `approximate`. Without statistics the count is exact.
+    """
+
+    approximate = False
+
+    @cached_property
+    def count(self):
+        threshold = settings.PAGINATION_COUNT_THRESHOLD
+
+        if not hasattr(self.object_list, 'model'):
+            return len(self.object_list)
+
+        count = bounded_count(self.object_list, threshold + 1)
+
+        if count <= threshold:
+            return count
+
+        estimate = estimate_count(self.object_list)
+
+        if estimate is None:
+            return self.object_list.count()
+
+        # Statistics older than the table may be under the bounded count
+        self.approximate = True
+        return max(estimate, count)
 
 
 class CustomPagination(pagination.PageNumberPagination):
+    """
+    Page number pagination, with an estimated count on large lists. Views
+    with a `keyset_ordering` also paginate with `CompositeKeysetPagination`
+    when the request asks for it with `pagination=cursor` or gives a cursor
+    """
+
+    django_paginator_class = EstimatedCountPaginator
+    mode_query_param = 'pagination'
+    keyset = None
+
+    def paginate_queryset(self, queryset, request, view=None):
+        ordering = getattr(view, 'keyset_ordering', None)
+        params = request.query_params
+
+        if ordering and (params.get(self.mode_query_param) == 'cursor'
+                         or CompositeKeysetPagination.cursor_query_param in params):
+            self.keyset = CompositeKeysetPagination(ordering)
+            return self.keyset.paginate_queryset(queryset, request, view)
+
+        return super().paginate_queryset(queryset, request, view)
+
     def get_paginated_response(self, data):
+
+        if self.keyset:
+            return self.keyset.get_paginated_response(data)
+
         return Response({
             'links': {
                 'next': self.get_next_link(),
                 'prev': self.get_previous_link()
             },
             'count': self.page.paginator.count,
+            'approximate': self.page.paginator.approximate,
             'total_pages': self.page.paginator.num_pages,
             'results': data
         })
+
+
+class CompositeKeysetPagination(pagination.BasePagination):
+    """
+    Keyset pagination over several ordering fields, e.g. ('-created', '-id'),
+    the last one unique. The opaque cursor holds the ordering values of the
+    row a page continues from, so page 1,000 costs what page 1 does. The
+    total is only counted when asked with `count=true`.
+    """
+
+    cursor_query_param = 'cursor'
+    count_query_param = 'count'
+    invalid_cursor_message = 'Invalid cursor'
+
+    def __init__(self, ordering):
+        """
+        :param ordering: Ordering fields, `-` prefix for descending
+        """
+
+        self.ordering = tuple(ordering)
+        self.page_size = api_settings.PAGE_SIZE
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        self.base_url = request.build_absolute_uri()
+        self.model = queryset.model
+        values, self.reverse = self.decode_cursor(request)
+
+        self.count = None
+
+        if request.query_params.get(self.count_query_param) == 'true':
+            self.count = queryset.count()
+
+        # Previous pages are read backwards from the cursor
+        queryset = queryset.order_by(*self.ordering)
+
+        if self.reverse:
+            queryset = queryset.reverse()
+
+        if values is not None:
+            queryset = queryset.filter(self.after(values))
+
+        rows = list(queryset[:self.page_size + 1])
+        has_more = len(rows) > self.page_size
+        self.page = rows[:self.page_size]
+
+        if self.reverse:
+            self.page.reverse()
+            self.has_next = True
+            self.has_previous = has_more
+        else:
+            self.has_next = has_more
+            self.has_previous = values is not None
+
+        return self.page
+
+    def after(self, values):
+        """
+        Condition of the rows after the cursor row in the read direction,
+        e.g. created <= c AND (created < c OR (created = c AND id < i)). The
+        redundant bound on the first field lets the index seek to the cursor
+        instead of filtering every row before it
+        """
+
+        condition = Q()
+        equal = Q()
+        bound = None
+
+        for field, value in zip(self.ordering, values):
+            name = field.lstrip('-')
+            lookup = 'lt' if field.startswith('-') != self.reverse else 'gt'
+            condition |= equal & Q(**{f'{name}__{lookup}': value})
+            equal &= Q(**{name: value})
+
+            if bound is None:
+                bound = Q(**{f'{name}__{lookup}e': value})
+
+        return bound & condition
+
+    def get_paginated_response(self, data):
+        content = {
+            'links': {
+                'next': self.get_next_link(),
+                'prev': self.get_previous_link()
+            },
+            'results': data
+        }
+
+        if self.count is not None:
+            content['count'] = self.count
+
+        return Response(content)
+
+    def get_next_link(self):
+
+        if not self.has_next or not self.page:
+            return None
+
+        return self.encode_cursor(self.page[-1], reverse=False)
+
+    def get_previous_link(self):
+
+        if not self.has_previous or not self.page:
+            return None
+
+        return self.encode_cursor(self.page[0], reverse=True)
+
+    def encode_cursor(self, row, reverse):
+        """
+        Link to the page after or before a row
+        """
+
+        values = []
+
+        for field in self.ordering:
+            name = field.lstrip('-')
+            value = row[name] if isinstance(row, dict) else getattr(row, name)
+
+            # Full precision, the JSON encoder of Django drops microseconds
+            if isinstance(value, (datetime.date, datetime.time)):
+                value = value.isoformat()
+
+            values.append(value)
+
+        cursor = base64.urlsafe_b64encode(
+            json.dumps([values, int(reverse)]).encode()).decode()
+        url = remove_query_param(self.base_url, self.count_query_param)
+
+        return replace_query_param(url, self.cursor_query_param, cursor)
+
+    def decode_cursor(self, request):
+        """
+        :returns: (ordering values or None, reverse)
+        """
+
+        cursor = request.query_params.get(self.cursor_query_param)
+
+        if not cursor:
+            return None, False
+
+        try:
+            values, reverse = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+
+            if len(values) != len(self.ordering):
+                raise ValueError
+
+            values = [
+                self.model._meta.get_field(field.lstrip('-')).to_python(value)
+                for field, value in zip(self.ordering, values)
+            ]
+        except (binascii.Error, ValueError, TypeError, ValidationError):
+            raise NotFound(self.invalid_cursor_message)
+
+        return values, bool(reverse)
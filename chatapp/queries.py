@@ -0,0 +1,94 @@
+import contextvars
+import threading
+import time
+from django.db import connections
+from django.db.backends.signals import connection_created
+
+# Counters of the current context, copied to the database executor threads
+_context_counters = contextvars.ContextVar('query_counters', default=())
+
+# Counters of every thread
+_global_counters = []
+
+
+def record_query(execute, sql, params, many, context):
+    """
+    Database execute wrapper feeding the active counters
+    """
+
+    counters = _context_counters.get()
+
+    if _global_counters:
+        counters = counters + tuple(_global_counters)
+
+    if not counters:
+        return execute(sql, params, many, context)
+
+    start = time.perf_counter()
+
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        duration = time.perf_counter() - start
+
+        for counter in counters:
+            counter.add(duration)
+
+
+def install(sender=None, connection=None, **kwargs):
+    """
+    Add `record_query` to a connection
+    """
+
+    if record_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(record_query)
+
+
+connection_created.connect(install)
+
+
+class QueryCounter:
+    """
+    Count SQL queries and their time. By default only the queries of the
+    current context are counted, which includes the calls it makes through
+    the database executor, so concurrent requests do not mix. With
+    `all_threads` every query of the process is counted.
+    """
+
+    def __init__(self, all_threads=False):
+        self.all_threads = all_threads
+        self.count = 0
+        self.duration = 0
+        self._lock = threading.Lock()
+        self._token = None
+
+    def add(self, duration):
+        with self._lock:
+            self.count += 1
+            self.duration += duration
+
+    def __enter__(self):
+
+        # Connections opened before this module was imported
+        for connection in connections.all():
+            install(connection=connection)
+
+        if self.all_threads:
+            _global_counters.append(self)
+        else:
+            self._token = _context_counters.set(
+                _context_counters.get() + (self,))
+
+        return self
+
+    def __exit__(self, *args):
+
+        if self.all_threads:
+            _global_counters.remove(self)
+        else:
+            _context_counters.reset(self._token)
+
+    def reset(self):
+        with self._lock:
+            self.count = 0
+            self.duration = 0
@@ -55,6 +55,7 @@ MIDDLEWARE = [
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    'chatapp.middleware.QueryCountMiddleware',
 ]
 
 ROOT_URLCONF = 'chatapp.urls'
@@ -143,6 +144,10 @@ REST_FRAMEWORK = {
     'PAGE_SIZE': 10
 }
 
+# Lists above this many rows get a count estimated from the planner
+# statistics instead of an exact COUNT(*)
+PAGINATION_COUNT_THRESHOLD = int(os.environ.get('PAGINATION_COUNT_THRESHOLD', 10000))
+
 
 # SImple JWT
 SIMPLE_JWT = {
@@ -152,6 +157,23 @@ SIMPLE_JWT = {
 }
 
 
+# Cache, per process by default. Deployments running several processes set
+# a shared backend, e.g. CACHE_BACKEND=
+# django.core.cache.backends.memcached.MemcachedCache with CACHE_LOCATION
+CACHES = {
+    'default': {
+        'BACKEND': os.environ.get(
+            'CACHE_BACKEND', 'django.core.cache.backends.locmem.LocMemCache'),
+        'LOCATION': os.environ.get('CACHE_LOCATION', ''),
+    },
+}
+
+
+# Bearer token of the Prometheus scraper for /metrics, which staff users
+# can also read. Empty allows staff users only
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN', '')
+
+
 ASGI_APPLICATION = 'chat.routing.application'
 
 CHANNEL_LAYERS = {
@@ -162,3 +184,32 @@ CHANNEL_LAYERS = {
         },
     },
 }
+
+
+# Chat consumers
+# Size of the thread pool running the ORM work of the async consumers
+CHAT_DB_EXECUTOR_WORKERS = int(os.environ.get('CHAT_DB_EXECUTOR_WORKERS', 8))
+
+# Message durability: "sync" stores each message before broadcasting it,
+# "buffered" broadcasts first and stores messages in batches, messages are
+# then broadcast without ID so clients cannot resume or fetch history
+CHAT_MESSAGE_DURABILITY = os.environ.get('CHAT_MESSAGE_DURABILITY', 'sync')
+
+# Buffered messages are stored every interval (ms) or batch size messages
+CHAT_WRITE_BEHIND_INTERVAL = int(os.environ.get('CHAT_WRITE_BEHIND_INTERVAL', 200))
+CHAT_WRITE_BEHIND_BATCH_SIZE = int(os.environ.get('CHAT_WRITE_BEHIND_BATCH_SIZE', 100))
+
+# Milliseconds between room_updated pushes of a room to its members
+CHAT_ROOM_UPDATE_INTERVAL = int(os.environ.get('CHAT_ROOM_UPDATE_INTERVAL', 1000))
+
+# Messages older than this many days are moved to the archive table by
+# the archive_messages command
+CHAT_MESSAGE_ARCHIVE_DAYS = int(os.environ.get('CHAT_MESSAGE_ARCHIVE_DAYS', 90))
+
+
+# Users
+# Seconds the friend lists of the friendship graph stay in the cache. The
+# lists are dropped from the cache of the process changing a friendship,
+# other processes see the change when they expire. Short for the default
+# per-process cache, raise it with a shared CACHE_BACKEND
+FRIEND_GRAPH_CACHE_TIMEOUT = int(os.environ.get('FRIEND_GRAPH_CACHE_TIMEOUT', 60))
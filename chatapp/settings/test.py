@@ -20,3 +20,9 @@ DATABASES = {
 
 # Config test runner
 TEST_RUNNER = 'django_nose.NoseTestSuiteRunner'
+
+CHANNEL_LAYERS = {
+    'default': {
+        'BACKEND': 'channels.layers.InMemoryChannelLayer',
+    },
+}
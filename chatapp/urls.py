@@ -18,7 +18,7 @@ from django.urls import path, include
 from django.conf import settings
 from django.conf.urls.static import static
 from rest_framework_swagger.views import get_swagger_view
-from . import routers
+from . import routers, views
 
 app_name = 'chatapp'
 schema_view = get_swagger_view(title='ChatApp API')
@@ -36,5 +36,8 @@ urlpatterns = [
 
     path('chat/', include('chat.urls')),
 
+    # Prometheus
+    path('metrics', views.metrics, name='metrics'),
+
 ] + static(settings.STATIC_URL, document_root=settings.STATIC_ROOT) \
               + static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT)
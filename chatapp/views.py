@@ -0,0 +1,32 @@
+import hmac
+from django.conf import settings
+from django.http import HttpResponse, HttpResponseForbidden
+from django.views.decorators.http import require_GET
+from .metrics import registry
+
+
+def can_read_metrics(request):
+    """
+    Staff users, or scrapers giving `Authorization: Bearer <METRICS_TOKEN>`
+    """
+
+    if request.user.is_staff:
+        return True
+
+    token = settings.METRICS_TOKEN
+    header = request.META.get('HTTP_AUTHORIZATION', '')
+
+    return bool(token) and hmac.compare_digest(header, f'Bearer {token}')
+
+
+@require_GET
+def metrics(request):
+    """
+    Metrics of this process in the Prometheus text format
+    """
+
+    if not can_read_metrics(request):
+        return HttpResponseForbidden()
+
+    return HttpResponse(registry.render(),
+                        content_type='text/plain; version=0.0.4; charset=utf-8')
@@ -1,8 +1,31 @@
-from django.urls import reverse
+import functools
+from asgiref.sync import async_to_sync, sync_to_async
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.core.cache import cache
+from django.db import connection
+from django.test import TransactionTestCase
+from django.test.utils import CaptureQueriesContext
+from django.urls import path, reverse
 from rest_framework.test import APITestCase
+from chat.consumers import ChatConsumer
+from chat.models import Room
+from chat.notifications import room_notifier
 from user.models import User
 
 
+def async_test(func):
+    """
+    Run an async test method in an event loop
+    """
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        return async_to_sync(func)(*args, **kwargs)
+
+    return wrapper
+
+
 class HelperAPITestCase(APITestCase):
 
     def setUp(self):
@@ -10,6 +33,9 @@ class HelperAPITestCase(APITestCase):
         Set up new normal and super users
         """
 
+        # Cached friend graph of users from previous tests
+        cache.clear()
+
         self.superuser_credentials = {
             'username': 'admin',
             'password': 'password'
@@ -56,6 +82,50 @@ class HelperAPITestCase(APITestCase):
             'HTTP_AUTHORIZATION': access_token
         }
 
+    def assertQueryBudget(self, budget, func, *args, **kwargs):
+        """
+        Call `func` and check it runs at most `budget` SQL queries. Log in
+        with `self.client.force_authenticate` first, so the login request
+        is not counted
+        :param budget: Maximum number of queries
+        :param func: Callable, e.g. `self.get`
+        :returns: Result of `func`
+        """
+
+        with CaptureQueriesContext(connection) as context:
+            result = func(*args, **kwargs)
+
+        queries = '\n'.join(query['sql'] for query in context.captured_queries)
+        self.assertLessEqual(
+            len(context), budget,
+            f'{len(context)} queries, budget is {budget}:\n{queries}')
+
+        return result
+
+    def assertQueriesDoNotGrow(self, budget, grow, func, *args, **kwargs):
+        """
+        Check `func` runs the same number of queries, within `budget`,
+        before and after `grow` adds items to the list it returns
+        :param budget: Maximum number of queries
+        :param grow: Callable adding items to the list
+        :param func: Callable, e.g. `self.get`
+        :returns: Result of the second call of `func`
+        """
+
+        with CaptureQueriesContext(connection) as before:
+            self.assertQueryBudget(budget, func, *args, **kwargs)
+
+        grow()
+
+        with CaptureQueriesContext(connection) as after:
+            result = self.assertQueryBudget(budget, func, *args, **kwargs)
+
+        self.assertEqual(
+            len(before), len(after),
+            'The number of queries grows with the size of the list.')
+
+        return result
+
 
     def get(self, resource, credentials=None, args=None, data=None):
         """
@@ -148,3 +218,68 @@ class HelperAPITestCase(APITestCase):
             format='json',
             **headers
         )
+
+
+class HelperConsumerTestCase(TransactionTestCase):
+    """
+    Consumers run their ORM work in other threads, so the data must be
+    committed instead of wrapped in a test transaction
+    """
+
+    def setUp(self):
+        """
+        Set up users and a room
+        """
+
+        # Drop room updates left by previous tests
+        room_notifier.flush()
+
+        self.user = User.objects.create_user(
+            'user', 'user@myproject.com', 'password')
+        self.user2 = User.objects.create_user(
+            'user2', 'user2@myproject.com', 'password')
+        self.user3 = User.objects.create_user(
+            'user3', 'user3@myproject.com', 'password')
+
+        self.room = Room.objects.create(
+            user=self.user,
+            label='test-room',
+            name='Test Room'
+        )
+        self.room.users.add(self.user, self.user2)
+
+    def get_application(self):
+        """
+        Websocket application without the session middleware
+        """
+
+        consumer = ChatConsumer
+        if hasattr(consumer, 'as_asgi'):
+            consumer = consumer.as_asgi()
+
+        return URLRouter([
+            path('ws/chat/', consumer),
+            path('ws/chat/<int:room>/', consumer),
+        ])
+
+    async def connect(self, user, room=None, path=None, subprotocols=None):
+        """
+        Open a websocket connection as `user`
+        :param user: User logged in
+        :param room: Room ID
+        :param subprotocols: Subprotocols offered by the client
+        :returns: Tuple of communicator and connected status
+        """
+
+        # Push the room updates of messages created before connecting now,
+        # the interval could otherwise deliver them in the middle of a test
+        await sync_to_async(room_notifier.flush)()
+
+        path = path or f'/ws/chat/{room or self.room.id}/'
+        communicator = WebsocketCommunicator(
+            self.get_application(), path, subprotocols=subprotocols)
+        communicator.scope['user'] = user
+
+        connected, self.subprotocol = await communicator.connect()
+
+        return communicator, connected
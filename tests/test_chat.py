@@ -1,5 +1,21 @@
+import datetime
+from io import StringIO
+from types import SimpleNamespace
+from django.core.management import call_command
+from django.db import connection
+from django.test import override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from rest_framework.exceptions import ValidationError
 from rest_framework.test import APITestCase
-from chat.models import Room, Message
+from chat.management.commands.check_query_plans import (
+    FULL_SCAN, TEMP_SORT, find_problems)
+from chat.metrics import MESSAGES_DROPPED
+from chat.models import ArchivedMessage, Room, Message
+from chat.serializers import RoomSerializer
+from chatapp import constants
+from chatapp.paginations import EstimatedCountPaginator
+from chat.writers import get_message_writer
 from user.models import Friend, User
 from .helpers import HelperAPITestCase
 
@@ -61,6 +77,72 @@ class ChatAPITest(HelperAPITestCase):
         self.assertEqual(response.status_code, 200)
         self.assertEqual(len(response.data['results']), 1)
 
+    def test_get_room_list_query_budget(self):
+        self.client.force_authenticate(self.normaluser)
+
+        def grow():
+            friends = User.objects.filter(pk__in=self.create_friends(3))
+
+            for i in range(3):
+                room = Room.objects.create(
+                    user=self.superuser, label=f'budget-{i}', name=f'Budget {i}')
+                room.users.add(self.normaluser, *friends)
+
+            self.room1.users.add(*friends)
+
+        # The ETag validator is one of them
+        response = self.assertQueriesDoNotGrow(4, grow, self.get, 'room-list')
+        self.assertEqual(len(response.data['results']), 4)
+        self.assertEqual(
+            {len(room['users']) for room in response.data['results']}, {4, 5})
+        self.assertIn('profile', response.data['results'][0]['user'])
+
+    def get_conditional(self, resource, etag, args=None, data=None):
+        return self.client.get(
+            reverse(resource, args=args), data=data, HTTP_IF_NONE_MATCH=etag)
+
+    def test_get_room_list_not_modified(self):
+        self.client.force_authenticate(self.normaluser)
+
+        response = self.get('room-list')
+        etag = response['ETag']
+        self.assertTrue(etag.startswith('W/'))
+        self.assertNotIn('Last-Modified', response)
+
+        # Dates alone never decide
+        response = self.client.get(
+            reverse('room-list'),
+            HTTP_IF_MODIFIED_SINCE='Fri, 01 Jan 2100 00:00:00 GMT')
+        self.assertEqual(response.status_code, 200)
+
+        # One aggregate query, nothing serialized
+        response = self.assertQueryBudget(
+            1, self.get_conditional, 'room-list', etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.content, b'')
+
+        # New message, renamed room, member profile edited, member removed
+        changes = [
+            lambda: get_message_writer().write(Message(
+                room=self.room1, user=self.normaluser, message='Changed')),
+            lambda: RoomSerializer().update(self.room1, {'name': 'Renamed'}),
+            lambda: self.superuser.profile.save(),
+            lambda: Room.objects.remove_users(self.room1.id, [self.superuser.id]),
+        ]
+
+        for change in changes:
+            change()
+
+            response = self.get_conditional('room-list', etag)
+            self.assertEqual(response.status_code, 200)
+            self.assertNotEqual(response['ETag'], etag)
+            etag = response['ETag']
+
+        # Another user never gets the copy of the first one
+        self.client.force_authenticate(self.superuser)
+        self.assertEqual(
+            self.get_conditional('room-list', etag).status_code, 200)
+
     def test_create_new_room_forbidden(self):
         response = self.post('room-list', {})
 
@@ -100,6 +182,71 @@ class ChatAPITest(HelperAPITestCase):
             'room-list', data, self.normaluser_credentials)
         self.assertEqual(response.status_code, 201)
 
+    def create_friends(self, count):
+        """
+        Create friends of the normal user
+        :returns: List of user ID
+        """
+
+        friends = []
+
+        for i in range(count):
+            friend = User.objects.create_user(
+                f'friend{i}', f'friend{i}@test.com', 'password')
+            Friend.objects.add_friend(self.normaluser, friend)
+            friends.append(friend.id)
+
+        return friends
+
+    def test_create_room_validation_queries(self):
+        request = SimpleNamespace(user=self.normaluser)
+        data = {'name': 'Test room', 'users': [self.user2.id]}
+
+        def validate():
+            serializer = RoomSerializer(data=data, context={'request': request})
+            self.assertTrue(serializer.is_valid(), serializer.errors)
+
+        self.assertQueriesDoNotGrow(
+            2, lambda: data['users'].extend(self.create_friends(7)), validate)
+
+    def test_create_room_not_friend(self):
+        data = {
+            'name': 'Test room',
+            'users': [self.user2.id, self.user3.id]
+        }
+
+        response = self.post(
+            'room-list', data, self.normaluser_credentials)
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.data['users'][0],
+                         'You do not add user is not your friend.')
+
+    def test_create_room_user_not_exist(self):
+        data = {
+            'name': 'Test room',
+            'users': [self.user2.id, 100]
+        }
+
+        response = self.post(
+            'room-list', data, self.normaluser_credentials)
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.data['users'][0],
+                         'Invalid pk "100" - object does not exist.')
+
+    def test_add_users_friendship_queries(self):
+        friends = self.create_friends(9)
+        room = Room.objects.create(
+            user=self.normaluser, label='friends-room', name='Friends')
+        room.users.add(self.normaluser)
+
+        with CaptureQueriesContext(connection) as queries:
+            Room.objects.add_users(self.normaluser, room.id, friends)
+
+        friendship = [query for query in queries.captured_queries
+                      if 'user_friend' in query['sql']]
+        self.assertEqual(len(friendship), 1)
+        self.assertEqual(room.users.count(), 10)
+
     def test_add_empty_user_to_room(self):
         data = {
             'users': ''
@@ -149,6 +296,67 @@ class ChatAPITest(HelperAPITestCase):
             'room-add-users', data, self.normaluser_credentials, [self.room1.id])
         self.assertEqual(response.status_code, 200)
 
+    def test_add_users_all_or_none(self):
+        data = {
+            'users': [self.user2.id, self.user3.id]
+        }
+        response = self.post(
+            'room-add-users', data, self.normaluser_credentials, [self.room1.id])
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.data['detail'],
+                         'You do not add user is not your friend.')
+        self.assertNotIn(self.user2, self.room1.users.all())
+
+    def test_add_users_queries(self):
+        friends = self.create_friends(7)
+        room = Room.objects.create(
+            user=self.normaluser, label='friends-room', name='Friends')
+        room.users.add(self.normaluser)
+
+        self.assertQueryBudget(
+            8, Room.objects.add_users, self.normaluser, room.id, friends)
+        self.assertEqual(room.users.count(), 8)
+
+    def test_add_users_maximum(self):
+        room = Room.objects.create(
+            user=self.normaluser, label='friends-room', name='Friends')
+        room.users.add(self.normaluser)
+        friends = self.create_friends(constants.ROOM_MAXIMUM_USERS)
+
+        with self.assertRaisesMessage(ValidationError, 'Maximum'):
+            Room.objects.add_users(self.normaluser, room.id, friends)
+
+        self.assertEqual(room.users.count(), 1)
+
+        # Up to the maximum
+        Room.objects.add_users(self.normaluser, room.id, friends[1:])
+        self.assertEqual(room.users.count(), constants.ROOM_MAXIMUM_USERS)
+
+    def test_create_room_maximum(self):
+        request = SimpleNamespace(user=self.normaluser)
+        friends = self.create_friends(constants.ROOM_MAXIMUM_USERS)
+
+        # The creator is a member too
+        for users, valid in ((friends[1:], True), (friends, False)):
+            serializer = RoomSerializer(
+                data={'name': 'Full room', 'users': users},
+                context={'request': request})
+            self.assertEqual(serializer.is_valid(), valid)
+
+        self.assertEqual(
+            serializer.errors['users'][0],
+            f'Maximum {constants.ROOM_MAXIMUM_USERS} users in a room.')
+
+    def test_remove_users_all_or_none(self):
+        data = {
+            'users': [self.superuser.id, self.user3.id]
+        }
+        response = self.delete(
+            'room-remove-users', data, self.normaluser_credentials,
+            [self.room1.id])
+        self.assertEqual(response.status_code, 400)
+        self.assertIn(self.superuser, self.room1.users.all())
+
     def test_remove_user_from_not_exist_room(self):
         data = {
             'users': []
@@ -214,6 +422,35 @@ class ChatAPITest(HelperAPITestCase):
             'message-list', self.normaluser_credentials, None, data)
         self.assertEqual(response.status_code, 200)
 
+    def test_get_messages_query_budget(self):
+        self.client.force_authenticate(self.normaluser)
+
+        def grow():
+            for user in (self.normaluser, self.superuser):
+                Message.objects.create(
+                    room=self.room1, user=user, message='Hello')
+
+        # The ETag validator is one of them
+        response = self.assertQueriesDoNotGrow(
+            6, grow, self.get, 'message-list', data={'room': self.room1.id})
+        self.assertEqual(len(response.data['results']), 3)
+
+    @override_settings(DEBUG=True)
+    def test_query_count_headers(self):
+        self.client.force_authenticate(self.normaluser)
+
+        response = self.get('message-list', data={'room': self.room1.id})
+
+        self.assertGreater(int(response['X-Query-Count']), 0)
+        self.assertIn('X-Query-Duration', response)
+
+    def test_no_query_count_headers_without_debug(self):
+        self.client.force_authenticate(self.normaluser)
+
+        response = self.get('message-list', data={'room': self.room1.id})
+
+        self.assertNotIn('X-Query-Count', response)
+
     def test_create_messages_not_join_room(self):
         data = {
             'room': self.room2.id,
@@ -241,3 +478,427 @@ class ChatAPITest(HelperAPITestCase):
             'message-list', data, self.normaluser_credentials)
         self.assertEqual(response.status_code, 201)
         self.assertEqual(response.data['message'], data['message'])
+
+    @override_settings(CHAT_MESSAGE_DURABILITY='buffered',
+                       CHAT_WRITE_BEHIND_INTERVAL=60000,
+                       CHAT_WRITE_BEHIND_BATCH_SIZE=1000)
+    def test_create_messages_buffered(self):
+        count = Message.objects.count()
+
+        for text in ('Hello', 'World'):
+            response = self.post(
+                'message-list', {'room': self.room1.id, 'message': text},
+                self.normaluser_credentials)
+            self.assertEqual(response.status_code, 201)
+            self.assertEqual(response.data['message'], text)
+            self.assertIsNone(response.data['id'])
+
+        self.assertEqual(Message.objects.count(), count)
+        self.assertEqual(get_message_writer().flush(), 2)
+        self.assertEqual(Message.objects.count(), count + 2)
+
+        room = Room.objects.get(pk=self.room1.id)
+        self.assertEqual(room.latest_message, 'World')
+        self.assertEqual(room.last_message.message, 'World')
+        self.assertEqual(room.last_message_id,
+                         Message.objects.filter(room=self.room1).latest('id').id)
+        self.assertEqual(room.last_sender, self.normaluser)
+
+    @override_settings(CHAT_MESSAGE_DURABILITY='buffered',
+                       CHAT_WRITE_BEHIND_INTERVAL=60000,
+                       CHAT_WRITE_BEHIND_BATCH_SIZE=1000)
+    def test_create_messages_buffered_bad_row(self):
+        writer = get_message_writer()
+        dropped = MESSAGES_DROPPED.get()
+        count = Message.objects.count()
+
+        writer.write(Message(room=self.room1, user=self.normaluser, message='One'))
+        writer.write(Message(room=self.room1, user=self.normaluser, message=None))
+        writer.write(Message(room=self.room2, user=self.user2, message='Two'))
+
+        with self.assertLogs('chat.writers', 'WARNING'):
+            writer.flush()
+
+        # Only the bad row is lost
+        self.assertEqual(Message.objects.count(), count + 2)
+        self.assertEqual(MESSAGES_DROPPED.get(), dropped + 1)
+        self.assertEqual(Room.objects.get(pk=self.room1.id).latest_message, 'One')
+        self.assertEqual(Room.objects.get(pk=self.room2.id).latest_message, 'Two')
+
+    def test_latest_message_pointer(self):
+        message = Message.objects.create(
+            room=self.room1, user=self.superuser, message='Latest')
+
+        room = Room.objects.get(pk=self.room1.id)
+        self.assertEqual(room.latest_message, 'Latest')
+        self.assertEqual(room.last_message_id, message.id)
+        self.assertEqual(room.last_sender_id, self.superuser.id)
+        self.assertEqual(room.updated, message.created)
+
+        self.client.force_authenticate(self.normaluser)
+        response = self.get('room-detail', args=[self.room1.id])
+        self.assertEqual(response.data['last_message'], message.id)
+        self.assertEqual(response.data['last_sender'], self.superuser.id)
+
+    def test_latest_message_does_not_regress(self):
+        latest = Message.objects.create(
+            room=self.room1, user=self.superuser, message='Latest')
+
+        # A slower sender committing an older message
+        older = Message(id=latest.id - 1, room=self.room1, user=self.normaluser,
+                        message='Older', created=latest.created)
+        self.assertFalse(Room.objects.set_latest_message(older))
+
+        older.created = latest.created - datetime.timedelta(seconds=1)
+        older.id = latest.id + 1
+        self.assertFalse(Room.objects.set_latest_message(older))
+
+        room = Room.objects.get(pk=self.room1.id)
+        self.assertEqual(room.last_message_id, latest.id)
+        self.assertEqual(room.latest_message, 'Latest')
+
+    def test_query_plans_use_indexes(self):
+        out = StringIO()
+        call_command('check_query_plans', current_database=True, stdout=out)
+        self.assertNotIn('FAIL', out.getvalue())
+
+    def test_query_plan_problems(self):
+        plan = '2 0 0 SCAN chat_message\n9 0 0 USE TEMP B-TREE FOR ORDER BY'
+
+        self.assertEqual(
+            [problem for problem, line in find_problems(plan, 'sqlite')],
+            [FULL_SCAN, TEMP_SORT])
+        self.assertEqual(find_problems(
+            '6 0 0 SEARCH chat_message USING INDEX chat_message_room_id_idx '
+            '(room_id=?)', 'sqlite'), [])
+
+    def archive_old_messages(self, count):
+        """
+        Create `count` messages in room 1 dated last year and archive them
+        """
+
+        old = [Message.objects.create(room=self.room1, user=self.normaluser,
+                                      message=f'Old {i}') for i in range(count)]
+        Message.objects.filter(id__in=[message.id for message in old]).update(
+            created=datetime.datetime(2000, 1, 1, tzinfo=datetime.timezone.utc))
+
+        Message.objects.create(room=self.room1, user=self.superuser, message='New')
+
+        out = StringIO()
+        call_command('archive_messages', days=30, stdout=out)
+        return old, out.getvalue()
+
+    def follow_keyset_pages(self, resource, data):
+        """
+        Get every keyset page of a list
+        :returns: (list of the pages results, last response)
+        """
+
+        response = self.get(resource, data={'pagination': 'cursor', **data})
+        pages = [response.data['results']]
+
+        while response.data['links']['next']:
+            response = self.client.get(response.data['links']['next'])
+            pages.append(response.data['results'])
+
+        return pages, response
+
+    def test_messages_keyset_pages(self):
+        self.archive_old_messages(12)
+        self.client.force_authenticate(self.normaluser)
+
+        pages, response = self.follow_keyset_pages(
+            'message-list', {'room': self.room1.id, 'count': 'true'})
+
+        rows = sorted(
+            list(Message.objects.filter(room=self.room1).values('id', 'created'))
+            + list(ArchivedMessage.objects.filter(
+                room=self.room1).values('id', 'created')),
+            key=lambda row: (row['created'], row['id']), reverse=True)
+
+        self.assertEqual([len(page) for page in pages], [10, 4])
+        self.assertEqual([message['id'] for page in pages for message in page],
+                         [row['id'] for row in rows])
+        self.assertNotIn('count', response.data)
+
+        # Back to the first page
+        response = self.client.get(response.data['links']['prev'])
+        self.assertEqual(response.data['results'], pages[0])
+        self.assertIsNone(response.data['links']['prev'])
+
+    def test_messages_keyset_count(self):
+        self.client.force_authenticate(self.normaluser)
+
+        response = self.get('message-list', data={
+            'room': self.room1.id, 'pagination': 'cursor', 'count': 'true'})
+        self.assertEqual(response.data['count'],
+                         Message.objects.filter(room=self.room1).count())
+        self.assertNotIn('total_pages', response.data)
+
+    def test_get_messages_not_modified(self):
+        self.client.force_authenticate(self.normaluser)
+        data = {'room': self.room1.id}
+
+        etag = self.get('message-list', data=data)['ETag']
+
+        response = self.assertQueryBudget(
+            1, self.get_conditional, 'message-list', etag, data=data)
+        self.assertEqual(response.status_code, 304)
+
+        # Another page of the same room
+        response = self.get_conditional(
+            'message-list', etag, data={'room': self.room1.id, 'page': 2})
+        self.assertNotEqual(response.status_code, 304)
+
+        message = get_message_writer().write(Message(
+            room=self.room1, user=self.normaluser, message='New'))
+        response = self.get_conditional('message-list', etag, data=data)
+        self.assertEqual(response.status_code, 200)
+        etag = response['ETag']
+
+        # Edited and deleted messages do not move the latest message
+        for request in (
+                lambda: self.client.patch(
+                    reverse('message-detail', args=[message.id]),
+                    {'message': 'Edited'}, format='json'),
+                lambda: self.client.delete(
+                    reverse('message-detail', args=[message.id]))):
+            request()
+
+            response = self.get_conditional('message-list', etag, data=data)
+            self.assertEqual(response.status_code, 200)
+            etag = response['ETag']
+
+        # Pages show the name of the sender
+        self.normaluser.first_name = 'Renamed'
+        self.normaluser.save()
+
+        response = self.get_conditional('message-list', etag, data=data)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['results'][0]['user']['full_name'],
+                         'Renamed')
+
+    def test_get_messages_not_modified_former_sender(self):
+        Message.objects.create(room=self.room1, user=self.user3, message='Bye')
+        ArchivedMessage.objects.create(
+            id=10000, room=self.room1, user=self.user2, message='Old',
+            created=datetime.datetime(2000, 1, 1, tzinfo=datetime.timezone.utc))
+        self.client.force_authenticate(self.normaluser)
+        data = {'room': self.room1.id}
+
+        # Neither of them is a member of the room
+        for sender in (self.user3, self.user2):
+            etag = self.get('message-list', data=data)['ETag']
+
+            sender.first_name = 'Renamed'
+            sender.save()
+
+            response = self.get_conditional('message-list', etag, data=data)
+            self.assertEqual(response.status_code, 200)
+
+        # Other fields leave the rooms as they are
+        etag = response['ETag']
+        self.user3.is_online = True
+        self.user3.save()
+
+        response = self.get_conditional('message-list', etag, data=data)
+        self.assertEqual(response.status_code, 304)
+
+    def test_get_messages_not_modified_not_member(self):
+        self.client.force_authenticate(self.normaluser)
+
+        response = self.get_conditional(
+            'message-list', '*', data={'room': self.room2.id})
+        self.assertEqual(response.status_code, 400)
+
+    def test_keyset_invalid_cursor(self):
+        self.client.force_authenticate(self.normaluser)
+
+        response = self.get('message-list', data={
+            'room': self.room1.id, 'cursor': 'invalid'})
+        self.assertEqual(response.status_code, 404)
+
+    def test_rooms_keyset_pages(self):
+        for i in range(15):
+            room = Room.objects.create(
+                user=self.normaluser, label=f'keyset-{i}', name=f'Keyset {i}')
+            room.users.add(self.normaluser)
+
+        # Same updated date for all of them, ordered by ID
+        Room.objects.update(
+            updated=datetime.datetime(2000, 1, 1, tzinfo=datetime.timezone.utc))
+        self.client.force_authenticate(self.normaluser)
+
+        pages, response = self.follow_keyset_pages('room-list', {})
+
+        self.assertEqual(
+            [room['id'] for page in pages for room in page],
+            list(Room.objects.rooms(self.normaluser).order_by(
+                '-id').values_list('id', flat=True)))
+
+    def analyze(self):
+        """
+        Update the planner statistics
+        """
+
+        with connection.cursor() as cursor:
+            cursor.execute('ANALYZE')
+
+    @override_settings(PAGINATION_COUNT_THRESHOLD=2)
+    def test_admin_estimated_count(self):
+        for i in range(5):
+            Message.objects.create(room=self.room1, user=self.normaluser,
+                                   message=f'Message {i}')
+
+        self.client.force_login(self.superuser)
+        response = self.client.get(reverse('admin:chat_message_changelist'))
+        self.assertFalse(response.context['cl'].paginator.approximate)
+
+        self.analyze()
+        response = self.client.get(reverse('admin:chat_message_changelist'))
+
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.context['cl'].paginator.approximate)
+        self.assertEqual(response.context['cl'].result_count,
+                         Message.objects.count())
+
+        for url in (reverse('admin:chat_room_changelist'),
+                    reverse('admin:user_friend_changelist'),
+                    reverse('admin:chat_room_change', args=[self.room1.id])):
+            self.assertEqual(self.client.get(url).status_code, 200)
+
+    @override_settings(PAGINATION_COUNT_THRESHOLD=2)
+    def test_estimated_count_filtered(self):
+        self.analyze()
+
+        # SQLite has no estimate for a filtered query, it is counted
+        paginator = EstimatedCountPaginator(
+            User.objects.filter(is_superuser=False), 10)
+        self.assertEqual(paginator.count, 3)
+        self.assertFalse(paginator.approximate)
+
+        # Exact under the threshold, whatever the statistics say
+        User.objects.exclude(pk=self.normaluser.pk).delete()
+        paginator = EstimatedCountPaginator(User.objects.all(), 10)
+        self.assertEqual(paginator.count, 1)
+        self.assertFalse(paginator.approximate)
+
+    def test_archive_messages(self):
+        old, out = self.archive_old_messages(3)
+
+        self.assertEqual(out.strip(), '3 messages archived.')
+        self.assertFalse(Message.objects.filter(message__startswith='Old').exists())
+
+        archived = ArchivedMessage.objects.get(pk=old[0].id)
+        self.assertEqual(archived.message, 'Old 0')
+        self.assertEqual(archived.created.year, 2000)
+
+        # Nothing left to archive
+        self.assertEqual(self.archive_old_messages(0)[1].strip(),
+                         '0 messages archived.')
+
+    def test_archive_keeps_latest_message(self):
+        message = Message.objects.create(
+            room=self.room1, user=self.normaluser, message='Only')
+        Message.objects.filter(room=self.room1).update(
+            created=datetime.datetime(2000, 1, 1, tzinfo=datetime.timezone.utc))
+
+        call_command('archive_messages', days=30, stdout=StringIO())
+
+        self.assertTrue(Message.objects.filter(pk=message.id).exists())
+        self.assertEqual(Room.objects.get(pk=self.room1.id).last_message_id,
+                         message.id)
+
+    def test_get_messages_from_archive(self):
+        old, _ = self.archive_old_messages(12)
+        self.client.force_authenticate(self.normaluser)
+
+        response = self.get('message-list', data={'room': self.room1.id})
+        self.assertEqual(response.data['count'], 14)
+        self.assertEqual(response.data['results'][0]['message'], 'New')
+
+        response = self.get('message-list', data={'room': self.room1.id, 'page': 2})
+        self.assertEqual([message['message'] for message in response.data['results']],
+                         ['Old 3', 'Old 2', 'Old 1', 'Old 0'])
+
+        response = self.get('message-list',
+                            data={'room': self.room1.id, 'search': 'Old 1'})
+        self.assertEqual([message['message'] for message in response.data['results']],
+                         ['Old 11', 'Old 10', 'Old 1'])
+
+    def test_history_across_archive(self):
+        old, _ = self.archive_old_messages(5)
+        new = Message.objects.get(message='New')
+
+        messages = Message.objects.history_before(self.room1.id, new.id, 4)
+        self.assertEqual([message.message for message in messages],
+                         ['Old 4', 'Old 3', 'Old 2', 'Old 1'])
+
+        messages = Message.objects.history_after(self.room1.id, old[2].id, 10)
+        self.assertEqual([message.message for message in messages],
+                         ['Old 3', 'Old 4', 'New'])
+
+    def search(self, **data):
+        self.client.force_authenticate(self.normaluser)
+        return self.get('message-search', data=data)
+
+    def test_search_messages(self):
+        Message.objects.create(room=self.room1, user=self.superuser,
+                               message='Lunch <b>today</b> at noon?')
+        Message.objects.create(room=self.room1, user=self.normaluser,
+                               message='Lunch lunch lunch')
+        Message.objects.create(room=self.room1, user=self.normaluser,
+                               message='Dinner')
+
+        # Room 2 is not a room of the user
+        Message.objects.create(room=self.room2, user=self.user2,
+                               message='Lunch secret')
+
+        response = self.search(q='lunch')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([item['message'] for item in response.data['results']],
+                         ['Lunch lunch lunch', 'Lunch <b>today</b> at noon?'])
+        self.assertEqual(response.data['results'][1]['snippet'],
+                         '<mark>Lunch</mark> &lt;b&gt;today&lt;/b&gt; at noon?')
+        self.assertIsNone(response.data['next'])
+
+        # The last word is a prefix while typing
+        response = self.search(q='lunch to')
+        self.assertEqual(len(response.data['results']), 1)
+
+    def test_search_messages_pages(self):
+        for i in range(5):
+            Message.objects.create(room=self.room1, user=self.normaluser,
+                                   message=f'Page {i}')
+
+        response = self.search(q='page', limit=2)
+        ids = [item['id'] for item in response.data['results']]
+
+        while response.data['next']:
+            response = self.search(q='page', limit=2, cursor=response.data['next'])
+            ids += [item['id'] for item in response.data['results']]
+
+        self.assertEqual(len(ids), 5)
+        self.assertEqual(len(set(ids)), 5)
+
+    def test_search_follows_edits_and_archive(self):
+        message = Message.objects.create(
+            room=self.room1, user=self.normaluser, message='Typo')
+
+        message.message = 'Fixed'
+        message.save()
+        self.assertEqual(len(self.search(q='typo').data['results']), 0)
+        self.assertEqual(len(self.search(q='fixed').data['results']), 1)
+
+        self.archive_old_messages(1)
+        response = self.search(q='old', room=self.room1.id)
+        self.assertEqual([item['message'] for item in response.data['results']],
+                         ['Old 0'])
+
+        message.delete()
+        self.assertEqual(len(self.search(q='fixed').data['results']), 0)
+
+    def test_search_messages_invalid(self):
+        self.assertEqual(self.search(q='  ').status_code, 400)
+        self.assertEqual(self.search(q='hi', cursor='bad').status_code, 400)
+        self.assertEqual(self.search(q='hi', room='x').status_code, 400)
@@ -0,0 +1,522 @@
+from unittest import mock
+from asgiref.sync import async_to_sync, sync_to_async
+from django.contrib.auth.models import AnonymousUser
+from django.db import OperationalError
+from django.test import override_settings
+from chat.executors import DatabaseExecutor, db_executor
+from chat.metrics import (
+    COMMAND_SECONDS, DB_SECONDS, FRAMES_RECEIVED, ROOM_CONNECTIONS)
+from chat.models import Message, Room
+from chat.notifications import room_notifier
+from chat.protocols import CompactProtocol
+from chat.writers import get_message_writer
+from chatapp import constants
+from user.models import Friend
+from .helpers import HelperConsumerTestCase, async_test
+
+
+class ChatConsumerTest(HelperConsumerTestCase):
+    """
+    Chat consumer test cases
+    """
+
+    @async_test
+    async def test_connect_require_login(self):
+        communicator, connected = await self.connect(AnonymousUser())
+        self.assertTrue(connected)
+
+        response = await communicator.receive_json_from()
+        self.assertEqual(response['command'], 'error_message')
+        self.assertEqual(response['message'], 'Require login.')
+        self.assertEqual((await communicator.receive_output())['type'],
+                         'websocket.close')
+
+    @async_test
+    async def test_connect_user_not_in_room(self):
+        communicator, connected = await self.connect(self.user3)
+
+        response = await communicator.receive_json_from()
+        self.assertEqual(response['message'], 'User is not in this room.')
+        self.assertEqual((await communicator.receive_output())['type'],
+                         'websocket.close')
+
+    @async_test
+    async def test_connect_room_not_exist(self):
+        communicator, connected = await self.connect(self.user, room=100)
+
+        response = await communicator.receive_json_from()
+        self.assertEqual(response['message'],
+                         'Room matching query does not exist.')
+
+    @async_test
+    async def test_fetch_data_ok(self):
+        Message.objects.create(room=self.room, user=self.user2, message='Hi')
+
+        communicator, connected = await self.connect(self.user)
+        self.assertTrue(connected)
+
+        await communicator.send_json_to({'command': 'fetch_data'})
+        response = await communicator.receive_json_from()
+
+        self.assertEqual(response['command'], 'fetch_data')
+        self.assertEqual(len(response['messages']), 1)
+        self.assertEqual(response['messages'][0]['message'], 'Hi')
+        self.assertEqual(response['room']['pk'], self.room.id)
+        self.assertEqual(len(response['room_users']), 2)
+
+        await communicator.disconnect()
+
+    @async_test
+    async def test_fetch_data_resume(self):
+        messages = [
+            Message.objects.create(room=self.room, user=self.user, message=str(i))
+            for i in range(4)
+        ]
+
+        communicator, _ = await self.connect(self.user)
+        await communicator.send_json_to({
+            'command': 'fetch_data',
+            'last_seen_message_id': messages[1].id,
+        })
+        response = await communicator.receive_json_from()
+
+        self.assertTrue(response['resumed'])
+        self.assertEqual([m['id'] for m in response['messages']],
+                         [messages[2].id, messages[3].id])
+        self.assertNotIn('room', response)
+
+        # Gap over the limit falls back to a full snapshot
+        with mock.patch.object(constants, 'MESSAGE_RESUME_MAXIMUM', 1):
+            await communicator.send_json_to({
+                'command': 'fetch_data',
+                'last_seen_message_id': messages[1].id,
+            })
+            response = await communicator.receive_json_from()
+
+        self.assertFalse(response['resumed'])
+        self.assertEqual(len(response['messages']), 4)
+        self.assertEqual(response['room']['pk'], self.room.id)
+
+        await communicator.disconnect()
+
+    @async_test
+    async def test_fetch_data_resume_from_query_string(self):
+        message = Message.objects.create(
+            room=self.room, user=self.user, message='Seen')
+
+        communicator, _ = await self.connect(
+            self.user,
+            path=f'/ws/chat/{self.room.id}/?last_seen_message_id={message.id}')
+
+        await communicator.send_json_to({'command': 'fetch_data'})
+        response = await communicator.receive_json_from()
+
+        self.assertTrue(response['resumed'])
+        self.assertEqual(response['messages'], [])
+
+        # Only the first fetch resumes
+        await communicator.send_json_to({'command': 'fetch_data'})
+        response = await communicator.receive_json_from()
+
+        self.assertNotIn('resumed', response)
+        self.assertEqual(len(response['messages']), 1)
+
+        await communicator.disconnect()
+
+    @async_test
+    async def test_fetch_before_streams_chunks(self):
+        messages = [
+            Message.objects.create(room=self.room, user=self.user, message=str(i))
+            for i in range(constants.MESSAGE_CHUNK_SIZE + 10)
+        ]
+
+        communicator, _ = await self.connect(self.user)
+        await communicator.send_json_to({
+            'command': 'fetch_before',
+            'message_id': messages[-1].id,
+            'limit': constants.MESSAGE_CHUNK_SIZE + 5,
+        })
+
+        first = await communicator.receive_json_from()
+        second = await communicator.receive_json_from()
+
+        self.assertEqual(first['command'], 'fetch_before')
+        self.assertEqual(len(first['messages']), constants.MESSAGE_CHUNK_SIZE)
+        self.assertFalse(first['done'])
+        self.assertEqual(first['messages'][-1]['id'], messages[-2].id)
+        self.assertEqual(first['cursor'], first['messages'][0]['id'])
+
+        self.assertEqual(len(second['messages']), 5)
+        self.assertTrue(second['done'])
+        self.assertTrue(second['has_more'])
+        self.assertEqual(second['messages'][-1]['id'] + 1,
+                         first['messages'][0]['id'])
+
+        await communicator.disconnect()
+
+    @async_test
+    async def test_fetch_after(self):
+        messages = [
+            Message.objects.create(room=self.room, user=self.user, message=str(i))
+            for i in range(3)
+        ]
+
+        communicator, _ = await self.connect(self.user)
+        await communicator.send_json_to({
+            'command': 'fetch_after',
+            'message_id': messages[0].id,
+        })
+        response = await communicator.receive_json_from()
+
+        self.assertEqual([m['id'] for m in response['messages']],
+                         [messages[1].id, messages[2].id])
+        self.assertTrue(response['done'])
+        self.assertFalse(response['has_more'])
+        self.assertEqual(response['cursor'], messages[2].id)
+
+        await communicator.send_json_to({'command': 'fetch_after'})
+        response = await communicator.receive_json_from()
+        self.assertEqual(response['message'], 'Message ID is require.')
+
+        await communicator.disconnect()
+
+    @async_test
+    async def test_new_message_broadcast(self):
+        sender, _ = await self.connect(self.user)
+        receiver, _ = await self.connect(self.user2)
+
+        await sender.send_json_to({'command': 'new_message', 'message': 'Hello'})
+
+        for communicator in (sender, receiver):
+            response = await communicator.receive_json_from()
+            self.assertEqual(response['command'], 'new_message')
+            self.assertEqual(response['message']['message'], 'Hello')
+            self.assertEqual(response['message']['user']['id'], self.user.id)
+
+        self.assertEqual(Message.objects.filter(room=self.room).count(), 1)
+
+        await sender.disconnect()
+        await receiver.disconnect()
+
+    @override_settings(CHAT_MESSAGE_DURABILITY='buffered',
+                       CHAT_WRITE_BEHIND_INTERVAL=60000,
+                       CHAT_WRITE_BEHIND_BATCH_SIZE=1000)
+    def test_new_message_buffered(self):
+
+        async def send():
+            sender, _ = await self.connect(self.user)
+            await sender.send_json_to(
+                {'command': 'new_message', 'message': 'Hello'})
+            response = await sender.receive_json_from()
+            await sender.disconnect()
+            return response
+
+        response = async_to_sync(send)()
+
+        self.assertEqual(response['message']['message'], 'Hello')
+        self.assertIsNotNone(response['message']['created'])
+        self.assertFalse(Message.objects.filter(room=self.room).exists())
+
+        get_message_writer().flush()
+
+        self.assertEqual(Message.objects.filter(room=self.room).count(), 1)
+        self.assertEqual(Room.objects.get(pk=self.room.id).latest_message,
+                         'Hello')
+
+    @override_settings(CHAT_MESSAGE_DURABILITY='buffered',
+                       CHAT_WRITE_BEHIND_INTERVAL=60000,
+                       CHAT_WRITE_BEHIND_BATCH_SIZE=1000)
+    def test_buffered_messages_no_cursors(self):
+        messages = [
+            Message.objects.create(room=self.room, user=self.user, message=str(i))
+            for i in range(3)
+        ]
+
+        async def fetch():
+            communicator, _ = await self.connect(self.user)
+            responses = []
+
+            for command in (
+                    {'command': 'fetch_data',
+                     'last_seen_message_id': messages[0].id},
+                    {'command': 'fetch_after', 'message_id': messages[0].id},
+                    {'command': 'fetch_before'}):
+                await communicator.send_json_to(command)
+                responses.append(await communicator.receive_json_from())
+
+            await communicator.disconnect()
+            return responses
+
+        snapshot, after, before = async_to_sync(fetch)()
+
+        # Full snapshot instead of resuming
+        self.assertFalse(snapshot['resumed'])
+        self.assertEqual(len(snapshot['messages']), 3)
+        self.assertEqual(snapshot['room']['pk'], self.room.id)
+
+        for response in (after, before):
+            self.assertEqual(response['command'], 'error_message')
+            self.assertEqual(
+                response['message'],
+                'Message history is not available with buffered messages.')
+
+    @async_test
+    async def test_multiplex_subscribe(self):
+        room2 = Room.objects.create(user=self.user, label='room-2', name='Room 2')
+        room2.users.add(self.user, self.user3)
+        room3 = Room.objects.create(user=self.user2, label='room-3', name='Room 3')
+
+        communicator, connected = await self.connect(self.user, path='/ws/chat/')
+        self.assertTrue(connected)
+
+        await communicator.send_json_to({
+            'command': 'subscribe',
+            'rooms': [self.room.id, room2.id, room3.id, 100],
+        })
+
+        errors = [await communicator.receive_json_from() for _ in range(2)]
+        self.assertEqual(
+            {(error['room_id'], error['message']) for error in errors},
+            {(room3.id, 'User is not in this room.'),
+             (100, 'Room matching query does not exist.')})
+
+        response = await communicator.receive_json_from()
+        self.assertEqual(response['command'], 'subscribe')
+        self.assertEqual(sorted(response['rooms']), sorted([self.room.id, room2.id]))
+
+        # Commands must give the room
+        await communicator.send_json_to({'command': 'fetch_data'})
+        response = await communicator.receive_json_from()
+        self.assertEqual(response['message'], 'Room is not subscribed.')
+
+        other, _ = await self.connect(self.user3, room=room2.id)
+
+        await communicator.send_json_to({
+            'command': 'new_message', 'room_id': room2.id, 'message': 'Hi'})
+
+        for client in (communicator, other):
+            response = await client.receive_json_from()
+            self.assertEqual(response['room_id'], room2.id)
+            self.assertEqual(response['message']['message'], 'Hi')
+
+        await communicator.send_json_to({
+            'command': 'unsubscribe', 'rooms': [room2.id]})
+        response = await communicator.receive_json_from()
+        self.assertEqual(response['rooms'], [self.room.id])
+
+        await other.send_json_to({'command': 'new_message', 'message': 'Bye'})
+        await other.receive_json_from()
+
+        # Only the room list updates are still received
+        while not await communicator.receive_nothing():
+            response = await communicator.receive_json_from()
+            self.assertEqual(response['command'], 'room_updated')
+
+        await communicator.disconnect()
+        await other.disconnect()
+
+    @async_test
+    async def test_room_updated_pushed_to_members(self):
+        member, _ = await self.connect(self.user2, path='/ws/chat/')
+        other, _ = await self.connect(self.user3, path='/ws/chat/')
+
+        Message.objects.create(room=self.room, user=self.user, message='First')
+        Message.objects.create(room=self.room, user=self.user, message='Second')
+        await sync_to_async(room_notifier.flush)()
+
+        response = await member.receive_json_from()
+        self.assertEqual(response['command'], 'room_updated')
+        self.assertEqual(response['room_id'], self.room.id)
+        self.assertEqual(response['latest_message'], 'Second')
+        self.assertIsNotNone(response['updated'])
+
+        # One push for the burst, none for users out of the room
+        self.assertTrue(await member.receive_nothing())
+        self.assertTrue(await other.receive_nothing())
+
+        await member.disconnect()
+        await other.disconnect()
+
+    @async_test
+    async def test_members_changed(self):
+        Friend.objects.add_friend(self.user, self.user3)
+        communicator, _ = await self.connect(self.user)
+        member, _ = await self.connect(self.user2)
+
+        await sync_to_async(Room.objects.add_users)(
+            self.user, self.room.id, [self.user3.id])
+
+        response = await communicator.receive_json_from()
+        self.assertEqual(response['command'], 'members_changed')
+        self.assertEqual(response['added'], [self.user3.id])
+        self.assertEqual(response['removed'], [])
+        await member.receive_json_from()
+
+        # Room users are reloaded
+        await communicator.send_json_to({'command': 'fetch_data'})
+        response = await communicator.receive_json_from()
+        self.assertEqual(len(response['room_users']), 3)
+
+        await sync_to_async(Room.objects.remove_users)(
+            self.room.id, [self.user2.id])
+
+        response = await member.receive_json_from()
+        self.assertEqual(response['removed'], [self.user2.id])
+        await communicator.receive_json_from()
+
+        # Removed member leaves the room
+        await member.send_json_to({'command': 'fetch_data'})
+        response = await member.receive_json_from()
+        self.assertEqual(response['message'], 'Room is not subscribed.')
+
+        await communicator.disconnect()
+        await member.disconnect()
+
+    @async_test
+    async def test_compact_protocol(self):
+        protocol = CompactProtocol()
+        communicator, _ = await self.connect(
+            self.user, subprotocols=['unknown', protocol.subprotocol])
+
+        self.assertEqual(self.subprotocol, protocol.subprotocol)
+
+        await communicator.send_to(
+            bytes_data=protocol.encode({'command': 'fetch_data'}))
+        response = await communicator.receive_from()
+
+        self.assertIsInstance(response, bytes)
+        self.assertIn(b'fetch_data', response)
+        self.assertNotIn(b'command', response)
+
+        response = protocol.decode(bytes_data=response)
+        self.assertEqual(response['room']['name'], self.room.name)
+        self.assertEqual(len(response['room_users']), 2)
+
+        # The room is left out when the client has the latest version
+        await communicator.send_to(bytes_data=protocol.encode({
+            'command': 'fetch_data',
+            'room_version': response['room_version'],
+        }))
+        response = protocol.decode(bytes_data=await communicator.receive_from())
+
+        self.assertNotIn('room', response)
+        self.assertNotIn('room_users', response)
+
+        await communicator.send_to(bytes_data=protocol.encode(
+            {'command': 'new_message', 'message': 'Hello'}))
+        response = protocol.decode(bytes_data=await communicator.receive_from())
+
+        self.assertEqual(response['message']['message'], 'Hello')
+        self.assertEqual(response['message']['user']['username'],
+                         self.user.username)
+
+        await communicator.disconnect()
+
+    @async_test
+    async def test_json_protocol_by_default(self):
+        communicator, _ = await self.connect(self.user, subprotocols=['unknown'])
+
+        self.assertIsNone(self.subprotocol)
+
+        await communicator.send_json_to({'command': 'fetch_data'})
+        response = await communicator.receive_json_from()
+
+        self.assertEqual(response['room']['pk'], self.room.id)
+
+        await communicator.disconnect()
+
+    @async_test
+    async def test_new_message_empty(self):
+        communicator, _ = await self.connect(self.user)
+
+        await communicator.send_json_to({'command': 'new_message', 'message': ''})
+        response = await communicator.receive_json_from()
+
+        self.assertEqual(response['command'], 'error_message')
+        self.assertEqual(response['message'], 'Message content is require.')
+
+        await communicator.disconnect()
+
+    @async_test
+    async def test_new_message_write_failed(self):
+        communicator, _ = await self.connect(self.user)
+
+        with mock.patch.object(Message, 'save',
+                               side_effect=OperationalError('database is locked')):
+            await communicator.send_json_to(
+                {'command': 'new_message', 'message': 'Hello'})
+            response = await communicator.receive_json_from()
+
+        self.assertEqual(response['command'], 'error_message')
+        self.assertEqual(response['message'], 'Message could not be stored.')
+
+        # The socket still serves commands
+        await communicator.send_json_to({'command': 'new_message', 'message': 'Hi'})
+        response = await communicator.receive_json_from()
+        self.assertEqual(response['command'], 'new_message')
+
+        await communicator.disconnect()
+
+    @async_test
+    async def test_unknown_command(self):
+        communicator, _ = await self.connect(self.user)
+
+        await communicator.send_json_to({'command': 'unknown'})
+        response = await communicator.receive_json_from()
+
+        self.assertEqual(response['message'], 'Command is not supported.')
+
+        await communicator.disconnect()
+
+    @async_test
+    async def test_command_metrics(self):
+        count, _ = COMMAND_SECONDS.get(command='fetch_data')
+        db_count, _ = DB_SECONDS.get(operation='get_room_data')
+        frames = FRAMES_RECEIVED.get(protocol='json')
+
+        communicator, connected = await self.connect(self.user)
+        self.assertEqual(ROOM_CONNECTIONS.get(room=self.room.id), 1)
+
+        await communicator.send_json_to({'command': 'fetch_data'})
+        await communicator.receive_json_from()
+
+        self.assertEqual(COMMAND_SECONDS.get(command='fetch_data')[0], count + 1)
+        self.assertEqual(DB_SECONDS.get(operation='get_room_data')[0], db_count + 1)
+        self.assertEqual(FRAMES_RECEIVED.get(protocol='json'), frames + 1)
+
+        await communicator.disconnect()
+        self.assertEqual(ROOM_CONNECTIONS.get(room=self.room.id), 0)
+
+    @override_settings(DEBUG=True)
+    @async_test
+    async def test_command_query_count_logged(self):
+        communicator, connected = await self.connect(self.user)
+
+        with self.assertLogs('chat.consumers', 'DEBUG') as logs:
+            await communicator.send_json_to({'command': 'fetch_data'})
+            await communicator.receive_json_from()
+
+        self.assertRegex(logs.output[0], r'fetch_data: [1-9]\d* queries in')
+
+    @async_test
+    async def test_db_executor_metrics(self):
+        submitted = db_executor.metrics()['submitted']
+
+        communicator, _ = await self.connect(self.user)
+        await communicator.send_json_to({'command': 'fetch_data'})
+        await communicator.receive_json_from()
+
+        metrics = db_executor.metrics()
+        self.assertGreater(metrics['submitted'], submitted)
+        self.assertEqual(metrics['pending'], 0)
+
+        await communicator.disconnect()
+
+    def test_db_executor_size(self):
+        executor = DatabaseExecutor(max_workers=2)
+
+        self.assertEqual(executor.max_workers, 2)
+        self.assertEqual(async_to_sync(executor.run)(sum, [1, 2]), 3)
+        self.assertEqual(executor.metrics()['completed'], 1)
+
+        executor.shutdown()
@@ -0,0 +1,84 @@
+from django.test import SimpleTestCase, override_settings
+from django.urls import reverse
+from chatapp.metrics import Registry
+
+
+class MetricsTest(SimpleTestCase):
+    """
+    Metric registry test cases
+    """
+
+    def setUp(self):
+        self.registry = Registry()
+
+    def test_counter(self):
+        counter = self.registry.counter('frames_total', 'Frames.', ['protocol'])
+        counter.inc(protocol='json')
+        counter.inc(2, protocol='json')
+
+        self.assertEqual(counter.get(protocol='json'), 3)
+        self.assertIn('# TYPE frames_total counter', self.registry.render())
+        self.assertIn('frames_total{protocol="json"} 3', self.registry.render())
+
+    def test_counter_wrong_labels(self):
+        counter = self.registry.counter('frames_total', 'Frames.', ['protocol'])
+
+        with self.assertRaises(ValueError):
+            counter.inc(room=1)
+
+    def test_gauge(self):
+        gauge = self.registry.gauge('connections', 'Connections.', ['room'])
+        gauge.inc(room=1)
+        gauge.inc(room=1)
+        self.assertEqual(gauge.dec(room=1), 1)
+
+        gauge.remove(room=1)
+        self.assertNotIn('connections{', self.registry.render())
+
+        function = self.registry.gauge('pending', 'Pending.', function=lambda: 7)
+        self.assertEqual(function.get(), 7)
+        self.assertIn('pending 7', self.registry.render())
+
+    def test_histogram(self):
+        histogram = self.registry.histogram(
+            'seconds', 'Seconds.', ['command'], buckets=(0.1, 1))
+        histogram.observe(0.05, command='fetch_data')
+        histogram.observe(0.5, command='fetch_data')
+        histogram.observe(5, command='fetch_data')
+
+        self.assertEqual(histogram.get(command='fetch_data'), (3, 5.55))
+
+        text = self.registry.render()
+        self.assertIn('seconds_bucket{command="fetch_data",le="0.1"} 1', text)
+        self.assertIn('seconds_bucket{command="fetch_data",le="1.0"} 2', text)
+        self.assertIn('seconds_bucket{command="fetch_data",le="+Inf"} 3', text)
+        self.assertIn('seconds_count{command="fetch_data"} 3', text)
+
+    def test_label_escaping(self):
+        counter = self.registry.counter('errors_total', 'Errors.', ['message'])
+        counter.inc(message='say "hi"\n')
+
+        self.assertIn(r'errors_total{message="say \"hi\"\n"} 1',
+                      self.registry.render())
+
+    @override_settings(METRICS_TOKEN='secret')
+    def test_metrics_view(self):
+        response = self.client.get(
+            reverse('metrics'), HTTP_AUTHORIZATION='Bearer secret')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response['Content-Type'].startswith('text/plain'))
+        self.assertIn(b'# TYPE chat_command_seconds histogram', response.content)
+
+    @override_settings(METRICS_TOKEN='secret')
+    def test_metrics_view_forbidden(self):
+        for headers in ({}, {'HTTP_AUTHORIZATION': 'Bearer wrong'}):
+            response = self.client.get(reverse('metrics'), **headers)
+            self.assertEqual(response.status_code, 403)
+
+    @override_settings(METRICS_TOKEN='')
+    def test_metrics_view_no_token(self):
+        response = self.client.get(
+            reverse('metrics'), HTTP_AUTHORIZATION='Bearer ')
+
+        self.assertEqual(response.status_code, 403)
@@ -0,0 +1,70 @@
+import datetime
+from chat.models import ArchivedMessage, Message, Room
+from chat.serializers import MessageProjection, MessageSerializer
+from user.models import User
+from .helpers import HelperAPITestCase
+
+
+class MessageProjectionTest(HelperAPITestCase):
+    """
+    The fast path must give what MessageSerializer gives
+    """
+
+    def setUp(self):
+        super().setUp()
+
+        self.named = User.objects.create_user(
+            'named', 'named@myproject.com', 'password',
+            first_name='Named', last_name='User')
+        self.room = Room.objects.create(
+            user=self.normaluser, label='projection', name='Projection')
+        self.room.users.add(self.normaluser, self.named)
+
+        Message.objects.create(room=self.room, user=self.normaluser, message='Hi')
+        Message.objects.create(room=self.room, user=self.named, message='<b>Hey</b>')
+        ArchivedMessage.objects.create(
+            id=10000, room=self.room, user=self.named, message='Old',
+            created=datetime.datetime(2000, 1, 1, 12, 30, 15, 123456,
+                                      tzinfo=datetime.timezone.utc))
+
+    def assertSameOutput(self, instances, projected):
+        self.assertEqual(projected,
+                         [dict(data) for data in
+                          MessageSerializer(instances, many=True).data])
+
+    def test_values(self):
+        for model in (Message, ArchivedMessage):
+            queryset = model.objects.filter(room=self.room).order_by('id')
+
+            self.assertSameOutput(
+                queryset, MessageProjection.from_rows(
+                    MessageProjection.values(queryset)))
+
+    def test_instances(self):
+        for model in (Message, ArchivedMessage):
+            queryset = model.objects.filter(room=self.room).order_by('id')
+
+            self.assertSameOutput(
+                queryset, MessageProjection.from_instances(queryset))
+
+    def test_messages_of_a_room(self):
+        queryset = Message.objects.messages(self.normaluser, self.room.id)
+
+        self.assertSameOutput(
+            list(queryset), MessageProjection.from_rows(
+                MessageProjection.values(queryset)[:10]))
+
+    def test_unsaved_message(self):
+        message = Message(room=self.room, user=self.named, message='New')
+
+        self.assertEqual(MessageProjection.from_instance(message),
+                         MessageSerializer(message).data)
+
+    def test_message_list(self):
+        self.client.force_authenticate(self.normaluser)
+
+        response = self.get('message-list', data={'room': self.room.id})
+
+        self.assertSameOutput(
+            list(Message.objects.messages(self.normaluser, self.room.id)),
+            response.data['results'])
@@ -1,5 +1,9 @@
+from django.core.cache import cache
+from django.db import DatabaseError, connection, transaction
+from django.test import TransactionTestCase, override_settings
 from django.urls import reverse
-from user.models import User, Profile
+from user.graph import friend_graph
+from user.models import Friend, FriendEdge, User, Profile
 from .helpers import HelperAPITestCase
 
 
@@ -114,6 +118,33 @@ class UserAPITest(HelperAPITestCase):
         self.assertEqual(response.status_code, 200)
         self.assertEqual(len(response.data['results']), 2)
 
+    @override_settings(PAGINATION_COUNT_THRESHOLD=1)
+    def test_get_user_list_estimated_count(self):
+        self.client.force_authenticate(self.normaluser)
+
+        response = self.get('user-list')
+        self.assertFalse(response.data['approximate'])
+        self.assertEqual(response.data['count'], 2)
+
+        with connection.cursor() as cursor:
+            cursor.execute('ANALYZE')
+
+        response = self.get('user-list')
+        self.assertTrue(response.data['approximate'])
+        self.assertEqual(response.data['count'], 2)
+
+    def test_get_user_list_query_budget(self):
+        self.client.force_authenticate(self.normaluser)
+
+        def grow():
+            for i in range(5):
+                User.objects.create_user(
+                    f'budget{i}', f'budget{i}@myproject.com', 'password')
+
+        response = self.assertQueriesDoNotGrow(
+            2, grow, self.get, 'user-list')
+        self.assertEqual(len(response.data['results']), 7)
+
     def test_get_user_detail_forbidden(self):
         response = self.get('user-detail', None, [self.normaluser.id])
 
@@ -188,6 +219,47 @@ class UserAPITest(HelperAPITestCase):
             'profile-me', self.normaluser_credentials)
         self.assertEqual(response.status_code, 200)
 
+    def test_get_user_profile_not_modified(self):
+        self.client.force_authenticate(self.normaluser)
+
+        response = self.get('profile-me')
+        etag = response['ETag']
+
+        response = self.assertQueryBudget(
+            1, self.client.get, reverse('profile-me'), HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+
+        self.normaluser.profile.save()
+        response = self.client.get(
+            reverse('profile-me'), HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        etag = response['ETag']
+
+        self.normaluser.first_name = 'Changed'
+        self.normaluser.save()
+        response = self.client.get(
+            reverse('profile-me'), HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+
+    def test_get_other_profile_not_modified(self):
+        self.client.force_authenticate(self.normaluser)
+        url = reverse('profile-detail', args=[self.superuser.id])
+
+        etag = self.client.get(url)['ETag']
+        self.assertEqual(
+            self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+
+        # One more friend in common
+        friend = User.objects.create_user(
+            'mutual', 'mutual@myproject.com', 'password')
+        Friend.objects.add_friend(self.normaluser, friend)
+        Friend.objects.add_friend(self.superuser, friend)
+        friend_graph.invalidate(self.normaluser.id, self.superuser.id, friend.id)
+
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['mutual_friends'], 1)
+
     # FRIEND RESOURCES
     # ------------------
 
@@ -209,6 +281,132 @@ class UserAPITest(HelperAPITestCase):
         self.assertEqual(response.status_code, 200)
         self.assertEqual(len(response.data['results']), 1)
 
+    def test_get_friend_list_search_and_pages(self):
+        users = [User.objects.create_user(f'friend{i}', f'friend{i}@myproject.com',
+                                          'password') for i in range(12)]
+
+        # Both directions of the friendship
+        for user in users[:6]:
+            Friend.objects.add_friend(self.normaluser, user)
+        for user in users[6:]:
+            Friend.objects.add_friend(user, self.normaluser)
+
+        self.client.force_authenticate(self.normaluser)
+
+        expected = sorted(user.username for user in users)
+
+        for pagination in ('page', 'cursor'):
+            response = self.get('friend-list', data={
+                'ordering': 'username', 'pagination': pagination})
+            usernames = [user['username'] for user in response.data['results']]
+
+            response = self.client.get(response.data['links']['next'])
+            usernames += [user['username'] for user in response.data['results']]
+            self.assertIsNone(response.data['links']['next'])
+            self.assertEqual(usernames, expected)
+
+        # Page numbers by default
+        response = self.get('friend-list', data={'page': 2})
+        self.assertEqual(response.data['count'], 12)
+        self.assertEqual(response.data['total_pages'], 2)
+        self.assertEqual(len(response.data['results']), 2)
+
+        response = self.get('friend-list', data={'search': 'friend1'})
+        self.assertEqual(
+            sorted(user['username'] for user in response.data['results']),
+            ['friend1', 'friend10', 'friend11'])
+
+    def test_get_friend_list_query_budget(self):
+        self.client.force_authenticate(self.normaluser)
+
+        def grow():
+            for i in range(3):
+                Friend.objects.add_friend(self.normaluser, User.objects.create_user(
+                    f'budget{i}', f'budget{i}@myproject.com', 'password'))
+
+        Friend.objects.add_friend(self.superuser, self.normaluser)
+        # Count and page
+        response = self.assertQueriesDoNotGrow(2, grow, self.get, 'friend-list')
+        self.assertEqual(len(response.data['results']), 4)
+
+    def test_friend_edges(self):
+        Friend.objects.add_friend(self.normaluser, self.superuser)
+
+        edges = FriendEdge.objects.values_list('user', 'friend')
+        self.assertEqual(
+            set(edges), {(self.normaluser.id, self.superuser.id),
+                         (self.superuser.id, self.normaluser.id)})
+        self.assertTrue(Friend.objects.are_friends(self.superuser, self.normaluser))
+        self.assertEqual(
+            Friend.objects.friends_among(self.superuser, [self.normaluser.id, 100]),
+            {self.normaluser.id})
+
+        # Both directions stored, the friendship lasts until both are gone
+        Friend.objects.create(from_user=self.superuser, to_user=self.normaluser)
+        Friend.objects.get(from_user=self.normaluser).delete()
+        self.assertTrue(Friend.objects.are_friends(self.normaluser, self.superuser))
+
+        Friend.objects.remove_friend(self.normaluser, self.superuser)
+        self.assertFalse(FriendEdge.objects.exists())
+        self.assertFalse(Friend.objects.are_friends(self.normaluser, self.superuser))
+
+    def create_friend_graph(self):
+        """
+        normaluser - superuser, normaluser - friend1, both friends of
+        candidate1, superuser also friend of candidate2
+        :returns: candidate1, candidate2
+        """
+
+        friend1 = User.objects.create_user(
+            'friend1', 'friend1@myproject.com', 'password')
+        candidate1 = User.objects.create_user(
+            'candidate1', 'candidate1@myproject.com', 'password')
+        candidate2 = User.objects.create_user(
+            'candidate2', 'candidate2@myproject.com', 'password')
+
+        Friend.objects.add_friend(self.normaluser, self.superuser)
+        Friend.objects.add_friend(self.normaluser, friend1)
+        Friend.objects.add_friend(candidate1, self.superuser)
+        Friend.objects.add_friend(friend1, candidate1)
+        Friend.objects.add_friend(self.superuser, candidate2)
+
+        return candidate1, candidate2
+
+    def test_friend_suggestions(self):
+        candidate1, candidate2 = self.create_friend_graph()
+
+        response = self.get('friend-suggestions', self.normaluser_credentials)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            [(user['id'], user['mutual_friends'])
+             for user in response.data['results']],
+            [(candidate1.id, 2), (candidate2.id, 1)])
+
+        # Walking the most recent friend of each user only, friend1 over
+        # superuser whose ID is lower
+        self.assertEqual(
+            friend_graph.suggestions(self.normaluser.id, fanout=1),
+            [(candidate1.id, 1)])
+
+    def test_friend_suggestions_cached(self):
+        self.create_friend_graph()
+        self.client.force_authenticate(self.normaluser)
+        self.get('friend-suggestions')
+
+        # Users only, the graph comes from the cache
+        self.assertQueryBudget(1, self.get, 'friend-suggestions')
+
+    def test_profile_mutual_friends(self):
+        candidate1, candidate2 = self.create_friend_graph()
+
+        response = self.get(
+            'profile-detail', self.normaluser_credentials, [candidate1.id])
+        self.assertEqual(response.data['mutual_friends'], 2)
+
+        response = self.get('profile-me', self.normaluser_credentials)
+        self.assertNotIn('mutual_friends', response.data)
+
     def test_add_new_friend_empty_id(self):
         response = self.post(
             'friend-list', {}, self.normaluser_credentials)
@@ -290,3 +488,46 @@ class UserAPITest(HelperAPITestCase):
             'friend-list', data, self.normaluser_credentials)
 
         self.assertEqual(response.status_code, 204)
+
+
+class FriendGraphCommitTest(TransactionTestCase):
+    """
+    Friendship changes drop the cached graph once committed
+    """
+
+    def setUp(self):
+        cache.clear()
+
+        self.user, self.friend, self.candidate = [
+            User.objects.create_user(
+                f'graph{i}', f'graph{i}@myproject.com', 'password')
+            for i in range(3)
+        ]
+
+    def test_suggestions_rebuilt(self):
+        Friend.objects.add_friend(self.friend, self.candidate)
+
+        # Cached while user has no friend
+        self.assertEqual(friend_graph.suggestions(self.user.id), [])
+
+        Friend.objects.add_friend(self.user, self.friend)
+        self.assertEqual(friend_graph.suggestions(self.user.id),
+                         [(self.candidate.id, 1)])
+        self.assertEqual(friend_graph.friend_ids(self.friend.id),
+                         [self.user.id, self.candidate.id])
+
+        Friend.objects.remove_friend(self.friend, self.user)
+        self.assertEqual(friend_graph.suggestions(self.user.id), [])
+        self.assertEqual(friend_graph.friend_ids(self.friend.id),
+                         [self.candidate.id])
+
+    def test_rolled_back_change_keeps_cache(self):
+        self.assertEqual(friend_graph.friend_ids(self.user.id), [])
+
+        with self.assertRaises(DatabaseError):
+            with transaction.atomic():
+                Friend.objects.add_friend(self.user, self.friend)
+                raise DatabaseError
+
+        with self.assertNumQueries(0):
+            self.assertEqual(friend_graph.friend_ids(self.user.id), [])
@@ -1,5 +1,6 @@
 from django.contrib import admin
 from django.contrib.auth.admin import UserAdmin
+from chatapp.paginations import EstimatedCountPaginator
 from .models import User, Profile, Friend
 
 
@@ -11,7 +12,11 @@ class ProfileAdmin(admin.ModelAdmin):
 
 class FriendAdmin(admin.ModelAdmin):
     list_display = ('from_user', 'to_user', 'message')
-    search_fields = ('from_user', 'to_user')
+    search_fields = ('from_user__username', 'to_user__username')
+    list_select_related = ('from_user', 'to_user')
+    raw_id_fields = ('from_user', 'to_user')
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
 
 
 admin.site.register(User, UserAdmin)
@@ -0,0 +1,105 @@
+from collections import Counter
+from django.conf import settings
+from django.core.cache import cache
+from chatapp import constants
+
+
+class FriendGraph:
+    """
+    Adjacency lists of the friendship graph, the friend IDs of a user
+    kept in the cache, most recent friendship first. Lists are loaded from
+    the friendship edges on a miss and dropped when a friendship of their
+    user changes, so reading the graph never joins the friend tables and
+    concurrent changes cannot lose one another. Only the cache of the
+    process changing a friendship drops them, the others see the change
+    when the lists expire unless the cache is shared.
+    """
+
+    key_prefix = 'friend_graph'
+
+    def __init__(self, timeout):
+        """
+        :param timeout: Seconds an adjacency list stays in the cache
+        """
+        self.timeout = timeout
+
+    def key(self, user_id):
+        return f'{self.key_prefix}:{user_id}'
+
+    def friend_ids(self, user_id):
+        """
+        Get the friend IDs of a user, most recent friendship first
+        """
+        return self.friend_ids_many([user_id])[user_id]
+
+    def friend_ids_many(self, user_ids):
+        """
+        Get the friend IDs of many users, most recent friendship first, the
+        missing lists are loaded with one query
+        :returns: Dict of user ID to list of friend ID
+        """
+
+        from .models import FriendEdge
+
+        keys = {self.key(user_id): user_id for user_id in user_ids}
+        cached = cache.get_many(list(keys))
+        graph = {keys[key]: friend_ids for key, friend_ids in cached.items()}
+        missing = [user_id for user_id in user_ids if user_id not in graph]
+
+        if missing:
+            loaded = {user_id: [] for user_id in missing}
+            edges = FriendEdge.objects.filter(user__in=missing).order_by(
+                'user_id', '-id').values_list('user_id', 'friend_id')
+
+            for user_id, friend_id in edges:
+                loaded[user_id].append(friend_id)
+
+            cache.set_many({
+                self.key(user_id): friend_ids
+                for user_id, friend_ids in loaded.items()
+            }, self.timeout)
+            graph.update(loaded)
+
+        return graph
+
+    def invalidate(self, *user_ids):
+        """
+        Friendship added or removed, drop the lists of its users so the
+        next read loads them from the edges
+        """
+        cache.delete_many([self.key(user_id) for user_id in user_ids])
+
+    def mutual_count(self, user_1, user_2):
+        """
+        Count the friends two users have in common
+        """
+
+        graph = self.friend_ids_many([user_1, user_2])
+        return len(set(graph[user_1]).intersection(graph[user_2]))
+
+    def suggestions(self, user_id, limit=constants.FRIEND_SUGGESTION_LIMIT,
+                    fanout=constants.FRIEND_SUGGESTION_FANOUT):
+        """
+        Friends of friends who are not friends of user yet, most mutual
+        friends first. Only the `fanout` most recent friends of user and of
+        each of them are walked, which bounds the work for large graphs
+        and favours the active part of the network.
+        :returns: List of (user ID, mutual friend count)
+        """
+
+        friend_ids = self.friend_ids(user_id)
+        known = set(friend_ids)
+        known.add(user_id)
+        mutual = Counter()
+
+        for friends_of_friend in self.friend_ids_many(
+                friend_ids[:fanout]).values():
+            mutual.update(
+                candidate for candidate in friends_of_friend[:fanout]
+                if candidate not in known)
+
+        # Equal counts by ID, for a stable order
+        return sorted(mutual.items(), key=lambda item: (-item[1], item[0]))[:limit]
+
+
+friend_graph = FriendGraph(settings.FRIEND_GRAPH_CACHE_TIMEOUT)
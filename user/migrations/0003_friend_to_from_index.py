@@ -0,0 +1,17 @@
+# Generated by Django 2.2.28 on 2026-10-18 08:46
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('user', '0002_auto_20190423_0759'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='friend',
+            index=models.Index(fields=['to_user', 'from_user'], name='user_friend_to_from_idx'),
+        ),
+    ]
@@ -0,0 +1,44 @@
+# Generated by Django 2.2.28 on 2026-10-18 09:04
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def add_friend_edges(apps, schema_editor):
+    """
+    Store every friendship in both directions
+    """
+
+    Friend = apps.get_model('user', 'Friend')
+    FriendEdge = apps.get_model('user', 'FriendEdge')
+    edges = []
+
+    for from_user, to_user in Friend.objects.values_list(
+            'from_user', 'to_user').iterator():
+        edges.append(FriendEdge(user_id=from_user, friend_id=to_user))
+        edges.append(FriendEdge(user_id=to_user, friend_id=from_user))
+
+    FriendEdge.objects.bulk_create(edges, batch_size=1000, ignore_conflicts=True)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('user', '0003_friend_to_from_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='FriendEdge',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('friend', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL)),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'unique_together': {('user', 'friend')},
+            },
+        ),
+        migrations.RunPython(add_friend_edges, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 2.2.28 on 2026-10-18 09:21
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('user', '0004_friendedge'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='profile',
+            name='modified',
+            field=models.DateTimeField(auto_now=True),
+        ),
+        migrations.AddField(
+            model_name='user',
+            name='modified',
+            field=models.DateTimeField(auto_now=True),
+        ),
+    ]
@@ -1,11 +1,12 @@
-from django.db import models
+from django.db import models, transaction
 from django.db.models import Q
 from django.contrib.auth.models import AbstractUser, UserManager as AbstractUserManager
 from django.utils.translation import ugettext_lazy as _
 from rest_framework.exceptions import ValidationError, NotFound
 from django.core.validators import MinLengthValidator
-from django.db.models.signals import post_save
+from django.db.models.signals import post_delete, post_save
 from chatapp import settings
+from .graph import friend_graph
 
 
 class UserManager(AbstractUserManager):
@@ -22,6 +23,17 @@ class UserManager(AbstractUserManager):
         except User.DoesNotExist as e:
             raise NotFound(e)
 
+    def profile_validator(self, pk):
+        """
+        Values the profile of a user depends on, with one query
+        :returns: List of values or None if user does not exist
+        """
+
+        stamps = User.objects.filter(pk=pk).values_list(
+            'modified', 'profile__modified').first()
+
+        return None if stamps is None else list(stamps)
+
     def get_full_name(self):
         return f'{self.first_name} {self.last_name}'.strip()
 
@@ -33,24 +45,12 @@ class FriendshipManager(models.Manager):
 
     def friends(self, user):
         """
-        Return a list of all friends
+        Get the friends of a user with one range of the edges index, as a
+        User queryset to filter, order and paginate in SQL
         """
 
-        friends = Friend.objects.select_related(
-            'from_user', 'to_user').filter(Q(from_user=user) | Q(to_user=user)).all()
-
-
-        # Check to get only user friend object
-        results = []
-
-        for friend in friends:
-
-            friend_obj = friend.from_user == user and friend.to_user \
-                         or friend.from_user
-
-            results.append(friend_obj)
-
-        return results
+        return User.objects.select_related('profile').filter(
+            pk__in=FriendEdge.objects.filter(user=user).values('friend'))
 
     def add_friend(self, from_user, to_user, message=None):
         """
@@ -79,30 +79,49 @@ class FriendshipManager(models.Manager):
         Destroy a friendship relationship
         """
 
-        qs = Friend.objects.filter(
-            Q(to_user=to_user, from_user=from_user) |
-            Q(to_user=from_user, from_user=to_user)
-        ).distinct().all()
-
-        if qs:
-            qs.delete()
-            return True
-        else:
+        if not self.are_friends(from_user, to_user):
             raise ValidationError('Friendship does not exist.')
 
+        # Edges are removed by the post_delete receiver
+        self.friendship(from_user, to_user).delete()
+        return True
+
+
+    def friendship(self, user_1, user_2):
+        """
+        Friendship of two users in either direction
+        """
+        return Friend.objects.filter(Q(from_user=user_1, to_user=user_2)
+                                     | Q(from_user=user_2, to_user=user_1)).order_by()
 
     def are_friends(self, user_1, user_2):
         """
-        Check users are friends
+        Check users are friends with one probe of the edges index
         """
-        friends = Friend.objects.filter(Q(from_user=user_1, to_user=user_2)
-                                        | Q(from_user=user_2, to_user=user_1))
+        return FriendEdge.objects.filter(user=user_1, friend=user_2).exists()
 
-        return len(friends) > 0
+    def friends_among(self, user, candidate_ids):
+        """
+        Get which candidates are friends of a user in one query on the
+        edges index
+        :param user: User
+        :param candidate_ids: IDs of the users to check
+        :returns: Set of the candidate IDs who are friends of user
+        """
+
+        candidate_ids = set(candidate_ids)
+
+        if not candidate_ids:
+            return set()
+
+        return set(FriendEdge.objects.filter(
+            user=user, friend__in=candidate_ids
+        ).values_list('friend_id', flat=True))
 
 
 class User(AbstractUser):
     created = models.DateTimeField(auto_now_add=True, editable=False)
+    modified = models.DateTimeField(auto_now=True)
     username = models.CharField(
         _('username'), unique=True, max_length=50,
         validators=[MinLengthValidator(2),])
@@ -128,6 +147,7 @@ class User(AbstractUser):
 
 class Profile(models.Model):
     created = models.DateTimeField(auto_now_add=True, editable=False)
+    modified = models.DateTimeField(auto_now=True)
     user = models.OneToOneField(settings.base.AUTH_USER_MODEL,
                                 on_delete=models.CASCADE,
                                 related_name='profile',
@@ -162,6 +182,27 @@ class Friend(models.Model):
         verbose_name_plural = _('Friends')
         unique_together = ('from_user', 'to_user')
         ordering = ('-id',)
+        indexes = [
+            models.Index(fields=['to_user', 'from_user'],
+                         name='user_friend_to_from_idx'),
+        ]
+
+
+class FriendEdge(models.Model):
+    """
+    Friendship in both directions, a row per user and friend, kept in sync
+    with `Friend` so lookups by user need no OR over the two directions
+    """
+
+    user = models.ForeignKey(
+        settings.base.AUTH_USER_MODEL, related_name='+',
+        on_delete=models.CASCADE)
+    friend = models.ForeignKey(
+        settings.base.AUTH_USER_MODEL, related_name='+',
+        on_delete=models.CASCADE)
+
+    class Meta:
+        unique_together = ('user', 'friend')
 
 
 # Auto create user profile when user is created
@@ -171,3 +212,28 @@ def create_user_profile(sender, instance, created, **kwargs):
         return profile
 
 post_save.connect(create_user_profile, sender=User)
+
+
+# Keep friendship edges in sync with friend rows
+def add_friend_edges(sender, instance, created, **kwargs):
+    if created:
+        user_1, user_2 = instance.from_user_id, instance.to_user_id
+        FriendEdge.objects.bulk_create([
+            FriendEdge(user_id=user_1, friend_id=user_2),
+            FriendEdge(user_id=user_2, friend_id=user_1),
+        ], ignore_conflicts=True)
+        transaction.on_commit(lambda: friend_graph.invalidate(user_1, user_2))
+
+
+def remove_friend_edges(sender, instance, **kwargs):
+    # A friendship may also be stored in the other direction
+    user_1, user_2 = instance.from_user_id, instance.to_user_id
+
+    if not Friend.objects.friendship(user_1, user_2).exists():
+        FriendEdge.objects.filter(
+            Q(user=user_1, friend=user_2) | Q(user=user_2, friend=user_1)
+        ).delete()
+        transaction.on_commit(lambda: friend_graph.invalidate(user_1, user_2))
+
+post_save.connect(add_friend_edges, sender=Friend)
+post_delete.connect(remove_friend_edges, sender=Friend)
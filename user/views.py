@@ -9,8 +9,10 @@ from rest_framework.decorators import action, api_view, permission_classes, list
 from rest_framework.response import Response
 from django.shortcuts import get_object_or_404
 from rest_framework.exceptions import ValidationError
-from rest_framework.filters import SearchFilter
+from rest_framework.filters import OrderingFilter, SearchFilter
 from rest_framework_simplejwt.tokens import RefreshToken
+from chatapp import constants
+from chatapp.conditional import conditional
 from chatapp.permissions import (
     IsAdminOrIsSelf,
     IsSelfOrAdminUpdateDeleteOnly,
@@ -22,6 +24,7 @@ from .serializers import (
     FriendSerializer,
     PasswordSerializer,
 )
+from .graph import friend_graph
 from .models import User, Profile, Friend
 
 
@@ -33,7 +36,7 @@ class UserViewSet(viewsets.ModelViewSet):
         - Allow owner or admin can edit profile, change password, delete user
         - Allow anonymous can login
     """
-    queryset = User.objects.all().order_by('-date_joined')
+    queryset = User.objects.select_related('profile').order_by('-date_joined')
     serializer_class = UserSerializer
     permission_classes = (IsSelfOrAdminUpdateDeleteOnly,
                           IsAuthenticatedReadOnly,)
@@ -67,6 +70,19 @@ class UserViewSet(viewsets.ModelViewSet):
                             status=status.HTTP_400_BAD_REQUEST)
 
 
+def profile_validator(request, pk):
+    """
+    Validator of a profile, with the mutual friends shown to other users
+    """
+
+    values = User.objects.profile_validator(pk)
+
+    if values is None or str(request.user.id) == str(pk):
+        return values
+
+    return values + [friend_graph.mutual_count(request.user.id, int(pk))]
+
+
 class ProfileViewSet(viewsets.ModelViewSet):
     """
     API endpoint that allows profiles to be viewed or edited.
@@ -77,6 +93,8 @@ class ProfileViewSet(viewsets.ModelViewSet):
     http_method_names = ['get', 'put',]
     ordering = ('-id',)
 
+    @conditional(lambda view, request, pk=None: profile_validator(
+        request, pk or view.kwargs['pk']))
     def retrieve(self, request, pk=None):
         """
         Get profile detail base on user model
@@ -86,9 +104,15 @@ class ProfileViewSet(viewsets.ModelViewSet):
         user = User.objects.get(pk=pk)
 
         user_serializer = UserSerializer(user, context={'request': request})
+        data = user_serializer.data
+
+        # Friends in common with the profile of another user
+        if request.user.id != user.id:
+            data['mutual_friends'] = friend_graph.mutual_count(
+                request.user.id, user.id)
 
         return Response(
-            user_serializer.data,
+            data,
             status=status.HTTP_200_OK
         )
 
@@ -117,13 +141,23 @@ class FriendViewSet(viewsets.ModelViewSet):
     queryset = ''
     serializer_class = FriendSerializer
     permission_classes = (IsAuthenticated, IsSelfOrAdminUpdateDeleteOnly,)
-    filter_backends = (SearchFilter,)
+    filter_backends = (SearchFilter, OrderingFilter)
     search_fields = ('username',)
+    ordering_fields = ('id', 'username')
     ordering = ('-id',)
 
+    @property
+    def keyset_ordering(self):
+        """
+        Keyset pages follow the `ordering` param, id and username are both
+        unique
+        """
+        return OrderingFilter().get_ordering(self.request, None, self)
+
     def list(self, request):
         """
-        Get friends
+        Get friends, `search` by username, `ordering` by id or username,
+        `pagination=cursor` for keyset pages
         """
 
         queryset = Friend.objects.friends(request.user)
@@ -133,6 +167,37 @@ class FriendViewSet(viewsets.ModelViewSet):
             page, many=True, context={'request': request})
         return self.get_paginated_response(serializer.data)
 
+    @action(detail=False, methods=['get'])
+    def suggestions(self, request):
+        """
+        Friends of friends, most mutual friends first, `limit` up to
+        FRIEND_SUGGESTION_LIMIT
+        """
+
+        try:
+            limit = int(request.query_params.get(
+                'limit', constants.FRIEND_SUGGESTION_LIMIT))
+        except ValueError:
+            return Response({'detail': 'Limit must be an integer.'},
+                            status.HTTP_400_BAD_REQUEST)
+
+        suggestions = friend_graph.suggestions(
+            request.user.id, max(1, min(limit, constants.FRIEND_SUGGESTION_LIMIT)))
+        users = User.objects.select_related('profile').in_bulk(
+            [user_id for user_id, mutual in suggestions])
+        data = []
+
+        for user_id, mutual in suggestions:
+
+            # Cached graph may still have a deleted user
+            if user_id in users:
+                item = UserSerializer(
+                    users[user_id], context={'request': request}).data
+                item['mutual_friends'] = mutual
+                data.append(item)
+
+        return Response({'results': data})
+
     def create(self, request):
         """
         Creates a friend request